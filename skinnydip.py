@@ -25,15 +25,36 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
 #  MODULES  ************************************************
+from __future__ import print_function
 import argparse
 import getopt
-from bisect import bisect_left
+from array import array
+from bisect import bisect_right
+from collections import OrderedDict, deque
+import glob
+import gzip
+import hashlib
+import heapq
+import itertools
+import json
+import math
+import mmap
+import multiprocessing
+import errno
 import re
 import pprint
 import os
 import time
 import shutil
+import struct
 import sys
+import tempfile
+import threading
+import zlib
+try:
+    import tracemalloc
+except ImportError:  # python 2.  Profiles report time only.
+    tracemalloc = None
 
 
 #  CONSTANTS ************************************************
@@ -42,13 +63,25 @@ TEST_FILE = ""
 RESOURCE_PATH = "/home/erik/PycharmProjects/skinnydip/testobjects/"
 PROJECT_PATH = "/home/erik/PycharmProjects/skinnydip/"
 
-MIN_LEVEL_TO_LOG=0  #[0,1,2]
-
-TOOL_LIST = ["T0", "T1", "T2", "T3", "T4"]
+# LOGGING
+LOG_DEBUG = 0  # dumps of whole indexes and per-insertion detail
+LOG_INFO = 1
+LOG_WARNING = 2
+LOG_ERROR = 3
+LOG_LEVELS = {"debug": LOG_DEBUG, "info": LOG_INFO, "warning": LOG_WARNING, "error": LOG_ERROR}
+MIN_LEVEL_TO_LOG = LOG_INFO  # changed at runtime with --log-level
+LOG_BUFFER_LINES = 2000  # most recent messages kept in memory, for failure reports
+LOG_DIR = "logs"  # beside the script, one file per run
+LOG_KEEP_FILES = 200  # the oldest logs in LOG_DIR are deleted beyond this
 
 #distance in mm to fine tune automatic insertion distance
 AUTO_INSERTION_DISTANCE_TWEAK = -2
 
+# PRINT TIME SETTINGS.  Used to estimate how much time the insertions add to a print,
+# for the tools that don't set hotend_cooling_rate and hotend_heating_rate.
+HOTEND_COOLING_RATE = 1.5  # degrees C per second while M109 R waits for a lower temperature
+HOTEND_HEATING_RATE = 3.0  # degrees C per second while M109 waits for a higher temperature
+
 # settings to initialize all tools
 NULL_SETTINGS_DICT = {
     "insertion_distance": "auto",
@@ -62,22 +95,33 @@ NULL_SETTINGS_DICT = {
     "removal_pause": 0,
     "beep_on_dip": 0,
     "beep_on_temp": 0,
+    "dip_template": None,
+    "wait_template": None,
+    "restore_template": None,
+    "temp_change_template": None,
+    "hotend_cooling_rate": HOTEND_COOLING_RATE,
+    "hotend_heating_rate": HOTEND_HEATING_RATE,
 }
 
 # [lower limit, upper limit, [accepted values], default if no value]
-SAFE_RANGE = {
-    "insertion_speed": [300, 10000, [], 2000],
-    "extraction_speed": [300, 10000, [], 4000],
-    "insertion_pause": [0, 20000, [None, ], 0],
-    "insertion_distance": [0, 60, ["AUTO", None], "AUTO"],
-    "removal_pause": [0, 20000, [None, ], 0],
-    "print_temp": [150, 295, [], "error"],
-    "toolchange_temp": [150, 295, [0, -1, "0", "-1", "OFF"], "OFF"],
-    "beep_on_dip": [0, 1, ["OFF", "ON"], "OFF"],
-    "beep_on_temp": [0, 1, ["OFF", "ON"], "OFF"],
-}
-
-SET_ITEMS = NULL_SETTINGS_DICT.keys()
+# Checked in this order, which sets the order of the notices in the header, so that
+# every interpreter writes the same output.  The first nine are in the order python 2
+# iterated them in when this was a plain dict.
+SAFE_RANGE = OrderedDict([
+    ("print_temp", [150, 295, [], "error"]),
+    ("removal_pause", [0, 20000, [None, ], 0]),
+    ("beep_on_temp", [0, 1, ["OFF", "ON"], "OFF"]),
+    ("toolchange_temp", [150, 295, [0, -1, "0", "-1", "OFF"], "OFF"]),
+    ("beep_on_dip", [0, 1, ["OFF", "ON"], "OFF"]),
+    ("insertion_pause", [0, 20000, [None, ], 0]),
+    ("insertion_speed", [300, 10000, [], 2000]),
+    ("insertion_distance", [0, 60, ["AUTO", None], "AUTO"]),
+    ("extraction_speed", [300, 10000, [], 4000]),
+    ("hotend_cooling_rate", [0.1, 20, [], HOTEND_COOLING_RATE]),
+    ("hotend_heating_rate", [0.1, 20, [], HOTEND_HEATING_RATE]),
+])
+
+SET_ITEMS = list(NULL_SETTINGS_DICT.keys())
 VARS_FROM_SLIC3R_GCODE = ['cooling_tube_length', 'cooling_tube_retraction',
                           'extra_loading_move', 'parking_pos_retraction']
 # Alert Tones
@@ -87,56 +131,230 @@ UP_BEEP = "M300 S1912 P95  ;upbeep\nM300 S3830 P95  ;upbeep\n" + \
           "M300 S5742 P195 ;upbeep\n"
 
 # REGULAR EXPRESSIONS*********************************************************
-OLD_INSERTIONS_REGEX = r"(?P<temp_pause>G1 E-.*\n)((G1 E-|M73).*\n){2,7}" + \
-                   r"(M104 S(?P<filament_temp>.*)\n)?(?P<temp_restore>" + \
-                   r"G1 [^E].*\n)(?:.*\n){1,20}(?P<dip_pos>G1 E-).*\n" + \
-                   r"(.*\n){1,5}(?P<new_tool>T\d)"
+OLD_INSERTIONS_REGEX = br"(?P<temp_pause>G1 E-.*\n)((G1 E-|M73).*\n){2,7}" + \
+                   br"(M104 S(?P<filament_temp>.*)\n)?(?P<temp_restore>" + \
+                   br"G1 [^E].*\n)(?:.*\n){1,20}(?P<dip_pos>G1 E-).*\n" + \
+                   br"(.*\n){1,5}(?P<new_tool>T\d+)"
 
-INSERTIONS_REGEX = r"(?P<temp_pause>G1 E-.*\n)((G1 E-|M73).*\n){2,7}(M104 S(?P<filament_temp>.*)\n)?(?P<temp_restore>G1 [^E].*\n)(?:.*\n){1,20}(?P<dip_pos>G1.*[^E].*\n)(?:.*\n){1,5}G4 S.*\n(?P<new_tool>T\d)\nG4 S.*\n"
+# Matched line by line by match_unload, which reproduces the results of this pattern
+INSERTIONS_REGEX = br"(?P<temp_pause>G1 E-.*\n)((G1 E-|M73).*\n){2,7}(M104 S(?P<filament_temp>.*)\n)?(?P<temp_restore>G1 [^E].*\n)(?:.*\n){1,20}(?P<dip_pos>G1.*[^E].*\n)(?:.*\n){1,5}G4 S.*\n(?P<new_tool>T\d+)\nG4 S.*\n"
 TEMP_BEEP = ["M300 S3038 P155 ;temp_beep\n", "M300 S2550 P75 ;temp_beep\n"]
 
-CONFIGSTRING_REGEX = r"(SKINNYDIP CONFIGURATION START.?)(?P<configstring>.*)"
+# Order of insertions that land on the same line
+TEMPERATURE_PRIORITY = 0
+DIP_PRIORITY = 1
+REPLACE_PRIORITY = 2  # gcode written in place of the line, which is kept as an ORIGINAL_PREFIX comment
 
-START_TEMPCHANGE_REGEX = r"M220 B.*\nM220 S(?P<speed_override>\d.*)\n" + \
-                        r"(M.*\n)?(?P<temp_start>; CP TOOLCHANGE UNLOAD)"
+# Slicer progress lines: percent done and minutes remaining, for normal (P/R) and silent (Q/S) mode
+PROGRESS_REGEX = br"^M73 (?P<progress>[PQ])(?P<percent>\d+) (?P<timer>[RS])(?P<remaining>\d+)(?P<rest>.*)\n"
+
+START_TEMPCHANGE_REGEX = br"M220 B.*\nM220 S(?P<speed_override>\d.*)\n" + \
+                        br"(M.*\n)?(?P<temp_start>; CP TOOLCHANGE UNLOAD)"
 
 #OLD_WAIT_FOR_TEMP_REGEX = r"(?P<wait_for_temp>^G1 E-\d\d.*\n)(^G1 E-.*$\n)" + \
 #                      r"{1,30}M104 S.*"
-WAIT_FOR_TEMP_REGEX = r"(?P<wait_for_temp>^G1 E-\d\d.*\n)((^G1 E-.*$\n)|(M73.*\n)){1,10}"
-
+WAIT_FOR_TEMP_REGEX = br"(?P<wait_for_temp>^G1 E-\d\d.*\n)((^G1 E-.*$\n)|(M73.*\n)){1,10}"
 
-SETTINGS_REGEX = r"(?P<previous_tool>^T[01234].*$)(?P<otherstuff>(.*\n)" + \
-                 r"{10,250}?); SKINNYDIP CONFIGURATION START.*\n" + \
-                 r"(?P<parameters>(; .*\n){1,11});.?SKINNYDIP " + \
-                 r"CONFIGURATION END"
 
 #OLD_COOLING_MOVE_REGEX = r"(?P<dip_pos>G1 E-).*\n(.*\n){1,5}(?P<new_tool>T\d)"
-COOLING_MOVE_REGEX = r"(?P<temp_pause>G1 E-.*\n)((G1 E-|M73).*?\n){2,7}"
+COOLING_MOVE_REGEX = br"(?P<temp_pause>G1 E-.*\n)((G1 E-|M73).*?\n){2,7}"
+
+TOOLCHANGE_REGEX = br"(?P<tool>^T\d+$)"
+MAX_TOOL_NUMBER = 0xFFFF  # largest tool number that the toolchange index holds, see ToolTimeline
+
+FINAL_TOOLCHANGE_REGEX = br"G1 E.*\nG1.*\nG4 S0\n(?P<final>M2)20 R"  # ?M73
+
+# a field of an insertion template, eg. {insertion_distance}
+TEMPLATE_FIELD_REGEX = r"\{([^{}]*)\}"
+
+# CONFIGURATION BLOCK MARKERS
+CONFIG_START = b"; SKINNYDIP CONFIGURATION START"
+CONFIG_END = b"SKINNYDIP CONFIGURATION END"
+PROCESSED_MARKER = b"; SKINNYDIP"  # first line of every file this script has written
+
+# INSERTION MARKERS.  Everything this script adds to a file lies between these lines, so
+# that unprocessing can strip it and give back the original bytes.
+HEADER_END = b"; SKINNYDIP HEADER END\n"
+INSERTION_START = b"; SKINNYDIP INSERTION START\n"
+INSERTION_END = b"; SKINNYDIP INSERTION END\n"
+ORIGINAL_PREFIX = b"; SKINNYDIP ORIGINAL "  # starts the copy of a replaced line, inside an insertion block
+
+# GCODE TEXT ENCODING.  Gcode is handled as bytes and only the lines that are interpreted
+# are decoded.  Bytes that aren't valid utf-8 survive the round trip unchanged.
+GCODE_ENCODING = "utf-8"
+GCODE_ERRORS = "surrogateescape"
+CONFIG_MAX_LINES = 64  # longest SKINNYDIP CONFIGURATION block accepted
+
+# SLICER SETTINGS.  The slicer lists its settings as "; key = value" comments at the end of the file.
+SLICER_TAIL_BLOCK = 4096  # bytes read at a time, backwards from the end of the file
+SLICER_TEMPERATURES = "temperature"  # print temperature of each tool, which sets the number of tools
+
+# STREAMING ENGINE SETTINGS
+STDIO_FILENAME = "-"  # file name that selects stdin -> stdout pipe mode
+
+# PARALLEL ENGINE SETTINGS
+PARALLEL_MIN_CHUNK = 1 << 20  # smallest share of a file worth handing to another process
+PARALLEL_SPLIT_AFTER = b"; CP TOOLCHANGE END"  # chunks end after this line when they can
+
+# UNLOAD MATCHER SETTINGS.  Limits of the repetitions in INSERTIONS_REGEX.
+UNLOAD_COOLING_LINES = (2, 7)  # ((G1 E-|M73).*\n){2,7}
+UNLOAD_RESTORE_GAP = 20  # (?:.*\n){1,20} between temp_restore and dip_pos
+UNLOAD_TAIL_GAP = 5  # (?:.*\n){1,5} between dip_pos and the toolchange
+UNLOAD_WINDOW_LINES = 39  # most lines from temp_pause to the T line of its toolchange
+# lines the scanner keeps: an unload and the lines after its T line, or a configuration block
+SCAN_WINDOW_LINES = max(2 * UNLOAD_WINDOW_LINES + 2, CONFIG_MAX_LINES + 1)
+
+# BATCH MODE SETTINGS
+BATCH_EXTENSIONS = [".gcode", ".gco", ".g", ".bgcode"]  # files picked up from directories, also gzipped
+BATCH_RESULT_WAIT = 24 * 3600  # seconds.  A timeout keeps the wait interruptible by ctrl-c
+JOURNAL_DIR = "journals"  # beside the script, one journal per batch until it completes
+
+# WATCH MODE SETTINGS
+WATCH_POLL_INTERVAL = 2.0  # seconds between directory scans when inotify is unavailable
+WATCH_OUTPUT_DIR = "processed"  # default output folder, created inside each watched directory
+WATCH_FAILED_DIR = "failed"  # folder inside the output folder for files that could not be processed
+IN_CLOSE_WRITE = 0x00000008  # inotify event masks, from <sys/inotify.h>
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+
+# ANALYSIS CACHE SETTINGS
+CACHE_DIR = "cache"  # beside the script
+CACHE_MAX_BYTES = 64 * 1024 * 1024  # least recently used entries are evicted beyond this
+CACHE_FORMAT = 5  # bump when the fields of a cache entry change
+CACHE_EXTENSION = ".analysis"
+HASH_CHUNK_SIZE = 1 << 20
+
+# PLAN FILE SETTINGS
+PLAN_FORMAT = 1  # bump when the layout of a plan file changes
+PLAN_EXTENSION = ".plan.json"  # added to the name of the input when no plan file is named
+PLAN_BESIDE_INPUT = ""  # plan file name that selects the default, for each file of a batch
+
+# OUTPUT WRITER SETTINGS
+COPY_CHUNK_SIZE = 1 << 20  # read size for spans the kernel can't copy for us
+O_BINARY = getattr(os, "O_BINARY", 0)  # windows only
+
+# COMPRESSED AND BINARY GCODE SETTINGS.  Formats are recognised by their first bytes.
+GCODE_FORMAT = "gcode"
+GZIP_FORMAT = "gzip"
+BGCODE_FORMAT = "bgcode"
+GZIP_MAGIC = b"\x1f\x8b"
+GZIP_EXTENSION = ".gz"
+GZIP_LEVEL = 6
+BGCODE_MAGIC = b"GCDE"
+BGCODE_CHECKSUM_CRC32 = 1  # checksum types.  0 is none.
+BGCODE_FILE_METADATA = 0  # block types
+BGCODE_GCODE = 1
+BGCODE_SLICER_METADATA = 2
+BGCODE_PRINTER_METADATA = 3
+BGCODE_PRINT_METADATA = 4
+BGCODE_THUMBNAIL = 5
+BGCODE_NO_COMPRESSION = 0  # block compressions
+BGCODE_DEFLATE = 1
+BGCODE_HEATSHRINK = {2: (11, 4), 3: (12, 4)}  # compression: (window bits, lookahead bits)
+BGCODE_MEATPACK = [1, 2]  # gcode block encodings.  2 keeps comments.  0 is plain text.
+BGCODE_BLOCK_SIZE = 65535  # most bytes of gcode written to one block
+MEATPACK_SIGNAL = 0xFF  # two of these introduce a command
+MEATPACK_ENABLE_PACKING = 0xFB
+MEATPACK_DISABLE_PACKING = 0xFA
+MEATPACK_RESET_ALL = 0xF9
+MEATPACK_ENABLE_NO_SPACES = 0xF7
+MEATPACK_DISABLE_NO_SPACES = 0xF6
+MEATPACK_CHARACTERS = b"0123456789. \nGX"  # 4 bit codes 0-14.  15 marks a character sent whole.
+MEATPACK_GLINE_PARAMETERS = b"XYZEFIJRPWHCA"  # letters spaced out again when decoding no-space gcode
 
-TOOLCHANGE_REGEX = r"(?P<tool>^T[01234]$)"
+# CLASS DEFINITIONS **********************************************************
+class CustomError(Exception):
+    """
+    Generic custom error handler
+    """
+    pass
 
-FINAL_TOOLCHANGE_REGEX = r"G1 E.*\nG1.*\nG4 S0\n(?P<final>M2)20 R"  # ?M73
 
-TEMPERATURE_REGEX = regex = r"; temperature = (...),(...),(...),(...),(...)"
 
-FIRST_TOOL_SETTINGS_REGEX = r"\n(?P<first_tool>T[0-4])\nM.*\n;.*(SKINNYDIP " + \
-                            r"CONFIGURATION START)\n(?P<config_string>" + \
-                            r"(;.*\n)*)"
+class Lazy():
+    """
+    Log message that is only formatted if something reads it, eg.
+        lprint(Lazy(pprint.pformat, d.dip_lines), False, loglevel=LOG_DEBUG)
+    """
 
-LINEBREAKS_REGEX = r"(?P<linebreak>\n)"
+    def __init__(self, function, *args):
+        self.function = function
+        self.args = args
 
-# GLOBAL VARS
-logtext = ""
+    def __str__(self):
+        return str(self.function(*self.args))
 
 
-# CLASS DEFINITIONS **********************************************************
-class CustomError(Exception):
+class Log():
     """
-    Generic custom error handler
+    Leveled log of one run.  The most recent messages are kept in a bounded ring buffer;
+    once a log file is opened everything (including the messages buffered before it was
+    opened) is streamed to it as well.
     """
-    pass
+
+    def __init__(self, level=MIN_LEVEL_TO_LOG, capacity=LOG_BUFFER_LINES):
+        self.level = level
+        self.buffer = deque(maxlen=capacity)
+        self.dropped = 0  # messages that fell out of the buffer before a file was opened
+        self.file = None
+        self.file_name = None
+
+    def enabled(self, level):
+        return level >= self.level
+
+    def write(self, message):
+        if self.file is not None:
+            self.file.write(encode_gcode(message + "\n"))
+        elif len(self.buffer) == self.buffer.maxlen:
+            self.dropped += 1
+        self.buffer.append(message)
+
+    def open_file(self, file_name):
+        """
+        Starts streaming the log to file_name, beginning with the buffered messages.
+        :param file_name: path of the log file.  Its directory is created if necessary.
+        :return: None
+        """
+        self.close()
+        directory = os.path.dirname(file_name)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.file = open(file_name, "wb")
+        self.file_name = file_name
+        if os.path.dirname(file_name) == default_log_dir():
+            prune_logs()
+        if self.dropped:
+            self.file.write(encode_gcode("(" + str(self.dropped) + " earlier messages dropped)\n"))
+        for message in self.buffer:
+            self.file.write(encode_gcode(message + "\n"))
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def tail(self):
+        """
+        :return: string of the buffered messages
+        """
+        return "\n".join(self.buffer) + "\n"
+
+
+class LogContext(threading.local):
+    """
+    The log of the current run, replaced by start_log for each file of a batch, and the
+    stream that lprint displays messages on.  Each thread has its own, so that runs on
+    different threads (see process) keep their messages apart.
+    """
+
+    def __init__(self):
+        self.log = Log()
+        self.console = sys.stdout  # moved to stderr when gcode is written to stdout
 
 
+logging_context = LogContext()
+log_numbers = itertools.count(1)  # tells apart the logs of runs in one process
+
 
 class FileInfo():
     """
@@ -156,33 +374,202 @@ class FileInfo():
         self.lines = []
         self.outfile = None
         self.log_file_name = ""
+        self.stream = False
+        self.stdio = False
+        self.file_format = GCODE_FORMAT
+        self.reader = None  # open_gcode object of a gzip or binary gcode input
+        self.mapped_path = None  # path of the file mapped as text, if other processes can map it too
+        self.parallel = False
 
         self.skinnydip_script_absolute = os.path.abspath(__file__)
         self.skinnydip_script_dir = (os.path.dirname(self.skinnydip_script_absolute)).rstrip(os.sep)
-        self.log_file_name = str(os.path.join(self.skinnydip_script_dir, "skinnydip.log"))
+        self.log_file_name = log_file_for("skinnydip")
+
+        self.batch = False
+        self.batch_paths = []
+        self.jobs = None
+        self.journal_file_name = None
+        self.profile_file = None
+        self.cprofile_file = None
+        self.cache_dir = None
+        self.reprocess = False
+        self.unprocess = False
+        self.overrides = []  # (tool or None for every tool, setting, value) from --set
+        self.plan_file = None  # where --plan writes the insertion plan instead of the output
+        self.apply_file = None  # insertion plan that --apply writes into the input
+        self.watch = False
+        self.watch_dirs = []
+        self.output_dir = None
+        self.poll = False
 
         if self.target_file is not None:
             self.file_to_process = target_file
-            self.keep_original = False
-            self.inputfile_dir = RESOURCE_PATH
+            self.keep_original = args.get("keep", False)
+            self.stream = args.get("stream", False)
+            self.parallel = args.get("parallel", False)
+            self.jobs = args.get("jobs")
+            self.cache_dir = args.get("cache_dir")
+            self.reprocess = args.get("reprocess", False)
+            self.unprocess = args.get("unprocess", False)
+            self.overrides = list(args.get("overrides", []))
+            self.plan_file = args.get("plan_file")
+            self.apply_file = args.get("apply_file")
+            if TEST_FILE == "":
+                self.set_input_path(target_file)
+            else:
+                self.inputfile_dir = RESOURCE_PATH
 
         else:
             self.parser = argparse.ArgumentParser()
             self.parser.add_argument("myFile", nargs="+")  # "+" is for filenames with spaces
             self.parser.add_argument("-k", "--keep", dest="k", action='store_true',
                                      help="keep copy of original file")
+            self.parser.add_argument("-s", "--stream", dest="s", action='store_true',
+                                     help="process in a single forward pass with bounded memory use. " +
+                                          "Use - as the file name to filter stdin to stdout.")
+            self.parser.add_argument("-p", "--parallel", dest="p", action='store_true',
+                                     help="analyse a large file in chunks, on several cores at once")
+            self.parser.add_argument("-b", "--batch", dest="b", action='store_true',
+                                     help="process every file, directory, glob or @listfile given, " +
+                                          "in parallel")
+            self.parser.add_argument("-j", "--jobs", dest="j", type=int, default=None,
+                                     help="number of files to process at once in batch mode, or " +
+                                          "of chunks with --parallel (default: number of cores)")
+            self.parser.add_argument("--journal", dest="journal", default=None,
+                                     help="journal of finished files, used to resume an " +
+                                          "interrupted batch")
+            self.parser.add_argument("-w", "--watch", dest="w", action='store_true',
+                                     help="keep running and process gcode files as they appear " +
+                                          "in the directories given")
+            self.parser.add_argument("-o", "--output-dir", dest="o", default=None,
+                                     help="where watch mode moves files to (default: a " +
+                                          "'processed' folder in each watched directory)")
+            self.parser.add_argument("--poll", dest="poll", action='store_true',
+                                     help="scan watched directories periodically instead of " +
+                                          "using inotify")
+            self.parser.add_argument("--profile", dest="profile", default=None, metavar="REPORT",
+                                     help="write the time and memory used by each stage, and the " +
+                                          "use of each regular expression, to REPORT as JSON")
+            self.parser.add_argument("--cprofile", dest="cprofile", default=None, metavar="FILE",
+                                     help="with --profile, also save a cProfile of the run to FILE")
+            self.parser.add_argument("--log-level", dest="log_level", default=None,
+                                     choices=sorted(LOG_LEVELS, key=LOG_LEVELS.get),
+                                     help="lowest level of message to log (default: info)")
+            self.parser.add_argument("--log-file", dest="log_file", default=None,
+                                     help="where to write the log (default: " + LOG_DIR +
+                                          "/<input name>-<hash>-<time>.log beside this script)")
+            self.parser.add_argument("--cache", dest="cache", action='store_true',
+                                     help="keep the analysis of each file, and reuse it for a file " +
+                                          "with the same contents.  Looking a file up reads all of it")
+            self.parser.add_argument("--cache-dir", dest="cache_dir", default=None,
+                                     help="where --cache keeps the analyses, and turns it on " +
+                                          "(default: " + CACHE_DIR + " beside this script)")
+            self.parser.add_argument("--no-cache", dest="no_cache", action='store_true',
+                                     help="don't use the analysis cache, even with --cache or --cache-dir")
+            self.parser.add_argument("--reprocess", dest="reprocess", action='store_true',
+                                     help="accept a file this script already processed: strip the " +
+                                          "previous insertions and process it again")
+            self.parser.add_argument("--unprocess", dest="unprocess", action='store_true',
+                                     help="strip the header and insertions of a previous run, " +
+                                          "giving back the gcode the slicer wrote")
+            self.parser.add_argument("--set", dest="set", action='append', default=[],
+                                     metavar="[TOOL.]SETTING=VALUE",
+                                     help="override a setting of the configuration blocks, for one " +
+                                          "tool (eg. T1.insertion_distance=40) or every configured tool")
+            self.parser.add_argument("--plan", dest="plan", action='store_true',
+                                     help="analyse only, and save the insertion plan instead of writing gcode")
+            self.parser.add_argument("--apply", dest="apply", action='store_true',
+                                     help="write the insertions of a plan saved by --plan into the input, " +
+                                          "without analysing it again")
+            self.parser.add_argument("--plan-file", dest="plan_file", default=None, metavar="PLAN",
+                                     help="where --plan saves the plan and --apply reads it (default: " +
+                                          "the input name + " + PLAN_EXTENSION + ")")
             self.args = self.parser.parse_args()
+            if self.args.plan and self.args.apply:
+                self.parser.error("--plan and --apply can't be used together")
+            if (self.args.plan or self.args.apply) and \
+                    (self.args.unprocess or self.args.w or ' '.join(self.args.myFile) == STDIO_FILENAME):
+                self.parser.error("--plan and --apply need input files, and can't be used with " +
+                                  "--unprocess or --watch")
+            if self.args.plan_file is not None and (self.args.b or not (self.args.plan or self.args.apply)):
+                self.parser.error("--plan-file names the plan of a single file processed with --plan or " +
+                                  "--apply.  In batch mode, each plan is kept beside its file.")
+            if self.args.p and (self.args.b or self.args.w):
+                self.parser.error("--parallel splits one file across the cores, and can't be used with " +
+                                  "--batch or --watch.  A batch already processes its files in parallel.")
+            if (self.args.profile is not None or self.args.cprofile is not None) and (self.args.b or self.args.w):
+                self.parser.error("--profile and --cprofile measure the run of a single file, and can't be " +
+                                  "used with --batch or --watch")
+            plan_file = PLAN_BESIDE_INPUT
+            if self.args.plan_file is not None:
+                plan_file = os.path.realpath(self.args.plan_file)
+            if self.args.plan:
+                self.plan_file = plan_file
+            if self.args.apply:
+                self.apply_file = plan_file
+            try:
+                self.overrides = [parse_setting_override(text) for text in self.args.set]
+            except CustomError as e:
+                self.parser.error(str(e))
+            self.reprocess = self.args.reprocess
+            self.unprocess = self.args.unprocess
+            if (self.args.cache or self.args.cache_dir is not None) and not self.args.no_cache:
+                self.cache_dir = os.path.realpath(self.args.cache_dir or
+                                                  os.path.join(self.skinnydip_script_dir, CACHE_DIR))
+            if self.args.log_level is not None:
+                current_log().level = LOG_LEVELS[self.args.log_level]
+            if self.args.profile is not None:
+                self.profile_file = os.path.realpath(self.args.profile)
+                if self.args.cprofile is not None:
+                    self.cprofile_file = os.path.realpath(self.args.cprofile)
 
             self.keep_original = self.args.k
+            self.stream = self.args.s
+            self.parallel = self.args.p
+            self.jobs = self.args.j
             self.myFile = ' '.join(self.args.myFile)  # handle filenames with spaces
             self.file_to_process = self.args.myFile
 
-            self.inputfile_realpath = os.path.realpath(self.myFile)
-            self.file_to_process = self.inputfile_realpath
-            self.inputfile_dir = os.path.dirname(self.inputfile_realpath)
-            self.inputfile_bn = os.path.basename(self.myFile)
-
-        if self.file_to_process is not None:
+            if self.args.b:
+                self.batch = True
+                self.batch_paths = self.args.myFile
+                if self.args.journal is not None:
+                    self.journal_file_name = os.path.realpath(self.args.journal)
+                else:
+                    self.journal_file_name = journal_file_for(self.batch_paths, self.task_args())
+                self.file_to_process = None
+                self.log_file_name = log_file_for("batch")
+            elif self.args.w:
+                self.watch = True
+                self.watch_dirs = [os.path.realpath(path) for path in self.args.myFile]
+                if self.args.o is not None:
+                    self.output_dir = os.path.realpath(self.args.o)
+                self.poll = self.args.poll
+                self.file_to_process = None
+                self.log_file_name = log_file_for("watch")
+            elif self.myFile == STDIO_FILENAME:
+                # gcode goes to stdout, so keep the console messages out of it.
+                set_log_console(sys.stderr)
+                self.stdio = True
+                self.stream = True
+                self.file_to_process = None
+                self.inputfile_realpath = "<stdin>"
+                self.log_file_name = log_file_for("stdin")
+            else:
+                self.set_input_path(self.myFile)
+            if self.args.log_file is not None:
+                self.log_file_name = os.path.realpath(self.args.log_file)
+
+        if args.get("input_name") is not None:
+            self.inputfile_realpath = args["input_name"]  # shown in the header in place of the path
+
+        if self.stdio:
+            lprint('Filtering gcode from stdin to stdout')
+        elif self.batch:
+            lprint('Batch received for processing: ' + ' '.join(self.batch_paths))
+        elif self.watch:
+            lprint('Watching for gcode in: ' + ' '.join(self.watch_dirs))
+        elif self.file_to_process is not None:
             if TEST_FILE == "":
                 self.inputfilename = os.path.splitext(self.inputfile_bn)[0]
                 self.inputextension = os.path.splitext(self.inputfile_bn)[1]
@@ -210,24 +597,68 @@ class FileInfo():
             lprint('No file received as an argument')
 
 
-    def open_file_lines(self):
-        self.f = open(self.file_to_process)
-        self.lines = self.f.readlines()  # was .f.read()
+    def set_input_path(self, path):
+        self.inputfile_realpath = os.path.realpath(path)
+        self.file_to_process = self.inputfile_realpath
+        self.inputfile_dir = os.path.dirname(self.inputfile_realpath)
+        self.inputfile_bn = os.path.basename(path)
+        self.log_file_name = log_file_for(path)
+        if self.plan_file == PLAN_BESIDE_INPUT:
+            self.plan_file = self.inputfile_realpath + PLAN_EXTENSION
+        if self.apply_file == PLAN_BESIDE_INPUT:
+            self.apply_file = self.inputfile_realpath + PLAN_EXTENSION
+        if os.path.isfile(self.inputfile_realpath):
+            self.file_format = sniff_format(self.inputfile_realpath)
+        if self.file_format != GCODE_FORMAT:
+            # compressed gcode is read in forward passes only, never decompressed whole
+            self.stream = True
 
     def open_file(self):
-        self.f = open(self.file_to_process)
-        self.text = str(self.f.read())
+        """
+        Maps the input file into memory.  The regular expressions run directly on the
+        mapping, so the page cache holds the only copy of the file.  Standard input is
+        spooled to a temporary file first.  When reprocessing, a file this script already
+        processed is replaced by its original gcode.
+        """
+        if self.stdio:
+            self.f = tempfile.TemporaryFile(mode='w+b')
+            shutil.copyfileobj(getattr(sys.stdin, "buffer", sys.stdin), self.f)
+            self.f.flush()
+        else:
+            self.f = open(self.file_to_process, 'rb')
+            self.mapped_path = self.file_to_process
+        self.map_file()
+        if self.reprocess and not self.unprocess and self.text[:len(PROCESSED_MARKER)] == PROCESSED_MARKER:
+            self.restore_original()
+
+    def map_file(self):
+        try:
+            self.text = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:  # empty files can't be mapped
+            self.f.seek(0)
+            self.text = self.f.read()
+
+    def restore_original(self):
+        """
+        Swaps the open processed file for a temporary file holding the gcode it was made
+        from.  The analysis reads this copy and the output is copied from it.
+        """
+        segments, insertions = original_segments(self.text)
+        original = tempfile.TemporaryFile(mode='w+b')
+        write_segments(self.f.fileno(), original.fileno(), segments)
+        self.close_file()
+        self.f = original
+        self.mapped_path = None
+        self.map_file()
+        lprint("Stripped the header and " + str(insertions) + " insertions of a previous run")
 
     def close_file(self):
+        if isinstance(self.text, mmap.mmap):
+            self.text.close()
         self.f.close()
         del self.text
         self.text = ""
 
-    def close_file_lines(self):
-        self.f.close()
-        del self.lines
-        self.lines = []
-
     def write_output_file(self, contents):
         lprint("writing output to temporary file: " + self.outputfilenamefull)
         self.outfile = open(self.outputfilenamefull, 'w')
@@ -243,20 +674,398 @@ class FileInfo():
         lprint("moving post processed output to " + self.inputfullpath)
         os.rename(self.outputfilenamefull, self.inputfullpath)
 
-    def write_output_file_lines(self, contents):
+    def write_output_segments(self, segments):
+        """
+        Writes the output file from the segments made by splice_segments, copying the
+        unchanged spans straight from the open input file.
+        :param segments: list of strings of gcode and (offset, length) spans of the input
+        :return: None
+        """
         lprint("writing output to temporary file: " + self.outputfilenamefull)
-        self.outfile = open(self.outputfilenamefull, 'w')
-        self.outfile.writelines(contents)
-        self.outfile.close()
-        self.close_file_lines()
-        if self.keep_original:
-            lprint("renaming original file as " + self.bakfilefullpath)
-            os.rename(self.inputfullpath, self.bakfilefullpath)
+        outfile = os.open(self.outputfilenamefull, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | O_BINARY, 0o666)
+        try:
+            try:
+                write_segments(self.f.fileno(), outfile, segments)
+                os.fsync(outfile)
+            finally:
+                os.close(outfile)
+        except:
+            # never leave a half written file behind
+            os.remove(self.outputfilenamefull)
+            raise
+        self.close_file()
+        self.replace_original()
+
+    def open_stream(self):
+        """
+        Opens the input for a forward pass of the streaming engine.  Standard input
+        can't be rewound for the output pass, so it is copied to a temporary spool
+        file on disk as it is read.  So is the original gcode of a file being reprocessed,
+        which is rebuilt from the processed file in the same pass.
+        :return: iterable of lines
+        """
+        if self.file_format != GCODE_FORMAT:
+            # decompressed again for the output pass, so there is nothing to spool
+            self.reader = open_gcode(self.file_to_process, self.file_format)
+            self.f = None
+            if self.reprocess:
+                return OriginalLines(self.reader)
+            return self.reader
+        if self.stdio:
+            source = getattr(sys.stdin, "buffer", sys.stdin)
         else:
-            lprint("deleting original file: " + self.inputfullpath)
-            os.remove(self.inputfullpath)
+            source = open(self.file_to_process, 'rb')
+            processed = self.reprocess and source.read(len(PROCESSED_MARKER)) == PROCESSED_MARKER
+            source.seek(0)
+            if not processed:
+                self.f = source
+                return source
+        if self.reprocess:
+            # the original gcode is rebuilt as the file is read, and spooled like stdin
+            source = OriginalLines(source)
+        self.f = tempfile.TemporaryFile(mode='w+b')
+        return tee_lines(source, self.f)
+
+    def write_stream_output(self, segments):
+        """
+        Writes the output of the streaming engine to stdout, or over the original file.
+        :param segments: list of strings of gcode and (offset, length) spans of the input
+        :return: None
+        """
+        if self.file_format != GCODE_FORMAT:
+            self.write_encoded_output(segments)
+        elif self.stdio:
+            sys.stdout.flush()
+            write_segments(self.f.fileno(), sys.stdout.fileno(), segments)
+            self.f.close()
+        else:
+            self.write_output_segments(segments)
+
+    def write_encoded_output(self, segments):
+        """
+        Writes the output for a gzip or binary gcode input in the same format.  The input
+        is decompressed a second time and its spans are copied to the output as they go
+        by, so the decompressed gcode is never held whole in memory or on disk.
+        :param segments: list of strings of gcode and (offset, length) spans of the original
+                         gcode, or None to write the original gcode of a processed input
+        :return: OriginalLines the gcode was read through, or the reader of the input
+        """
+        if self.reader is not None:
+            self.reader.close()
+        self.reader = open_gcode(self.file_to_process, self.file_format)
+        lines = self.reader
+        if self.reprocess or self.unprocess:
+            lines = OriginalLines(self.reader)
+        lprint("writing output to temporary file: " + self.outputfilenamefull)
+        outfile = open(self.outputfilenamefull, "wb")
+        try:
+            try:
+                if self.file_format == GZIP_FORMAT:
+                    output = gzip_writer(outfile, self.inputfullpath)
+                else:
+                    output = BinaryGcodeWriter(outfile, self.reader)
+                if segments is None:
+                    copy_lines(lines, output)
+                else:
+                    copy_line_spans(lines, output, segments)
+                output.close()
+                outfile.flush()
+                os.fsync(outfile.fileno())
+            finally:
+                outfile.close()
+                self.reader.close()
+        except:
+            # never leave a half written file behind
+            os.remove(self.outputfilenamefull)
+            raise
+        self.replace_original()
+        return lines
+
+    def replace_original(self):
+        """
+        Moves the finished output over the input file.  The input path always holds
+        either the original or the complete output, even if the process dies here.
+        """
+        if self.keep_original:
+            lprint("keeping original file as " + self.bakfilefullpath)
+            if os.path.exists(self.bakfilefullpath):
+                os.remove(self.bakfilefullpath)
+            try:
+                os.link(self.inputfullpath, self.bakfilefullpath)
+            except (AttributeError, OSError):  # no hard links on this platform or filesystem
+                shutil.copy2(self.inputfullpath, self.bakfilefullpath)
         lprint("moving post processed output to " + self.inputfullpath)
-        os.rename(self.outputfilenamefull, self.inputfullpath)
+        replace_file(self.outputfilenamefull, self.inputfullpath)
+
+    def task_args(self):
+        """
+        :return: dict of the keyword arguments that make a FileInfo for another file
+                 processed the way this one is set up
+        """
+        return {"keep": self.keep_original, "stream": self.stream, "cache_dir": self.cache_dir,
+                "reprocess": self.reprocess, "unprocess": self.unprocess, "overrides": self.overrides,
+                "plan_file": self.plan_file, "apply_file": self.apply_file}
+
+
+class ToolTimeline():
+    """
+    Columnar index of the toolchanges in a file.  Toolchange n is the T? line at char
+    position positions[n] and line lines[n], and loads tool number tools[n].  Tools are
+    numbers throughout the script; tool_name gives the T? name for messages and gcode.  The final
+    unload, which has no T line, is recorded separately.
+    Lookups by position or line are bisections; TimelineCursor answers the lookups of a
+    forward sweep in constant time.
+    """
+
+    def __init__(self, size=None):
+        """
+        :param size: int: length of the file, or None if it isn't known yet
+        """
+        typecode = "I"
+        if size is None or size >= 2 ** (8 * array(typecode).itemsize):
+            typecode = "L"
+        self.positions = array(typecode)
+        self.lines = array(typecode)
+        self.tools = array("H")  # up to MAX_TOOL_NUMBER
+        self.final_position = None
+
+    def __len__(self):
+        return len(self.positions)
+
+    def append(self, position, line_number, tool):
+        """
+        Adds the toolchange on the T? line at position.  Toolchanges must be added in order.
+        :param position: int: char position of the T? line
+        :param line_number: int: line number of the T? line
+        :param tool: int: number of the tool loaded
+        :return: None
+        """
+        self.positions.append(position)
+        self.lines.append(line_number)
+        self.tools.append(tool)
+
+    def set_final(self, position):
+        """
+        :param position: int: char position of the final unload
+        :return: None
+        """
+        self.final_position = position
+
+    def tool_count(self):
+        """
+        :return: int: number of tools up to the highest one loaded
+        """
+        return max(self.tools) + 1 if self.tools else 0
+
+    def total(self):
+        """
+        :return: int: number of toolchanges, counting the final unload
+        """
+        return len(self.positions) + (self.final_position is not None)
+
+    def tool(self, index):
+        """
+        :param index: int: toolchange number
+        :return: int: number of the tool loaded by toolchange index, or None if index is
+                 before the first toolchange
+        """
+        if index < 0:
+            return None
+        return self.tools[index]
+
+    def previous_tool(self, index):
+        """
+        :param index: int: toolchange number
+        :return: int: tool that toolchange index unloads, or None for the first
+        """
+        return self.tool(index - 1)
+
+    def index_at(self, position):
+        """
+        :param position: int: char position in the file
+        :return: int: number of the last toolchange at or before position, or -1
+        """
+        return bisect_right(self.positions, position) - 1
+
+    def index_at_line(self, line_number):
+        """
+        :param line_number: int: line number in the file
+        :return: int: number of the last toolchange on or before line_number, or -1
+        """
+        return bisect_right(self.lines, line_number) - 1
+
+    def tool_at(self, position):
+        """
+        :param position: int: char position in the file
+        :return: int: tool active at position, or None before the first toolchange
+        """
+        return self.tool(self.index_at(position))
+
+    def tool_at_line(self, line_number):
+        """
+        :param line_number: int: line number in the file
+        :return: int: tool active on line_number, or None before the first toolchange
+        """
+        return self.tool(self.index_at_line(line_number))
+
+    def toolchange_on_line(self, line_number):
+        """
+        :param line_number: int: line number in the file
+        :return: int: number of the toolchange on line_number, or None if there isn't one
+        """
+        index = self.index_at_line(line_number)
+        if index < 0 or self.lines[index] != line_number:
+            return None
+        return index
+
+    def next_index(self, position):
+        """
+        :param position: int: char position in the file
+        :return: int: number of the first toolchange after position, or len(self) if none
+        """
+        return bisect_right(self.positions, position)
+
+    def sequence(self):
+        """
+        :return: list of the tools loaded, in order eg. ['T0','T1','T3']
+        """
+        return tool_names(self.tools)
+
+    def entries(self):
+        """
+        :return: list of (line number, char position, tool) for logging
+        """
+        return list(zip(self.lines, self.positions, self.sequence()))
+
+
+class TimelineCursor():
+    """
+    Looks up the active tool at positions that increase from one call to the next,
+    stepping through a ToolTimeline instead of searching it.
+    """
+
+    def __init__(self, timeline):
+        self.timeline = timeline
+        self.index = -1
+
+    def tool_at(self, position):
+        """
+        :param position: int: char position in the file
+        :return: int: tool active at position, or None before the first toolchange
+        """
+        positions = self.timeline.positions
+        if self.index >= 0 and positions[self.index] > position:  # went backwards
+            self.index = self.timeline.index_at(position)
+        count = len(positions)
+        while self.index + 1 < count and positions[self.index + 1] <= position:
+            self.index += 1
+        return self.timeline.tool(self.index)
+
+
+class InsertionPlan():
+    """
+    Sparse list of the gcode to be inserted into the output file, ordered by line.
+    Each entry is (line number, priority, sequence, gcode).  Any number of entries can
+    target the same line; they are written in priority order, then in the order they
+    were added, ahead of the original line.  An entry with REPLACE_PRIORITY takes the
+    place of the original line.
+    """
+
+    def __init__(self):
+        self.entries = []
+        self.is_sorted = True
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        self.sort()
+        return iter(self.entries)
+
+    def add(self, line_number, priority, gcode):
+        """
+        :param line_number: int: line of the input file that the gcode is placed before
+        :param priority: int: TEMPERATURE_PRIORITY, DIP_PRIORITY or REPLACE_PRIORITY
+        :param gcode: string of gcode.  Blank gcode is not planned.
+        :return: None
+        """
+        self.add_payload(line_number, priority, compile_payload(gcode))
+
+    def add_payload(self, line_number, priority, payload):
+        """
+        Plans gcode that compile_payload has already prepared.  The entry refers to
+        payload rather than copying it, so insertions of the same gcode share it.
+        :param line_number: int: line of the input file that the gcode is placed before
+        :param priority: int: TEMPERATURE_PRIORITY, DIP_PRIORITY or REPLACE_PRIORITY
+        :param payload: bytes made by compile_payload.  Blank gcode is not planned.
+        :return: None
+        """
+        if not payload:
+            return
+        self.entries.append((line_number, priority, len(self.entries), payload))
+        self.is_sorted = False
+
+    def sort(self):
+        if not self.is_sorted:
+            self.entries.sort()
+            self.is_sorted = True
+
+    def lines(self):
+        return [entry[0] for entry in self]
+
+
+def compile_payload(gcode):
+    """
+    :param gcode: string of gcode
+    :return: bytes of the gcode as it is written to the output: without blank lines at
+             either end, with a linebreak after every line.  Blank gcode gives b"".
+    """
+    lines = gcode.strip().splitlines()
+    if len(lines) == 0:
+        return b""
+    return encode_gcode("\n".join(lines) + "\n")
+
+
+def splice_segments(header, plan, position_of, end):
+    """
+    Works out the output file as a list of segments: the generated gcode, and the spans of
+    the input file that lie between insertion points, which are copied unchanged.  The
+    insertions made before each line are written as one block between INSERTION_START
+    and INSERTION_END.  A replaced line ends its block, behind ORIGINAL_PREFIX.
+    :param header: bytes of gcode for the beginning of the file, ending with HEADER_END
+    :param plan: InsertionPlan
+    :param position_of: function returning the char position at which an input line begins
+    :param end: int: length of the input file
+    :return: list of bytes of gcode and (offset, length) spans of the input
+    """
+    segments = [header]
+    offset = 0
+    block = None
+    for line_number, priority, sequence, gcode in plan:
+        position = position_of(line_number)
+        if block is None or position > offset:
+            if block is not None:
+                block.append(INSERTION_END)
+                segments.append(b"".join(block))
+            if position > offset:
+                segments.append((offset, position - offset))
+                offset = position
+            block = [INSERTION_START]
+        block.append(gcode)
+        if priority == REPLACE_PRIORITY and position == offset:
+            following = position_of(line_number + 1)
+            block.append(ORIGINAL_PREFIX)
+            segments.append(b"".join(block))
+            segments.append((position, following - position))
+            segments.append(INSERTION_END)
+            offset = following
+            block = None
+    if block is not None:
+        block.append(INSERTION_END)
+        segments.append(b"".join(block))
+    if end > offset:
+        segments.append((offset, end - offset))
+    return segments
 
 
 class SetupData():
@@ -264,39 +1073,50 @@ class SetupData():
     Data storage and configuration object.  Mainly transports data between functions
     """
 
-    def __init__(self, target_file):
+    def __init__(self, target_file, **args):
         self.scriptpath =  os.path.abspath(__file__)
-        self.configured_tools = []
+        self.configured_tools = []  # numbers of the tools with a configuration block, in order
+        self.tool_count = 0  # number of tools the file was sliced for
         self.auto_insertion_distance = None
         self.log_file_name = None
         self.gcode_str = ""
-        self.tool_settings = {}
-        self.tc_dict = {}
-        self.tc_list = []
-        self.tc_lines = []
-        self.toolnumber_sequence = []
-        self.dip_index = {}
-        self.dip_positions = []
+        self.tool_settings = []
+        self.timeline = ToolTimeline()
         self.dip_lines = []
-        self.temper_index = {}
-        self.temper_positions = []
         self.temper_lines = []
-        self.utool_settings = {}
-        self.tool_settings = {}
+        self.insertion_plan = InsertionPlan()
+        self.utool_settings = []  # settings of each tool, by tool number
+        self.tool_settings = []
+        self.tool_payloads = []  # compiled gcode of each tool's insertions, by tool number
         self.processed_gcode = ""
         self.target_file = target_file
         self.gcode_vars = {}
-        self.final_insertion_list = []
-        self.fileinfo = FileInfo(target_file)
-        self.output_lines = []
+        self.fileinfo = FileInfo(target_file, **args)
+        self.output_segments = []
         self.notices = []
+        self.line_positions = None  # char positions of the lines that insertions are planned at
+        self.config_blocks = None  # (position, line, parameters) of each configuration block
+        self.unloads = None  # match_unloads results
+        self.temp_changes = None  # (position, line) of each START_TEMPCHANGE_REGEX match
+        self.progress_lines = None  # (line number, line) of each PROGRESS_REGEX match
+        self.regex = re  # runs the regular expressions of the analysis, see Profiler
+        self.handler_counter = None  # times the handlers of the line scanner, see Profiler
+        self.slicer_settings = {}  # setting name: value, see read_slicer_settings
+        self.trailing_comments = []  # comment lines at the end of input that can't be read backwards
+        self.added_seconds = 0.0  # estimated print time added by the insertions
+        self.progress_corrected = 0
+        self.overrides = self.fileinfo.overrides
+        self.cache = None
+        if self.fileinfo.cache_dir is not None and not (self.fileinfo.stdio or self.fileinfo.unprocess or
+                                                        self.fileinfo.apply_file is not None):
+            self.cache = AnalysisCache(self.fileinfo.cache_dir)
+        self.cache_key = None
+        self.analysis_cached = False
+        self.insertions_stripped = 0
+        self.stage_seconds = []  # (name, wall time) of each stage run
+        self.stream_size = None  # length of the gcode, when it isn't mapped as gcode_str
         self.log_file_name = self.fileinfo.log_file_name
 
-    def sort_indexes(self):
-        # self.temper_index = sorted(self.temper_index)
-        # self.dip_index = sorted(self.dip_index)
-        pass
-
     def apply_automatic_values(self):
         for tool in self.configured_tools:
             try:
@@ -305,60 +1125,84 @@ class SetupData():
             except:
                 pass
 
+    def settings_of(self, tool):
+        """
+        :param tool: int: tool number, or None before the first toolchange
+        :return: dict of the settings of the tool, or NULL_SETTINGS_DICT for a tool the
+                 slicer didn't list
+        """
+        if tool is None or tool >= len(self.tool_settings):
+            return NULL_SETTINGS_DICT
+        return self.tool_settings[tool]
+
     def open_target_file(self):
         self.fileinfo.open_file()
         self.gcode_str = self.fileinfo.text
 
-    def open_target_file_lines(self):
-        self.fileinfo.open_file_lines()
-        self.gcode_lines = self.fileinfo.lines
-
     def check_target_file(self):
-        if self.gcode_str[:11] == "; SKINNYDIP":
+        if self.gcode_str[:len(PROCESSED_MARKER)] == PROCESSED_MARKER:
             raise CustomError("File was previously processed by this " + \
-                              "script.  Terminating.")
-        match = re.search("; SKINNYDIP CONFIGURATION START", self.gcode_str, re.MULTILINE)
-        if not match:
-            custom_message = "No skinnydip configuration data in target file.\n"
-            custom_message += "Configuration must be set up in start gcode for filaments that will be used.\n"
-            custom_message += "Please visit http://github.com/domesticatedviking/skinnydip to read the docs.\n"
-            lprint(custom_message, error=True)
+                              "script.  Use --reprocess to process it again.  Terminating.")
 
     def close_target_file(self):
         self.fileinfo.close_file()
 
-    def close_target_file_lines(self):
-        self.fileinfo.close_file_lines()
-
     def write_output_file(self):
         self.fileinfo.write_output_file(self.out)
 
-    def write_output_file_lines(self):
-        self.fileinfo.write_output_file_lines(self.output_lines)
+    def write_output_segments(self):
+        self.fileinfo.write_output_segments(self.output_segments)
+
+    def write_stream_output(self):
+        self.fileinfo.write_stream_output(self.output_segments)
 
-    def init_log_file(self, filename):
-        self.log_file_name = filename
+    def open_log_file(self):
+        current_log().open_file(self.fileinfo.log_file_name)
 
     def write_log_file(self):
-        lprint("Writing log file at " + str(self.fileinfo.log_file_name) + "\n")
-        logfile = open(self.fileinfo.log_file_name, "w")
-        logfile.write(logtext)
-        logfile.close()
+        lprint("Log written to " + str(self.fileinfo.log_file_name))
+        current_log().close()
 
 
 # GENERIC UTILITY FUNCTIONS **************************************************
-def raw_string(s):
+def decode_gcode(data):
+    """
+    Converts bytes read from a gcode file to text for interpretation.
+    :param data: bytes
+    :return: string.  On python 2 the bytes are already a string and are returned as they are.
+    """
+    if isinstance(data, str):
+        return data
+    return data.decode(GCODE_ENCODING, GCODE_ERRORS)
+
+
+def encode_gcode(text):
+    """
+    Converts generated gcode to bytes for writing.  Reverses decode_gcode exactly.
+    :param text: string
+    :return: bytes
+    """
+    if isinstance(text, bytes):
+        return text
+    return text.encode(GCODE_ENCODING, GCODE_ERRORS)
+
+
+def fsencode(path):
+    """
+    :return: path as bytes, for calls into the C library.  Python 2 paths already are.
+    """
+    if isinstance(path, bytes):
+        return path
+    return os.fsencode(path)
+
+
+def fsdecode(name):
     """
-    ensures that slashes are not read as escape characters.  Important when
-    forming regular expressions from strings
-    :param : generic string to convert to regex
-    :return: raw string
+    :return: a file name that the C library returned as bytes, as a native string
     """
-    if isinstance(s, str):
-        s = s.encode('string-escape')
-    elif isinstance(s, unicode):
-        s = s.encode('unicode-escape')
-    return s
+    if isinstance(name, str):
+        return name
+    return os.fsdecode(name)
 
 
 def merge_two_dicts(x, y):
@@ -367,6 +1211,34 @@ def merge_two_dicts(x, y):
     return z
 
 
+def tool_number(name):
+    """
+    :param name: string or bytes naming a tool eg. "T12"
+    :return: int: the tool number eg. 12
+    """
+    tool = int(name.strip()[1:])
+    if tool > MAX_TOOL_NUMBER:
+        raise CustomError("Tool number " + decode_gcode(name.strip()) + " is larger than " +
+                          str(MAX_TOOL_NUMBER) + ".  Terminating.")
+    return tool
+
+
+def tool_name(tool):
+    """
+    :param tool: int: tool number eg. 12
+    :return: string: the tool's name in gcode eg. "T12"
+    """
+    return "T" + str(tool)
+
+
+def tool_names(tools):
+    """
+    :param tools: iterable of tool numbers
+    :return: list of the tools' names, for messages
+    """
+    return [tool_name(tool) for tool in tools]
+
+
 def best_type(thisitem):
     """
     Takes an input of unknown type, tests it and returns the most logical type for that item
@@ -386,131 +1258,681 @@ def best_type(thisitem):
     return val, whattype
 
 
-def get_nearest(poslist, mypos):
-    """
-    Utility function to find the number closest to a an item in a list of numbers
-    :param: poslist: a list of integers
-    :param: mypos: an integer
-    :returns  an integer
-    """
-    # if mypos > poslist[-1] or mypos < poslist[0]:
-    #    return None
-    pos = bisect_left(poslist, mypos)
-    if pos == 0:
-        return poslist[0]
-    if pos == len(poslist):
-        return poslist[-1]
-    before = poslist[pos - 1]
-    after = poslist[pos]
-    if after - mypos < mypos - before:
-        return after
-    else:
-        return before
-
-
-def lprint(message, display=True, error=False, loglevel=1):
+def lprint(message, display=True, error=False, loglevel=LOG_INFO):
     """
-    Very simple logger and error reporter.  Requires global string variable logtext.
-    :param message: String indicating information or error
+    Very simple logger and error reporter.  Writes to the Log of the current thread.
+    :param message: String indicating information or error, or a Lazy message
     :param display: Outputs the information to the console in addition to logging it
     :param error: After logging the information, raises an error that displays the message
+    :param loglevel: one of LOG_DEBUG, LOG_INFO, LOG_WARNING, LOG_ERROR
     :return:
     """
-    global logtext
-    if loglevel >= MIN_LEVEL_TO_LOG:
-        logtext += str((message)) + "\n"
+    if error:
+        loglevel = max(loglevel, LOG_ERROR)
+    log = logging_context.log
+    logged = log.enabled(loglevel)
+    if logged or display or error:
+        message = str(message)  # formats Lazy messages, only when they will be read
+    if logged:
+        log.write(message)
     if error:
         raise CustomError(message)
-    if display:
-        print message
+    if display and logging_context.console is not None:
+        print(message, file=logging_context.console)
 
 
-# APPLICATION SPECIFIC UTILITY FUNCTIONS**************************************
-def regex_from_paramstr(paramstr):
+def start_log(level=None):
+    """
+    Begins a new log, eg. for each file of a batch.
+    :param level: lowest level to log, or None for the level of the current log
+    :return: the current Log object, to be handed back to restore_log
     """
-    Secondary function that accepts a variable name and forms a regular expression to scan
-    for that variable in configuration text
-    :param paramstr: string - variable name
-    :return: regular expression as raw string
+    previous = logging_context.log
+    logging_context.log = Log(previous.level if level is None else level)
+    return previous
+
+
+def restore_log(previous):
+    """
+    Closes the current log and returns to the one start_log replaced.
+    :param previous: Log object returned by start_log
+    :return: None
     """
-    raw_ps = raw_string(paramstr)
-    pattern = r";.*" + raw_ps + r" (?P<" + raw_ps + r">.*)\n"
-    return pattern
+    logging_context.log.close()
+    logging_context.log = previous
 
 
-def regex_from_gcode_varname(variable_name):
+def current_log():
     """
-    Secondary function that generate regular expressions to extract variables that slic3r has
-    noted in the gcode file
-    eg <cooling tube>= r"; cooling_tube_length.?=.(?P<cooling_tube_length>-?\d*)"
+    :return: the Log object of the current run on this thread
     """
-    varname = raw_string(variable_name)
+    return logging_context.log
 
-    pattern = r";.*" + varname + r".?=.(?P<" + varname + r">-?\d*)\n"
-    return pattern
 
+def default_log_dir():
+    """
+    :return: path of the log directory beside the script
+    """
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), LOG_DIR)
 
-def extract_params(tool, paramstr):
+
+def log_file_for(name):
     """
-    Secondary function to extract user's configuration parameters from the comments left in
-    filament start gcode comments.
-    :param tool:  Tool name ([T0..T4])
-    :param paramstr: String containing all of the settings for this tool.
-    :return: dictionary of values for all parameters listed in SET_ITEMS
+    :param name: name of the run, usually the path of its input file
+    :return: path of a new log file for that run, in the log directory beside the script.
+             The name of the input is followed by a hash of its full path, so that inputs
+             with the same name in different directories don't share a log, then by the
+             time, process id and a count so that every run has its own.
     """
-    out_dict = {}
-    for param in SET_ITEMS:
-        regex = regex_from_paramstr(param)
+    base = os.path.splitext(os.path.basename(name))[0] or "skinnydip"
+    path_hash = hashlib.sha1(encode_gcode(os.path.abspath(name))).hexdigest()[:8]
+    run = time.strftime("%Y%m%d-%H%M%S") + "-" + str(os.getpid()) + "-" + str(next(log_numbers))
+    return os.path.join(default_log_dir(), base + "-" + path_hash + "-" + run + ".log")
+
 
+def prune_logs():
+    """
+    Deletes the oldest logs in the log directory beside the script beyond LOG_KEEP_FILES.
+    Other runs may be pruning at the same time, so files that are already gone are skipped.
+    :return: None
+    """
+    directory = default_log_dir()
+    logs = []
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        try:
+            logs.append((os.path.getmtime(path), path))
+        except OSError:
+            continue
+    for mtime, path in sorted(logs)[:-LOG_KEEP_FILES]:
         try:
-            matches = re.search(regex, paramstr, re.MULTILINE)
-            if matches is not None:
-                thisitem = str(matches.group(param)).strip()
-                thisitem, besttype = best_type(thisitem)
-                out_dict[param] = thisitem
-
-        except Exception, e:
-            print str(e)
-            lprint("no matches for " + tool + ": regex" + regex)
-            out_dict[param] = -1
+            os.remove(path)
+        except OSError:
             pass
-    return out_dict
 
 
-def get_tool_from_filepos(d, filepos):
+def set_log_console(stream):
     """
-    Optimized search that scans for nearest tool location based on current position in the file
-    If the nearest location is greater than filepos, retrieves the next lowest position and returns it instead.
-    :param d: SetupData object
-    :param filepos: int: character position in input file
-    :return: string- toolnumber [T0..T4]
+    Redirects the messages that lprint displays on this thread, eg. to stderr when stdout
+    carries gcode.
+    :param stream: file object, or None to display nothing
+    :return: the stream that was used before
+    """
+    previous = logging_context.console
+    logging_context.console = stream
+    return previous
+
+
+def replace_file(source, destination):
+    """
+    Renames source over destination in a single step where the platform allows it.
+    :param source: path of the new file
+    :param destination: path of the file to replace
+    :return: None
+    """
+    if hasattr(os, "replace"):
+        os.replace(source, destination)
+    elif os.name == "nt":  # python 2 can't rename over an existing file on windows
+        os.remove(destination)
+        os.rename(source, destination)
+    else:
+        os.rename(source, destination)
+
+
+def tee_lines(source, copy):
+    """
+    Yields the lines of source while writing each of them to copy.
+    :param source: file object to read
+    :param copy: file object that receives an identical copy of the input
+    :return: generator of lines
+    """
+    for line in source:
+        copy.write(line)
+        yield line
+    copy.flush()
+
+
+def write_all(fd, data):
+    """
+    os.write may write less than it was given, so keep going until everything is written.
+    :param fd: file descriptor open for writing
+    :param data: bytes
+    :return: None
+    """
+    data = memoryview(data)  # slicing a memoryview doesn't copy
+    while len(data):
+        written = os.write(fd, data)
+        data = data[written:]
+
+
+def copy_span(src_fd, dst_fd, offset, count):
+    """
+    Copies count bytes starting at offset in src_fd to the current position of dst_fd.
+    Where possible the copy is done kernel-side with os.copy_file_range or os.sendfile
+    so the data never passes through Python.  Otherwise the span is copied in large
+    buffered reads.
+    :param src_fd: file descriptor open for reading
+    :param dst_fd: file descriptor open for writing
+    :param offset: int: position of the span in src_fd
+    :param count: int: length of the span
+    :return: None
+    """
+    kernel_copies = []
+    if hasattr(os, "copy_file_range"):
+        kernel_copies.append(lambda pos, n: os.copy_file_range(src_fd, dst_fd, n, pos))
+    if hasattr(os, "sendfile"):
+        kernel_copies.append(lambda pos, n: os.sendfile(dst_fd, src_fd, pos, n))
+    for kernel_copy in kernel_copies:
+        while count > 0:
+            try:
+                copied = kernel_copy(offset, count)
+            except OSError:  # not supported between these files.  Try the next method.
+                break
+            if copied == 0:
+                break
+            offset += copied
+            count -= copied
+    while count > 0:
+        os.lseek(src_fd, offset, os.SEEK_SET)
+        data = os.read(src_fd, min(count, COPY_CHUNK_SIZE))
+        if not data:
+            raise CustomError("Input file changed size while it was being copied.")
+        write_all(dst_fd, data)
+        offset += len(data)
+        count -= len(data)
+
+
+def preallocate(fd, size):
+    """
+    Reserves disk space for an output file of known size, where the OS supports it.
+    :param fd: file descriptor open for writing
+    :param size: int: final size of the file
+    :return: None
+    """
+    fallocate = getattr(os, "posix_fallocate", None)
+    if fallocate is None:
+        return
+    try:
+        fallocate(fd, 0, size)
+    except OSError:  # eg. pipes and filesystems without fallocate
+        pass
+
+
+def write_segments(src_fd, dst_fd, segments):
+    """
+    Writes a list of segments from splice_segments.  Bytes are written as they are,
+    (offset, length) spans are copied from the input file.
+    :param src_fd: file descriptor of the input file
+    :param dst_fd: file descriptor of the output file
+    :param segments: list of bytes and (offset, length) tuples
+    :return: None
+    """
+    size = 0
+    for segment in segments:
+        if isinstance(segment, tuple):
+            size += segment[1]
+        else:
+            size += len(segment)
+    preallocate(dst_fd, size)
+    for segment in segments:
+        if isinstance(segment, tuple):
+            copy_span(src_fd, dst_fd, segment[0], segment[1])
+        else:
+            write_all(dst_fd, segment)
+
+
+# APPLICATION SPECIFIC UTILITY FUNCTIONS**************************************
+def slicer_value(text):
+    """
+    :param text: string value of a slicer setting
+    :return: int or float for a number, a list of them for numbers separated by commas
+             (one for each tool), otherwise the string
+    """
+    values = []
+    for item in text.split(","):
+        try:
+            values.append(int(item))
+        except ValueError:
+            try:
+                values.append(float(item))
+            except ValueError:
+                return text
+    return values if len(values) > 1 else values[0]
+
+
+def parse_slicer_settings(lines):
+    """
+    :param lines: the slicer's "; key = value" comment lines, in file order.  Other lines are skipped.
+    :return: dict of setting name: value, see slicer_value.  A name listed twice keeps its last value.
+    """
+    settings = {}
+    for line in lines:
+        text = decode_gcode(line).strip()
+        key, equals, value = text[1:].partition("=")
+        if text[:1] == ";" and equals:
+            settings[key.strip()] = slicer_value(value.strip())
+    return settings
+
+
+def read_slicer_settings(f):
+    """
+    Reads the slicer's settings from the comments at the end of a gcode file.  The file is
+    read backwards from its end, SLICER_TAIL_BLOCK bytes at a time, until the last line
+    that isn't a comment, so only the settings are read whatever the size of the file.
+    :param f: seekable file object of the gcode, open for binary reading
+    :return: dict of setting name: value, see parse_slicer_settings
+    """
+    f.seek(0, os.SEEK_END)
+    start = f.tell()
+    partial = b""  # first line read so far, which may begin in a block not read yet
+    lines = []  # comment and blank lines from the end of the file, last first
+    while start > 0:
+        size = min(SLICER_TAIL_BLOCK, start)
+        start -= size
+        f.seek(start)
+        block_lines = (f.read(size) + partial).split(b"\n")
+        partial = block_lines.pop(0) if start > 0 else b""
+        for line in reversed(block_lines):
+            text = line.strip()
+            if text and text[:1] != b";":
+                start = 0
+                break
+            lines.append(line)
+    lines.reverse()
+    return parse_slicer_settings(lines)
+
+
+def iter_lines(text, pos=0):
+    """
+    Yields the lines of text (with their linebreaks) from char position pos onwards,
+    without splitting the rest of the file.
+    :param text: string or mmap
+    :param pos: int: char position of the first line
+    """
+    size = len(text)
+    while pos < size:
+        end = text.find(b"\n", pos)
+        end = size if end < 0 else end + 1
+        yield text[pos:end]
+        pos = end
+
+
+def is_toolchange_tail(lines, n):
+    """
+    :param lines: list of complete lines
+    :param n: int: index in lines
+    :return: True if the lines from n are "G4 S.. / T? / G4 S.."
+    """
+    if n + 2 >= len(lines):
+        return False
+    text = lines[n + 1]
+    return text[:1] == b"T" and text[-1:] == b"\n" and text[1:-1].isdigit() and \
+        lines[n].startswith(b"G4 S") and lines[n + 2].startswith(b"G4 S")
+
+
+def match_unload(lines, first):
+    """
+    Line level state machine equivalent to trying INSERTIONS_REGEX on one line.  The
+    repetitions are tried in the order the regex would try them (greedy, longest
+    first) so the same points are found, but only line indexes are returned.
+    :param lines: list of complete lines
+    :param first: int: index of the candidate temp_pause line
+    :return: dict of the indexes of temp_pause, temp_restore, dip_pos, new_tool and end
+             (the line after the match) plus filament_temp (bytes or None); or None
+    """
+    if b"G1 E-" not in lines[first]:
+        return None
+    count = len(lines)
+    cooling = 0
+    while cooling < UNLOAD_COOLING_LINES[1] and first + 1 + cooling < count:
+        text = lines[first + 1 + cooling]
+        if not (text.startswith(b"G1 E-") or text.startswith(b"M73")):
+            break
+        cooling += 1
+    for cooling in range(cooling, UNLOAD_COOLING_LINES[0] - 1, -1):
+        after = first + 1 + cooling
+        if after < count and lines[after].startswith(b"M104 S"):
+            match = match_unload_from_restore(lines, after + 1)
+            if match is not None:
+                match["filament_temp"] = lines[after][6:-1]
+                match["temp_pause"] = first
+                return match
+        match = match_unload_from_restore(lines, after)
+        if match is not None:
+            match["filament_temp"] = None
+            match["temp_pause"] = first
+            return match
+    return None
+
+
+def match_unload_from_restore(lines, restore):
+    """
+    Matches the part of INSERTIONS_REGEX from temp_restore to the end of the toolchange.
+    :param lines: list of complete lines
+    :param restore: int: index of the candidate temp_restore line
+    :return: dict of the indexes of temp_restore, dip_pos, new_tool and end; or None
+    """
+    count = len(lines)
+    if restore >= count:
+        return None
+    text = lines[restore]
+    if not text.startswith(b"G1 ") or text[3:4] == b"E":
+        return None
+    after = restore + 1
+    if len(text) == 4:  # "G1 \n": [^E] takes the linebreak and .*\n the next line
+        after += 1
+    # dip_pos is one line long, or two when its [^E] takes the linebreak.  The
+    # toolchange follows it after 1 to UNLOAD_TAIL_GAP lines.
+    last_tail = after + UNLOAD_RESTORE_GAP + 2 + UNLOAD_TAIL_GAP
+    tails = [n for n in range(min(last_tail, count - 3), after + 2, -1) if is_toolchange_tail(lines, n)]
+    if not tails:
+        return None
+    for dip in range(min(after + UNLOAD_RESTORE_GAP, count - 1), after, -1):
+        text = lines[dip]
+        if not text.startswith(b"G1"):
+            continue
+        spans = [2]
+        if text[2:-1].strip(b"E"):
+            spans.append(1)
+        for span in spans:
+            for tail in tails:
+                if dip + span < tail <= dip + span + UNLOAD_TAIL_GAP:
+                    return {"temp_restore": restore, "dip_pos": dip,
+                            "new_tool": tail + 1, "end": tail + 3}
+    return None
+
+
+def find_unload(lines, toolchange, floor):
+    """
+    Finds the first match of INSERTIONS_REGEX that could end at the toolchange at
+    lines[toolchange], looking back no further than UNLOAD_WINDOW_LINES.
+    :param lines: list of complete lines
+    :param toolchange: int: index of a T? line
+    :param floor: int: first index a match may start at
+    :return: dict returned by match_unload, or None
+    """
+    for first in range(max(floor, toolchange - UNLOAD_WINDOW_LINES), toolchange):
+        if b"G1 E-" in lines[first]:
+            match = match_unload(lines, first)
+            if match is not None:
+                return match
+    return None
+
+
+def match_unloads(text, starts, linecount, toolchange_lines, floor=0):
+    """
+    Runs find_unload over the lines around each toolchange in turn.  Each toolchange is
+    visited once, and only the lines before it that INSERTIONS_REGEX could span are
+    examined.  Lines taken by one unload are not searched again for the next.
+    :param text: string or mmap holding the gcode
+    :param starts: array of the char positions at which the lines of text begin
+    :param linecount: int: number of lines in starts that end with a newline
+    :param toolchange_lines: numbers of the T? lines, in order
+    :param floor: int: first line that an unload may begin on
+    :return: (list of dicts of the lines and positions of each unload, floor after the last toolchange)
+    """
+    unloads = []
+    for toolchange_line in toolchange_lines:
+        # a match can start UNLOAD_WINDOW_LINES before the toolchange, and one that
+        # starts just before it can run on to a later toolchange.
+        base = max(floor, toolchange_line - UNLOAD_WINDOW_LINES)
+        end = min(linecount, toolchange_line + UNLOAD_WINDOW_LINES + 2)
+        lines = [text[starts[n]:starts[n + 1]] for n in range(base, end)]
+        match = find_unload(lines, toolchange_line - base, 0)
+        if match is None:
+            floor = max(floor, toolchange_line)
+            continue
+        floor = base + match["end"]
+        unloads.append({"temp_pause_line": base + match["temp_pause"],
+                        "temp_pause_pos": starts[base + match["temp_pause"]] +
+                                          lines[match["temp_pause"]].find(b"G1 E-"),
+                        "temp_restore_line": base + match["temp_restore"],
+                        "temp_restore_pos": starts[base + match["temp_restore"]],
+                        "dip_line": base + match["dip_pos"],
+                        "new_tool_line": base + match["new_tool"],
+                        "new_tool": decode_gcode(lines[match["new_tool"]]).strip(),
+                        "filament_temp": match["filament_temp"]})
+    return unloads, floor
+
+
+def parse_config_block(lines):
     """
-    scanlist = d.tc_list
-    nearest_toolchange = get_nearest(scanlist, filepos)
-    if nearest_toolchange > filepos:  # toolchange happened after the position in the file (wrong one!)
-        nearest_index = d.tc_list.index(nearest_toolchange)  # search for the index's position in the list
-        nearest_toolchange = d.tc_list[nearest_index - 1]
-    return d.tc_dict[nearest_toolchange]['new_tool']
+    Tokenizes the "; key value" lines of a SKINNYDIP CONFIGURATION block in a single pass.
+    The block ends at the CONFIGURATION END marker, the first line that is not a
+    comment, or after CONFIG_MAX_LINES lines.  The first value given for a key wins.
+    :param lines: iterable of the lines following the CONFIGURATION START line
+    :return: dictionary of values for the parameters listed in SET_ITEMS
+    """
+    params = {}
+    for count, line in enumerate(lines):
+        if count >= CONFIG_MAX_LINES or line[:1] != b";" or CONFIG_END in line:
+            break
+        fields = decode_gcode(line[1:]).split(None, 1)
+        if fields and fields[0] in SET_ITEMS and fields[0] not in params:
+            value = fields[1].strip() if len(fields) > 1 else ""
+            params[fields[0]] = best_type(value)[0]
+    return params
+
+
+def find_config_blocks(text, first=0, last=None):
+    """
+    Locates every SKINNYDIP CONFIGURATION block with plain substring searches.  A block
+    starts with a line that begins with CONFIG_START.
+    :param text: string or mmap holding the gcode
+    :param first: int: char position of a line to search from
+    :param last: int: char position that the START lines must end before.  Defaults to the end of text
+    :return: list of (char position of the START line, dict of parsed parameters)
+    """
+    if last is None:
+        last = len(text)
+
+    def next_block(pos):
+        found = text.find(b"\n" + CONFIG_START, pos, last)
+        return found + 1 if found >= 0 else -1
+
+    blocks = []
+    start = next_block(first)
+    if text[first:first + len(CONFIG_START)] == CONFIG_START and first + len(CONFIG_START) <= last:
+        start = first
+    while start >= 0:
+        body = text.find(b"\n", start)
+        if body < 0:
+            break
+        blocks.append((start, parse_config_block(iter_lines(text, body + 1))))
+        start = next_block(body)
+    return blocks
+
+
+def original_segments(text):
+    """
+    Finds the spans of a processed file that hold the original gcode: everything
+    except the header and the insertion blocks, apart from the lines they replaced.  Plain
+    substring searches, so the cost depends on the number of insertions rather than the
+    number of lines.
+    :param text: string or mmap holding gcode written by this script
+    :return: (list of (offset, length) spans of text, number of insertion blocks left out)
+    """
+    if text[:len(PROCESSED_MARKER)] != PROCESSED_MARKER:
+        raise CustomError("File was not processed by this script.  Nothing to strip.")
+    header_end = text.find(b"\n" + HEADER_END)
+    if header_end < 0:
+        raise CustomError("File was processed by a version of this script that didn't mark its " +
+                          "insertions, so they can't be stripped.  Reslice it instead.")
+    segments = []
+    insertions = 0
+    offset = header_end + 1 + len(HEADER_END)
+    block = text.find(b"\n" + INSERTION_START, offset - 1)
+    while block >= 0:
+        block += 1
+        if block > offset:
+            segments.append((offset, block - offset))
+        block_end = text.find(b"\n" + INSERTION_END, block)
+        if block_end < 0:
+            raise CustomError("Insertion at char " + str(block) + " has no end marker.  " +
+                              "The file was edited after processing.")
+        original = text.find(b"\n" + ORIGINAL_PREFIX, block, block_end)
+        if original >= 0:  # a replaced line
+            original += 1 + len(ORIGINAL_PREFIX)
+            segments.append((original, block_end + 1 - original))
+        offset = block_end + 1 + len(INSERTION_END)
+        insertions += 1
+        block = text.find(b"\n" + INSERTION_START, offset - 1)
+    if len(text) > offset:
+        segments.append((offset, len(text) - offset))
+    return segments, insertions
+
+
+class OriginalLines():
+    """
+    Line by line counterpart of original_segments for a single forward pass: iterating
+    gives the lines of the original gcode of a processed file.  Gcode that wasn't
+    processed by this script passes through unchanged.
+    """
+
+    def __init__(self, source):
+        """
+        :param source: iterable of lines
+        """
+        self.source = source
+        self.processed = False
+        self.insertions = 0  # insertion blocks left out so far
+
+    def __iter__(self):
+        lines = iter(self.source)
+        first = next(lines, None)
+        if first is None:
+            return
+        if first[:len(PROCESSED_MARKER)] != PROCESSED_MARKER:
+            yield first
+            for line in lines:
+                yield line
+            return
+        self.processed = True
+        for line in lines:
+            if line == HEADER_END:
+                break
+        else:
+            raise CustomError("File was processed by a version of this script that didn't mark its " +
+                              "insertions, so they can't be stripped.  Reslice it instead.")
+        inside = False
+        for line in lines:
+            if inside:
+                inside = line != INSERTION_END
+                if line[:len(ORIGINAL_PREFIX)] == ORIGINAL_PREFIX:
+                    yield line[len(ORIGINAL_PREFIX):]
+            elif line == INSERTION_START:
+                inside = True
+                self.insertions += 1
+            else:
+                yield line
+        if inside:
+            raise CustomError("The last insertion has no end marker.  The file was edited after processing.")
+
+
+def estimate_seconds(gcode, temperature=None, cooling_rate=HOTEND_COOLING_RATE,
+                     heating_rate=HOTEND_HEATING_RATE):
+    """
+    Estimates how long the printer takes to run a piece of gcode: moves at their feed
+    rates, G4 dwells, M300 beeps, and M109 waits for the hotend to get from temperature to
+    the target at cooling_rate or heating_rate.  Acceleration is ignored, and move
+    distances are taken as relative, as they are in the gcode this script inserts.
+    :param gcode: bytes of gcode
+    :param temperature: hotend temperature when the gcode begins, or None if unknown
+    :param cooling_rate: degrees C per second the hotend cools by
+    :param heating_rate: degrees C per second the hotend heats by
+    :return: float: seconds
+    """
+    seconds = 0.0
+    feedrate = None
+    for line in decode_gcode(gcode).splitlines():
+        fields = line.split(";", 1)[0].upper().split()
+        if not fields:
+            continue
+        params = {}
+        for field in fields[1:]:
+            try:
+                params[field[:1]] = float(field[1:])
+            except ValueError:
+                pass
+        command = fields[0]
+        if command in ["G0", "G1"]:
+            feedrate = params.get("F", feedrate)
+            distance = math.sqrt(sum([params.get(axis, 0.0) ** 2 for axis in "XYZE"]))
+            if feedrate:
+                seconds += distance / feedrate * 60
+        elif command == "G4":
+            seconds += params.get("P", 0.0) / 1000 + params.get("S", 0.0)
+        elif command == "M300":
+            seconds += params.get("P", 0.0) / 1000
+        elif command == "M109":
+            target = params.get("R", params.get("S"))
+            if target is not None and temperature is not None:
+                rate = cooling_rate if target < temperature else heating_rate
+                seconds += abs(temperature - target) / rate
+            if target is not None:
+                temperature = target
+    return seconds
+
+
+def format_duration(seconds):
+    """
+    :param seconds: float
+    :return: string eg. "1h 05m 12s"
+    """
+    seconds = int(seconds + 0.5)
+    return "%dh %02dm %02ds" % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+def parse_setting_override(text):
+    """
+    Reads a --set argument.  eg. "T1.insertion_distance=40" sets the insertion distance of
+    T1, "toolchange_temp=off" turns toolchange temperatures off for every configured tool.
+    :param text: string of the form [TOOL.]SETTING=VALUE
+    :return: (tool number or None for every configured tool, setting name, value)
+    """
+    name, equals, value = text.partition("=")
+    tool, dot, setting = name.strip().rpartition(".")
+    tool = tool.upper() or None
+    if not equals or setting not in NULL_SETTINGS_DICT or (tool is not None and not re.match(r"T\d+$", tool)):
+        raise CustomError("Can't read the setting '" + text + "'.  Expected [TOOL.]SETTING=VALUE, " +
+                          "with TOOL a tool such as T0 and SETTING one of " +
+                          ", ".join(sorted(NULL_SETTINGS_DICT)))
+    if tool is not None:
+        tool = tool_number(tool)
+    return tool, setting, best_type(value.strip())[0]
 
 
 # OUTPUT FUNCTIONS ***********************************************************
-def generate_temp_restore(d, position):
+def generate_temp_restore(d, position, line_number):
     """
     Slicer is inconsistent about setting tool temperatures when
     beginning toolchanges (it may not insert an M104 if the temp is same
-    as that used by the previous tool.   This function creates gcode strings
-    to ensure that M104's are inserted so that the printer returns from any
-    toolchange temperatures that have been set.
+    as that used by the previous tool.   This function plans the tool's compiled
+    restore gcode to ensure that M104's are inserted so that the printer returns
+    from any toolchange temperatures that have been set.
     :param d: SetupData object
     :param position:  int: character position in a file
+    :param line_number: int: number of the line at position
     :return:none
     """
-    tool_number = get_tool_from_filepos(d, position)
+    tool_number = d.timeline.tool_at(position)
+    print_temp = d.tool_settings[tool_number]['print_temp']
+    lprint(Lazy("{} temperature {}    restored at pos: {}".format, tool_name(tool_number), print_temp, position),
+           False, loglevel=LOG_DEBUG)
+    d.insertion_plan.add_payload(line_number, TEMPERATURE_PRIORITY, tool_payload(d, tool_number, "restore"))
+    d.temper_lines.append(line_number)
+
+
+def temp_restore_gcode(d, tool_number):
+    """
+    Secondary function that builds the gcode returning a tool to its print temperature.
+    :param d: SetupData object
+    :param tool_number: int: tool number
+    :return: a string of gcode to be inserted in the output file
+    """
     print_temp = d.tool_settings[tool_number]['print_temp']
     if str(print_temp).upper() in ["ERROR", "OFF", "0", "NONE", "-1"]:
         lprint("FATAL ERROR:  Restore temperature out of range!", error=True)
-    lprint(str(tool_number) + " temperature " + str(print_temp) + "    restored at pos: " + str(position), False)
-    line_number = d.line_lookup[position]
     tempbeep = ["", ""]
     if str(d.tool_settings[tool_number]["beep_on_temp"]).upper() in ["ON", "1"]:
         tempbeep = TEMP_BEEP
@@ -519,27 +1941,16 @@ def generate_temp_restore(d, position):
     temper_change_gcode += tempbeep[1]
     temper_change_gcode += "M104 S" + str(print_temp)
     temper_change_gcode += " ;***SKINNYDIP Restoring temperature for  " + \
-                           str(tool_number) + ": " + str(print_temp) + "\n"
+                           tool_name(tool_number) + ": " + str(print_temp) + "\n"
     temper_change_gcode += "; +++++++++++++++++++++++++++++++++++++++++\n"
-
-    temper_details = {'toolchange_number': 0,
-                      'tool_pos': position,
-                      'tool_number': tool_number,
-                      'toolchange_temp': print_temp,
-                      'output_gcode': temper_change_gcode,
-                      'line_number': line_number
-                      }
-    # toolchange number to toolchange pos index
-    d.temper_positions.append(position)  # to speed up render process
-    d.temper_index[position] = temper_details
-    d.temper_lines.append(line_number)
+    return temper_change_gcode
 
 
 def generate_dip_gcode(d, toolnumber):
     """
     Secondary function to generate a "skinnydip" operation.
     :param d: SetupData object
-    :param toolnumber: [T0..T4]
+    :param toolnumber: int: tool number
     :return: a string of gcode to be inserted in the output file
     """
     if toolnumber not in d.configured_tools:
@@ -559,7 +1970,7 @@ def generate_dip_gcode(d, toolnumber):
         upbeep = UP_BEEP
     dip_gcode = ""
     dip_gcode += ";*****SKINNYDIP THREAD REDUCTION*****************\n"
-    dip_gcode += "; Tool(" + toolnumber + "), " + material_type + "/" \
+    dip_gcode += "; Tool(" + tool_name(toolnumber) + "), " + material_type + "/" \
                  + material_name + "\n" + downbeep
     if float(insertion_distance) > 0 and float(insertion_speed) > 0:
         dip_gcode += "G1 E" + str(insertion_distance) + " F" + \
@@ -594,9 +2005,9 @@ def generate_gcode_header(d):
     tct = []
     for tool in d.configured_tools:
         if str(d.tool_settings[tool]["beep_on_dip"]).upper() in ["ON", "1"]:
-            bod.append(tool)
+            bod.append(tool_name(tool))
         if str(d.tool_settings[tool]["beep_on_temp"]).upper() in ["ON", "1"]:
-            bot.append(tool)
+            bot.append(tool_name(tool))
         tct.append(d.tool_settings[tool]["toolchange_temp"])
         length = d.tool_settings[tool]["insertion_distance"]
         ins.append(length)
@@ -613,38 +2024,57 @@ def generate_gcode_header(d):
     header += "; Postprocessing completed on " + str(ts) + "\n"
     header += ";               File Processed:" + str(d.fileinfo.inputfile_realpath) + "\n"
     header += "; Note that editing the values below will have no effect on your\n"
-    header += "; Skinnydip settings.  To change parameters you must reslice.\n\n"
-    sorted_tools = sorted(d.configured_tools)
-    header += ";         Configured extruders: " + str(sorted_tools) + "\n"
+    header += "; Skinnydip settings.  To change parameters, reslice or run skinnydip\n"
+    header += "; again with --reprocess and --set SETTING=VALUE.\n\n"
+    header += ";         Configured extruders: " + str(tool_names(d.configured_tools)) + "\n"
     header += ";             Toolchange temps: " + str(tct) + "\n"
     header += ";          Insertion distances: " + str(ins) + "\n"
     header += ";      Auto insertion distance: " + str(d.auto_insertion_distance) + "\n"
-    header += ";       Total # of toolchanges: " + str(len(d.tc_dict.keys())) + "\n"
+    header += ";       Total # of toolchanges: " + str(d.timeline.total()) + "\n"
     header += ";                   Dips added: " + str(d.dips_inserted) + "\n"
     header += ";       Toolchange temps added: " + str(d.temp_drops_inserted) + "\n"
+    header += ";         Estimated time added: " + format_duration(d.added_seconds) + "\n"
+    header += ";   Progress updates corrected: " + str(d.progress_corrected) + "\n"
     header += ";   Tools beeping on skinnydip: " + str(bod) + "\n"
-    header += "; Tools beeping on temp change: " + str(bot) + "\n\n"
+    header += "; Tools beeping on temp change: " + str(bot) + "\n"
+    if len(d.overrides) > 0:
+        header += ";          Settings overridden: " + \
+                  ", ".join([(tool_name(tool) + "." if tool is not None else "") + setting + "=" + str(value)
+                             for tool, setting, value in d.overrides]) + "\n"
+    header += "\n"
     if len(d.notices) > 0:
         header += "; SOME PARAMETERS WERE OUT OF SAFE RANGES AND WERE CORRECTED!\n"
         for notice in d.notices:
             header += "; " + str(notice)
+    header += decode_gcode(HEADER_END)
 
     lprint(header, False)
     return header
 
 
-def generate_wait_for_temp(d, position):
+def generate_wait_for_temp(d, position, line_number):
     """
-    creates gcode string that inserts a M109 R command just prior to filament extraction on toolchange.
+    plans the gcode that inserts a M109 R command just prior to filament extraction on toolchange.
     This causes the printer to stop and wait for the specified toolchange temperature.  Cooler
     temperatures are associated with smaller and more uniform filament tips.
     :param d: SetupData object
     :param position: int: character position in input file
-    :return: None - stores gcode string
+    :param line_number: int: number of the line at position
+    :return: None - plans the tool's compiled wait gcode
+    """
+    tool_number = d.timeline.tool_at(position)
+    d.insertion_plan.add_payload(line_number, TEMPERATURE_PRIORITY, tool_payload(d, tool_number, "wait"))
+    d.temper_lines.append(line_number)
+
+
+def wait_for_temp_gcode(d, tool_number):
+    """
+    Secondary function that builds the M109 R block for generate_wait_for_temp.
+    :param d: SetupData object
+    :param tool_number: int: tool number
+    :return: a string of gcode to be inserted in the output file
     """
-    tool_number = get_tool_from_filepos(d, position)
     toolchange_temp = d.tool_settings[tool_number]['toolchange_temp']
-    line_number = d.line_lookup[position]
     tempbeep = ["", ""]
     if str(d.tool_settings[tool_number]["beep_on_temp"]).upper() in ["ON", "1"]:
         tempbeep = TEMP_BEEP
@@ -653,158 +2083,173 @@ def generate_wait_for_temp(d, position):
     temper_change_gcode += tempbeep[0]
     temper_change_gcode += "M109 R" + str(
         toolchange_temp) + " ;***SKINNYDIP Waiting for " + \
-                           tool_number + " toolchange temp: " + str(toolchange_temp) + "\n" + tempbeep[1]
+                           tool_name(tool_number) + " toolchange temp: " + str(toolchange_temp) + "\n" + tempbeep[1]
     temper_change_gcode += "; *****************************************\n"
-
-    temper_details = {'toolchange_number': 0,
-                      'tool_pos': position,
-                      'tool_number': tool_number,
-                      'toolchange_temp': toolchange_temp,
-                      'output_gcode': temper_change_gcode,
-                      'line_number': line_number
-                      }
-
-    # toolchange number to toolchange pos index
-    d.temper_positions.append(position)  # to speed up render process
-    d.temper_index[position] = temper_details
-    d.temper_lines.append(line_number)
+    return temper_change_gcode
 
 
-def prepare_insertions(d):
+def temp_change_gcode(d, tool_number):
     """
-    Creates a list with length equal to the number of lines in the input file and populates
-    the list with lines of text which will be inserted at that line in the file.
-    The main purpose of this step is to speed up the output of the final file
+    Secondary function that builds the M104 which starts cooling toward the toolchange
+    temperature as the printer heads for the wipe tower.
     :param d: SetupData object
-    :return: None
+    :param tool_number: int: tool number
+    :return: a string of gcode to be inserted in the output file
     """
+    toolchange_temp = d.tool_settings[tool_number]['toolchange_temp']
+    tempbeep = ["", ""]
+    if str(d.tool_settings[tool_number]["beep_on_temp"]).upper() in ["ON", "1"]:
+        tempbeep = TEMP_BEEP
+    temper_change_gcode = ""
+    temper_change_gcode += tempbeep[0]
+    temper_change_gcode += "M104 S" + str(toolchange_temp) + \
+                           " ;***SKINNYDIP initiating " + tool_name(
+        tool_number) + " toolchange temperature.  Target: " + str(toolchange_temp) + "***\n"
+    return temper_change_gcode
 
 
-    # merge and sort temperature and dip lists
-    d.dips_inserted = len(d.dip_lines)
-    d.temp_drops_inserted = len(d.temper_lines)
-    if d.temp_drops_inserted == 0:
-        all_insertion_lines = d.dip_lines
-        blended_dict = d.dip_index
-    elif d.dips_inserted == 0:
-        all_insertion_lines = d.temper_lines
-        blended_dict = d.temper_index
-    elif d.dips_inserted == 0 and d.temp_drops_inserted == 0:
-        lprint ("ERROR: No insertions to process!", error=True)
-    else:
-        all_insertion_lines = sorted(list(set(d.temper_lines + d.dip_lines)))
-        # combine the dictionaries of insertion points
-        blended_dict = merge_two_dicts(d.temper_index, d.dip_index)
-
-    # shift location of output down by one line to ensure it maps to the right line of output code
-    d.final_insertion_list.append(None)  # important!
-
-
-
-    for line_number in range(0, d.linecount):
-        try:
-            #skipping check for key in source dict to improve performance.
-            charpos = d.linebreak_list[line_number]
-            output_gcode = blended_dict[charpos]["output_gcode"]
-            d.final_insertion_list.append(output_gcode.strip())
-        except:
-            d.final_insertion_list.append(None)
+# INSERTION TEMPLATES ********************************************************
+# The gcode of each kind of insertion: (kind, setting holding a user template, function
+# building the default gcode for a tool)
+TEMPLATES = [
+    ("dip", "dip_template", generate_dip_gcode),
+    ("wait", "wait_template", wait_for_temp_gcode),
+    ("restore", "restore_template", temp_restore_gcode),
+    ("temp_change", "temp_change_template", temp_change_gcode),
+]
+TEMPERATURE_TEMPLATES = ["wait", "restore", "temp_change"]  # only used with a toolchange temp
 
 
-def assemble_final_output(d):
+def fill_template(template, values):
     """
-    Inserts all of the pre-sorted and indexed positions into the original file
-    Final compilation of the lines of text for the output file.
-    :param d: SetupData
-    :return: none
+    Replaces each {name} in template with str(values[name]).  Nothing else in braces is
+    interpreted, since templates come from the gcode file.
+    :param template: string
+    :param values: dict of field name to value
+    :return: string
+    :raises KeyError: for a field that isn't in values
+    :raises ValueError: for a brace that isn't part of a field
     """
-    gcode_header = generate_gcode_header(d).splitlines()
-    for line in gcode_header:
-        d.output_lines.append(line + "\n")
-
-    for linenum in xrange(d.linecount):
-        orgline = d.gcode_lines[linenum]
-        insline = d.final_insertion_list[linenum]
+    def field(match):
+        return str(values[match.group(1)])
 
-        if insline is not None:
-            for subline in insline.splitlines():
-                d.output_lines.append(subline + "\n")
-        d.output_lines.append(orgline)
-    #lprint(d.output_lines, False)
+    rest = re.sub(TEMPLATE_FIELD_REGEX, "", template)
+    if "{" in rest or "}" in rest:
+        raise ValueError("a brace outside a {setting}")
+    return re.sub(TEMPLATE_FIELD_REGEX, field, template)
+
+
+def render_template(d, tool, kind):
+    """
+    Builds the gcode of one kind of insertion for a tool.  A template given in the tool's
+    configuration block, or with --set, is filled in with the tool's settings: {tool} for
+    its name and eg. {insertion_distance}, with \\n between lines.  A template that can't be
+    filled in is noted in the header and the default gcode is used instead.
+    :param d: SetupData object
+    :param tool: int: tool number
+    :param kind: string: kind of insertion listed in TEMPLATES
+    :return: string of gcode
+    """
+    for name, setting, build in TEMPLATES:
+        if name == kind:
+            break
+    template = d.tool_settings[tool][setting]
+    if template is None:
+        return build(d, tool)
+    values = merge_two_dicts(d.tool_settings[tool], {"tool": tool_name(tool)})
+    try:
+        return fill_template(str(template).replace("\\n", "\n"), values)
+    except (KeyError, ValueError) as e:
+        note = tool_name(tool) + "-" + setting + ": can't fill in " + str(e) + ", used the default"
+        d.notices.append(note + "\n")
+        lprint(note, loglevel=LOG_WARNING)
+        return build(d, tool)
+
+
+def compile_templates(d):
+    """
+    Renders the insertions of each configured tool once, so that planning an insertion
+    is a lookup and every insertion of the same gcode shares one payload.  The temperature
+    insertions are only compiled for tools with a toolchange temperature.
+    :param d: SetupData object
+    :return: None
+    """
+    d.tool_payloads = [None] * d.tool_count
+    for tool in d.configured_tools:
+        temperature = str(d.tool_settings[tool]["toolchange_temp"]).upper() not in ["OFF", "0", "-1"]
+        d.tool_payloads[tool] = dict((kind, compile_payload(render_template(d, tool, kind)))
+                                     for kind, setting, build in TEMPLATES
+                                     if temperature or kind not in TEMPERATURE_TEMPLATES)
+    lprint("  Compiled insertions for " + str(tool_names(d.configured_tools)), False)
+
+
+def tool_payload(d, tool, kind):
+    """
+    :param d: SetupData object
+    :param tool: int: tool number
+    :param kind: string: kind of insertion listed in TEMPLATES
+    :return: bytes of the gcode compiled for the tool, or rendered now if it wasn't
+    """
+    if tool in d.configured_tools and kind in d.tool_payloads[tool]:
+        return d.tool_payloads[tool][kind]
+    return compile_payload(render_template(d, tool, kind))
+
+
+def prepare_insertions(d):
+    """
+    Sorts the insertion plan once all of the insertions have been generated, so that the
+    output can be built with a single merge-walk through the input file.
+    Cost depends on the number of insertions, not on the length of the file.
+    :param d: SetupData object
+    :return: None
+    """
+    d.dips_inserted = len(d.dip_lines)
+    d.temp_drops_inserted = len(d.temper_lines)
+    d.insertion_plan.sort()
+    lprint("  Insertion plan has " + str(len(d.insertion_plan)) + " elements")
+    lprint(Lazy(pprint.pformat, d.insertion_plan.lines()), False, loglevel=LOG_DEBUG)
+
+
+def assemble_final_output(d):
+    """
+    Inserts all of the pre-sorted and indexed positions into the original file
+    Final compilation of the segments of the output file.  Nothing is copied here; the
+    unchanged parts of the input are referred to by position.
+    :param d: SetupData
+    :return: none
+    """
+    gcode_header = generate_gcode_header(d).splitlines()
+    header = encode_gcode("".join([line + "\n" for line in gcode_header]))
+    d.output_segments = splice_segments(header, d.insertion_plan, d.line_positions.__getitem__,
+                                        len(d.gcode_str))
 
 
 # ANALYSIS FUNCTIONS *********************************************************
-def index_linebreaks(d):
+def scan_input(d):
     """
-    stores a list of all the newline characters in the input.  This became necessary
-    since the input side of the program was done using character-level indexing, but
-    this proved to be much too slow on the output side.
-    :param d:
-    :return:
+    Runs the line scanner over the mapped input.  This single pass stands in for indexing
+    the linebreaks and toolchanges, and for the searches of the stages after it.
+    :param d: SetupData object
+    :return: None
     """
-    d.linebreak_list = []
-    d.line_lookup = {}
-    linebreaks = re.finditer(LINEBREAKS_REGEX, d.gcode_str, re.MULTILINE)
-    d.linecount = 0
-    for linebreakNum, linebreak in enumerate(linebreaks, start=0):
-        pos = linebreak.start("linebreak")
-        d.linebreak_list.append(pos + 1)  # we want to target the beginnings of lines
-        d.line_lookup[pos + 1] = linebreakNum
-        d.linecount += 1
-    print "  lines in file: " + str(d.linecount)
+    d.timeline = ToolTimeline(len(d.gcode_str))
+    scan_gcode(d, mapped_lines(d.gcode_str))
+    if hasattr(d.gcode_str, "seek"):
+        d.gcode_str.seek(0)  # searches of a mapping without a start position begin at its position
+    check_config_found(d)
 
 
-def index_toolchanges(d):
-    '''
-    Indexes locations of tool changes in the gcode, and creates a dictionary
-    that allows us to know what tool is currently active (the tool activated
-    by the previous toolchange).
-
-    d.tc_dict = {}  #indexes toolchanges with their predecessor tools by file position
-                    eg: {30003:{"new_tool":'T1', "previous_tool" T2}, etc}
-    d.tc_list = []  #lists file positions of toolchanges eg [1993,33335,33339]
-    d.toolnumber_sequence = [] #the sequence of tools used in the gcode file eg ['T0','T1','T3']
-    '''
-    d.tc_dict = {}
-    d.tc_list = []
-    d.toolnumber_sequence = []
-    prev_tool = None
-    lprint("Scanning for toolchanges for retrieval of previous tool value by toolchange at position.", False)
-    matches = re.finditer(TOOLCHANGE_REGEX, d.gcode_str, re.MULTILINE)
-    if matches is not None:
-        for matchNum, match in enumerate(matches, start=0):
-            if match is not (None):
-                new_tool_pos = (match.start('tool'))  # add 1 because of initial newline
-                line_number = d.line_lookup[new_tool_pos]
-                new_tool = str(match.group('tool')).strip()
-                d.tc_dict[new_tool_pos] = {'new_tool': new_tool,
-                                           'previous_tool': prev_tool,
-                                           'line_number': line_number}
-                prev_tool = new_tool
-                d.tc_list.append(new_tool_pos)
-                d.tc_lines.append(line_number)
-                d.toolnumber_sequence.append(new_tool)
-            else:
-                lprint("No toolchanges found!")
-    # final tool removal doesn't match the regular pattern.
-    # There is also no toolchange lookup possible because there
-    # is no actual toolchange here.  So we have to fake one.
-    final = re.search(FINAL_TOOLCHANGE_REGEX, d.gcode_str)
-    if final is not None:
-        finalpos = int(final.start())
-        # sanity check, line should contain M220 R
-        if str(final.groups("final")[0]) != "M2":  # group
-            lprint("Error with final toolchange.  Unexpected value" + \
-                   str(final.groups("final")))
-        else:
-            d.tc_dict[finalpos] = {"new_tool": "end",
-                                   "previous_tool": prev_tool}
-    tc_length = len(d.tc_dict.keys())
-    ts_length = len(d.toolnumber_sequence)
-    lprint("  Toolchange index has " + str(tc_length) + " elements")
-    lprint(pprint.pformat(d.tc_dict), False)
-    lprint("Tool sequence has " + str(ts_length) + " elements:" + \
-           pprint.pformat(d.toolnumber_sequence), False)
+def check_config_found(d):
+    """
+    Stops with an explanation if the scan found no configuration block.
+    :param d: SetupData object
+    :return: None
+    """
+    if not d.config_blocks:
+        custom_message = "No skinnydip configuration data in target file.\n"
+        custom_message += "Configuration must be set up in start gcode for filaments that will be used.\n"
+        custom_message += "Please visit http://github.com/domesticatedviking/skinnydip to read the docs.\n"
+        lprint(custom_message, error=True)
 
 
 def clean_settings(d):
@@ -814,11 +2259,11 @@ def clean_settings(d):
     :param d: SetupData
     :return: None
     """
-    dirty = d.utool_settings.copy()  # save a copy to clean in place
+    dirty = list(d.utool_settings)  # save a copy to clean in place
 
     for tool in d.configured_tools:
 
-        lprint("  Verifying safe settings for tool: " + str(tool), False)
+        lprint("  Verifying safe settings for tool: " + tool_name(tool), False)
 
         for setting in SAFE_RANGE.keys():
             low = SAFE_RANGE[setting][0]
@@ -836,18 +2281,18 @@ def clean_settings(d):
             if type(v) in [int, float]:
                 if float(v) < float(low):
                     note = "  Minimum setting " + setting + " for " + \
-                           tool + " enforced: " + str(low)
+                           tool_name(tool) + " enforced: " + str(low)
                     d.notices.append(note + "\n")
-                    lprint(note)
+                    lprint(note, loglevel=LOG_WARNING)
                     dirty[tool][setting] = low
                 elif float(v) > float(high):
                     note = "  Maximum setting " + setting + " for " + \
-                           tool + " enforced: " + str(high)
+                           tool_name(tool) + " enforced: " + str(high)
                     d.notices.append(note + "\n")
                     dirty[tool][setting] = high
             elif v == None:
                 dirty[tool][setting] = default_if_none
-                note = str(tool) + "-" + str(setting) + \
+                note = tool_name(tool) + "-" + str(setting) + \
                        ": used default value of " + \
                        str(default_if_none)
                 d.notices.append(note + "\n")
@@ -872,107 +2317,120 @@ def auto_calculate_insertion_distance(d):
 # SEARCH FUNCTIONS ***********************************************************
 def get_settings(d):
     """
-    extract settings from comments in filament start gcode and populate
-    d.utool_settings (unverified settings from user)
+    extract settings from the SKINNYDIP CONFIGURATION blocks in filament start gcode and
+    populate d.utool_settings (unverified settings from user).  Each block belongs to the
+    tool that is loaded where it appears, as recorded by the toolchange index.
+    The blocks were found by the scan of the engine.
     :param d: SetupData object
-    :return: a string of gcode to be inserted in the output file
+    :return: None
+    """
+    config_settings = {}
+    cursor = TimelineCursor(d.timeline)
+    for position, line_number, params in d.config_blocks:
+        toolname = cursor.tool_at(position)
+        if toolname is None:
+            lprint("Configuration block at line " + str(line_number) +
+                   " comes before any toolchange.  Ignored.", loglevel=LOG_WARNING)
+            continue
+        config_settings[toolname] = params
+        if toolname not in d.configured_tools:
+            d.configured_tools.append(toolname)
+            d.configured_tools = sorted(d.configured_tools)
+            lprint("Configured tools is now" + str(tool_names(d.configured_tools)), False)
+    lprint("  finished scanning configuration strings.", False)
+    apply_config_settings(d, config_settings)
+
 
+def apply_config_settings(d, config_settings):
     """
-    d.utool_settings = {}  # dict to store configuration for each tool
-    config_strings = {}
+    Populates d.utool_settings (unverified settings from user) from the configuration
+    blocks found for each of d.configured_tools.
+    :param d: SetupData object
+    :param config_settings: dict of tool number to the parameters parsed from its configuration block
+    :return: None
+    """
+    # look up print temperatures to add to settings dict.  The printer has a tool for
+    # each of them, and at least as many as the toolchanges load.
+    lprint("Scanning for main print temperature configuration...", False)
+    print_temps = get_temperature_config(d)
+    lprint("Print temps are: " + str(print_temps), False)
+    d.tool_count = max(len(print_temps), d.timeline.tool_count())
+    lprint("  Tools in file: " + str(d.tool_count))
 
     # Initialize tool settings to null settings
-    for i in TOOL_LIST:
-        d.utool_settings[i] = NULL_SETTINGS_DICT
-    try:
-        firstmatch = re.search(FIRST_TOOL_SETTINGS_REGEX,
-                               d.gcode_str, re.MULTILINE)
-        if firstmatch != None:
-            first_tool = firstmatch.group('first_tool')
-            config_strings[first_tool] = str(firstmatch.group('config_string'))
-            d.configured_tools.append(str(first_tool).strip())
-    except Exception, e:
-        print "Firstmatch failed." + str(e)
-
-    # search for text chunks containing both a tool number and an associated
-    # configuration string.
-    chunks = re.finditer(SETTINGS_REGEX,
-                         d.gcode_str, re.MULTILINE)
-    # create dict that links the tool number to its settings profile
-    if chunks is not None:
-        for chunkNum, chunk in enumerate(chunks, start=0):
-            if chunk is not None:
-                toolname = str(chunk.group('previous_tool')).strip()
-                config_string = chunk.group('parameters')
-                config_strings[toolname] = config_string
-                if toolname not in d.configured_tools:
-                    d.configured_tools.append(toolname)
-                    sortlist = sorted(d.configured_tools)
-                    d.configured_tools = sortlist
-                    lprint("Configured tools is now" + str(d.configured_tools), False)
-    lprint("  finished scanning configuration strings.", False)
-    lprint("  Configured extruders: " + str(d.configured_tools))
-    lprint("  Extracting settings dictionaries from config strings", False)
+    d.utool_settings = [NULL_SETTINGS_DICT] * d.tool_count
+    lprint("  Configured extruders: " + str(tool_names(d.configured_tools)))
+    lprint("  Extracting settings dictionaries from config blocks", False)
     for tool in d.configured_tools:
-        tool_param_dict = {}
-        tool_param_dict = extract_params(tool, config_strings[tool])
-        d.utool_settings[tool] = merge_two_dicts(d.utool_settings[tool], tool_param_dict)
-
-    # look up print temperatures to add to settings dict
-    lprint("Scanning for main print temperature configuration...", False)
-    print_temps_dict = get_temperature_config(d)
-    lprint("Print temps are: " + str(print_temps_dict), False)
+        d.utool_settings[tool] = merge_two_dicts(d.utool_settings[tool], config_settings[tool])
 
     for j in d.configured_tools:
-        d.utool_settings[j]["print_temp"] = print_temps_dict[j]
+        if j < len(print_temps):
+            d.utool_settings[j]["print_temp"] = print_temps[j]
+        else:
+            lprint("  " + tool_name(j) + " has no print temperature in the slicer settings",
+                   loglevel=LOG_WARNING)
+            d.utool_settings[j]["print_temp"] = None
+    apply_setting_overrides(d)
+
+    lprint(Lazy("Settings before validation:\n{}\n".format, Lazy(pprint.pformat, d.utool_settings, 4)), False,
+           loglevel=LOG_DEBUG)
+
 
-    lprint("Settings before validation:\n" + str(pprint.pformat(d.utool_settings, indent=4) + "\n"), False)
+def apply_setting_overrides(d):
+    """
+    Replaces settings of the configuration blocks with the values given by --set, ahead of
+    validation.  Only tools with a configuration block can be overridden.
+    :param d: SetupData object
+    :return: None
+    """
+    for tool, setting, value in d.overrides:
+        tools = d.configured_tools if tool is None else [tool]
+        for toolname in tools:
+            if toolname not in d.configured_tools:
+                lprint("  " + tool_name(toolname) + " has no configuration block.  Ignored " + setting + "=" +
+                       str(value), loglevel=LOG_WARNING)
+                continue
+            lprint("  Overriding " + setting + " for " + tool_name(toolname) + ": " + str(value))
+            d.utool_settings[toolname][setting] = value
 
 
 def get_temperature_config(d):
     '''
-    Scan gcode file for line that lists the temperature settings
-    for every extruder.  The regex should return each temperature value
-    as its own capture group.
-    returns:  a dict of {"TO : [200,200,200,200,200], T1 ..}
+    Looks up the slicer setting that lists the print temperature of every extruder.
+    The list is as long as the number of tools.
+    returns:  a list of the print temperature of each tool, by tool number eg. [200,215,200]
     '''
-    temperaturedict = {}
-    temps = re.search(TEMPERATURE_REGEX, d.gcode_str)
-    i = 0
-    if temps is not None:
-        for tool in TOOL_LIST:
-            # print "tool "+str(tool)
-            temperaturedict[tool] = int(temps.groups()[i])
-            i += 1
-        lprint("temperature config result:" + str(temperaturedict), False)
+    temperatures = d.slicer_settings.get(SLICER_TEMPERATURES)
+    if isinstance(temperatures, int):
+        temperatures = [temperatures]
+    if isinstance(temperatures, list) and all(isinstance(value, int) for value in temperatures):
+        lprint("temperature config result:" + str(temperatures), False)
     else:
+        temperatures = []
         lprint("No temperature configuration data in file.  Was it sliced with a  MMU profile?", error=True)
 
-    return temperaturedict
+    return temperatures
 
 
 def get_insertion_points(d):
     '''
      finds positions where insertions in the input file need to be
-     made and indexes them.
-     dip_index is dict of char locations in the file and the
-     contents of those locations for further processing
-     dip_positions is an ascending list of those locations used when
-     building the output file. (faster than searching for
-     existence of keys)
+     made and adds them to d.insertion_plan.  The unloads were found by the scan of
+     the engine.
+     dip_lines lists the line numbers of the dips in the order they were found.
     '''
-
-
-    matches = re.finditer(INSERTIONS_REGEX, d.gcode_str, re.MULTILINE)
-    for matchNum, match in enumerate(matches, start=1):
-        dip_pos = match.start("dip_pos")
-        line_number = d.line_lookup[dip_pos]
-        new_tool = match.group("new_tool")
-        new_tool_pos = match.start("new_tool")
-        previous_tool = d.tc_dict[new_tool_pos]["previous_tool"]
-        temp_pause_pos = match.start("temp_pause")
-        filament_temp = match.group("filament_temp")
-        toolchange_temp = d.tool_settings[previous_tool]["toolchange_temp"]
+    for unload in d.unloads:
+        line_number = unload["dip_line"]
+        toolchange = d.timeline.toolchange_on_line(unload["new_tool_line"])
+        if toolchange is None:
+            lprint("Unexpected tool " + unload["new_tool"] + " at line " +
+                   str(unload["new_tool_line"]) + ".  Skipped.", loglevel=LOG_WARNING)
+            continue
+        previous_tool = d.timeline.previous_tool(toolchange)
+        temp_pause_pos = unload["temp_pause_pos"]
+        filament_temp = unload["filament_temp"]
+        toolchange_temp = d.settings_of(previous_tool)["toolchange_temp"]
 
         apply_temp_change = True
         if previous_tool not in d.configured_tools or \
@@ -980,32 +2438,17 @@ def get_insertion_points(d):
             apply_temp_change = False
         if apply_temp_change:
             if temp_pause_pos is not None:
-                generate_wait_for_temp(d, temp_pause_pos)
+                generate_wait_for_temp(d, temp_pause_pos, unload["temp_pause_line"])
         if filament_temp is None and apply_temp_change:
-            temp_restore_pos = match.start("temp_restore")
-            if temp_restore_pos is not None:
-                generate_temp_restore(d, temp_restore_pos)
+            generate_temp_restore(d, unload["temp_restore_pos"], unload["temp_restore_line"])
         try:
-
-            bundle = {"previous_tool": previous_tool,
-                      "new_tool": new_tool,
-                      "new_tool_pos": new_tool_pos,
-                      "line_number": line_number,
-                      "output_gcode": generate_dip_gcode(d, previous_tool)
-                      }
-            d.dip_index[dip_pos] = bundle
-            d.dip_positions.append(dip_pos)  # to speed up render process
+            d.insertion_plan.add_payload(line_number, DIP_PRIORITY, tool_payload(d, previous_tool, "dip"))
             d.dip_lines.append(line_number)
-        except Exception, e:
+        except Exception as e:
             lprint(str(e), error=True)
 
-
-    #lprint("dip postitions:\n" + str(d.dip_positions), False)
-    spos = d.dip_positions
-    sposlen = len(d.dip_positions)
-    diplen = len(d.dip_index.keys())
-    lprint("  dip index has " + str(diplen) + " elements")
-    lprint("\n" + pprint.pformat(sorted(d.dip_index)) + "\n", False)
+    lprint("  dip index has " + str(len(d.dip_lines)) + " elements")
+    lprint(Lazy(pprint.pformat, d.dip_lines), False, loglevel=LOG_DEBUG)
     return 0
 
 
@@ -1013,40 +2456,76 @@ def get_temperature_change_positions(d):
     """
     In order to arrive at the set temperature a tiny bit sooner, a toolchange temperature
     is triggered just as the printer begins to move to the wipe tower.  This function
-    locates these changes and generates a string of gcode for insertion which it stores
-    in the SetupData object
+    plans the tool's compiled temperature change gcode at the changes that the scan of
+    the engine located
     """
-    # scan for temperature change patterns
-    matches = re.finditer(START_TEMPCHANGE_REGEX, d.gcode_str)
-    for matchNum, match in enumerate(matches, start=1):
-        if match is not None:
-            changepos = int(match.start('temp_start'))
-            line_number = d.line_lookup[changepos]
-            tool_number = get_tool_from_filepos(d, changepos)
-            toolchange_temp = d.tool_settings[tool_number]['toolchange_temp']
-            if str(toolchange_temp).upper() not in ["OFF", "0", "-1"] and tool_number in d.configured_tools:
-                tempbeep = ["", ""]
-                if str(d.tool_settings[tool_number]["beep_on_temp"]).upper() in ["ON", "1"]:
-                    tempbeep = TEMP_BEEP
-                temper_change_gcode = ""
-                temper_change_gcode += tempbeep[0]
-                temper_change_gcode += "M104 S" + str(toolchange_temp) + \
-                                       " ;***SKINNYDIP initiating " + str(
-                    tool_number) + " toolchange temperature.  Target: " + str(toolchange_temp) + "***\n"
-                temper_details = {'toolchange_number': 0,
-                                  'tool_pos': changepos,
-                                  'tool_number': tool_number,
-                                  'toolchange_temp': toolchange_temp,
-                                  'output_gcode': temper_change_gcode,
-                                  'line_number': line_number,
-                                  }
-                d.temper_positions.append(changepos)  # to speed up render process
-                d.temper_positions = sorted(d.temper_positions)  # required or some will be lost.
-                d.temper_index[changepos] = temper_details
-                d.temper_lines.append(line_number)
-    temperlen = str(len(d.temper_index.keys()))
+    cursor = TimelineCursor(d.timeline)
+    for changepos, line_number in d.temp_changes:
+        tool_number = cursor.tool_at(changepos)
+        if tool_number not in d.configured_tools:
+            continue
+        toolchange_temp = d.tool_settings[tool_number]['toolchange_temp']
+        if str(toolchange_temp).upper() not in ["OFF", "0", "-1"]:
+            d.insertion_plan.add_payload(line_number, TEMPERATURE_PRIORITY,
+                                         tool_payload(d, tool_number, "temp_change"))
+            d.temper_lines.append(line_number)
+    temperlen = str(len(d.temper_lines))
     lprint("  Temperature drop index has " + temperlen + " elements")
-    lprint("\n" + pprint.pformat(d.temper_index.keys()) + "\n", False)
+    lprint(Lazy(pprint.pformat, d.temper_lines), False, loglevel=LOG_DEBUG)
+
+
+def plan_progress_updates(d):
+    """
+    Estimates the print time that the planned insertions add, and plans a corrected
+    copy of each of the slicer's M73 progress lines in its place, so that the printer
+    shows the remaining time of the print as processed.  The lines were found by the
+    scan of the engine.
+    :param d: SetupData object
+    :return: None
+    """
+    costs = []
+    estimates = {}  # seconds of each payload at each starting temperature
+    for line_number, priority, sequence, gcode in d.insertion_plan:
+        if priority == REPLACE_PRIORITY:
+            continue
+        tool = d.timeline.tool_at_line(line_number)
+        settings = d.settings_of(tool)
+        temperature = settings["print_temp"]
+        if not isinstance(temperature, (int, float)):
+            temperature = None
+        rates = (settings["hotend_cooling_rate"], settings["hotend_heating_rate"])
+        if (gcode, temperature, rates) not in estimates:
+            estimates[gcode, temperature, rates] = estimate_seconds(gcode, temperature, *rates)
+        costs.append((line_number, estimates[gcode, temperature, rates]))
+    d.added_seconds = sum([seconds for line_number, seconds in costs])
+    lprint("  Estimated time added by insertions: " + format_duration(d.added_seconds))
+
+    total_minutes = {}  # slicer's estimate of the whole print, for each mode
+    added = 0.0  # seconds added ahead of the current line
+    cost = 0
+    for line_number, line in d.progress_lines:
+        match = d.regex.match(PROGRESS_REGEX, line)
+        progress, timer = decode_gcode(match.group("progress")), decode_gcode(match.group("timer"))
+        percent, remaining = int(match.group("percent")), int(match.group("remaining"))
+        while cost < len(costs) and costs[cost][0] <= line_number:
+            added += costs[cost][1]
+            cost += 1
+        if progress not in total_minutes:
+            total_minutes[progress] = remaining * 100.0 / (100 - percent) if percent < 100 else remaining
+        total = total_minutes[progress] + d.added_seconds / 60
+        elapsed = total_minutes[progress] * percent / 100 + added / 60
+        new_remaining = remaining + int((d.added_seconds - added) / 60 + 0.5)
+        new_percent = percent
+        if total > 0:
+            new_percent = max(0, min(100, int(100 * elapsed / total + 0.5)))
+        if (new_percent, new_remaining) == (percent, remaining):
+            continue
+        d.insertion_plan.add(line_number, REPLACE_PRIORITY,
+                             "M73 " + progress + str(new_percent) + " " + timer + str(new_remaining) +
+                             decode_gcode(match.group("rest")))
+        d.progress_corrected += 1
+    lprint("  Corrected " + str(d.progress_corrected) + " of " + str(len(d.progress_lines)) +
+           " progress updates")
 
 
 def get_extruder_settings(d):
@@ -1057,60 +2536,2386 @@ def get_extruder_settings(d):
     :return:
     """
     for var in VARS_FROM_SLIC3R_GCODE:
-        pattern = regex_from_gcode_varname(var)
-        result = re.search(pattern, d.gcode_str)
-        if result is not None:
-            value = str(result.group(var))
+        value = d.slicer_settings.get(var)
+        if isinstance(value, (int, float)):
             d.gcode_vars[var] = value
             lprint("from gcode: " + str(var) + " = " + str(value))
         else:
-            lprint("WARNING: " + str(var) + " not found in gcode file.")
+            lprint("WARNING: " + str(var) + " not found in gcode file.", loglevel=LOG_WARNING)
     return
 
 
+def get_slicer_settings(d):
+    """
+    Reads the slicer's settings into d.slicer_settings from the end of the input.  Compressed
+    input can only be read forwards, so its settings come from the comments at its end
+    that the scan kept, and binary gcode adds those of its slicer metadata block.
+    :param d: SetupData object
+    :return: None
+    """
+    if d.fileinfo.f is not None:
+        d.slicer_settings = read_slicer_settings(d.fileinfo.f)
+    else:
+        d.slicer_settings = parse_slicer_settings(d.trailing_comments)
+    if isinstance(d.fileinfo.reader, BinaryGcodeReader):
+        d.slicer_settings.update(d.fileinfo.reader.slicer_settings())
+    lprint("  Slicer settings found: " + str(len(d.slicer_settings)), False)
+
+
+# LINE SCANNER ***************************************************************
+class LineScanner():
+    """
+    Single forward pass over the lines of a gcode file, which hands each line to the
+    handlers registered for the token that the line begins with.  The whole-file and
+    streaming engines find everything they need in this one pass; a new rule adds a
+    handler rather than another search of the file.
+    Handlers are functions of (d, scanner, line).  The scanner holds the last
+    SCAN_WINDOW_LINES lines as (line number, char position, line) in window, for the
+    patterns that span several lines; the current line is the last of them.  A handler
+    that needs the lines after its own has the rest of its work called later, see after.
+    """
+
+    def __init__(self, d, handlers):
+        """
+        :param d: SetupData object that the handlers record what they find in
+        :param handlers: list of (token, handler).  A handler sees the lines that start with its token.
+        """
+        self.d = d
+        self.dispatch = {}  # first char of the tokens: list of (token, handler)
+        for token, handler in handlers:
+            if d.handler_counter is not None:
+                handler = d.handler_counter.timed(handler)
+            self.dispatch.setdefault(token[:1], []).append((token, handler))
+        self.window = deque(maxlen=SCAN_WINDOW_LINES)
+        self.pending = []  # heap of (line number, sequence, function, args), see after
+        self.scheduled = 0  # sequence number of the next function given to after
+        self.next_due = float("inf")  # line number of the first pending function
+        self.floor = 0  # lines before this one were consumed by an unload
+        self.temp_change_end = 0  # char position of the end of the last START_TEMPCHANGE_REGEX match
+        self.comments = []  # the comment lines since the last line of gcode
+        self.comments_next = 0  # line number that continues them
+
+    def after(self, line_number, function, *args):
+        """
+        Calls function(d, scanner, *args) once the line line_number has been read, or at
+        the end of the input if it is shorter.  The window still holds the SCAN_WINDOW_LINES
+        lines up to that line.  Functions due on the same line are called in the order given.
+        :param line_number: int
+        :param function: function of (d, scanner, *args)
+        :return: None
+        """
+        if self.d.handler_counter is not None:
+            function = self.d.handler_counter.timed(function)
+        heapq.heappush(self.pending, (line_number, self.scheduled, function, args))
+        self.scheduled += 1
+        self.next_due = self.pending[0][0]
+
+    def run_due(self, line_number):
+        """
+        Calls the pending functions due by line_number
+        """
+        while self.pending and self.pending[0][0] <= line_number:
+            due, sequence, function, args = heapq.heappop(self.pending)
+            function(self.d, self, *args)
+        self.next_due = self.pending[0][0] if self.pending else float("inf")
+
+    def scan(self, source):
+        """
+        :param source: iterable of lines
+        :return: int: length of the input
+        """
+        d = self.d
+        get_handlers = self.dispatch.get
+        append = self.window.append
+        pos = 0
+        for line_number, line in enumerate(source):
+            append((line_number, pos, line))
+            if line_number >= self.next_due:
+                self.run_due(line_number)
+            handlers = get_handlers(line[:1])
+            if handlers is not None:
+                for token, handler in handlers:
+                    if line.startswith(token):
+                        handler(d, self, line)
+            pos += len(line)
+        self.run_due(float("inf"))
+        return pos
+
+
+def recent_lines(scanner, count):
+    """
+    :param scanner: LineScanner
+    :param count: int: number of lines wanted
+    :return: list of the last count (line number, char position, line) of the window
+    """
+    window = scanner.window
+    return [window[n] for n in range(-min(count, len(window)), 0)]
+
+
+def scan_processed_marker(d, scanner, line):
+    """
+    Refuses a file that starts with the marker of a previous run.
+    """
+    if scanner.window[-1][0] == 0:
+        raise CustomError("File was previously processed by this " + \
+                          "script.  Use --reprocess to process it again.  Terminating.")
+
+
+def scan_toolchange(d, scanner, line):
+    """
+    Records a T? line in the toolchange index, and looks for the unload before it once
+    the lines after it that INSERTIONS_REGEX could span have been read.
+    """
+    match = d.regex.match(TOOLCHANGE_REGEX, line)
+    if match is None:
+        return
+    toolchange_line, pos, line = scanner.window[-1]
+    d.timeline.append(pos, toolchange_line, tool_number(match.group('tool')))
+    scanner.after(toolchange_line + UNLOAD_WINDOW_LINES + 1, scan_unload, toolchange_line)
+
+
+def scan_unload(d, scanner, toolchange_line):
+    """
+    The part of match_unloads for one toolchange, run over the window.  Records the
+    insertion points of the unload in d.unloads, and their positions in d.line_positions.
+    :param d: SetupData object
+    :param scanner: LineScanner whose window holds the lines around the toolchange
+    :param toolchange_line: int: line number of the T? line
+    :return: None
+    """
+    base = max(scanner.floor, toolchange_line - UNLOAD_WINDOW_LINES)
+    end = toolchange_line + UNLOAD_WINDOW_LINES + 2
+    # only complete lines, as match_unloads reads them
+    recent = [entry for entry in scanner.window if base <= entry[0] < end and entry[2][-1:] == b"\n"]
+    lines = [text for line_number, pos, text in recent]
+    match = find_unload(lines, toolchange_line - base, 0)
+    if match is None:
+        scanner.floor = max(scanner.floor, toolchange_line)
+        return
+    scanner.floor = base + match["end"]
+    for key in ["temp_pause", "temp_restore", "dip_pos"]:
+        line_number, pos, text = recent[match[key]]
+        d.line_positions[line_number] = pos
+    d.unloads.append({"temp_pause_line": base + match["temp_pause"],
+                      "temp_pause_pos": recent[match["temp_pause"]][1] +
+                                        lines[match["temp_pause"]].find(b"G1 E-"),
+                      "temp_restore_line": base + match["temp_restore"],
+                      "temp_restore_pos": recent[match["temp_restore"]][1],
+                      "dip_line": base + match["dip_pos"],
+                      "new_tool_line": base + match["new_tool"],
+                      "new_tool": decode_gcode(lines[match["new_tool"]]).strip(),
+                      "filament_temp": match["filament_temp"]})
+
+
+def scan_temp_change(d, scanner, line):
+    """
+    Records the CP TOOLCHANGE UNLOAD line in d.temp_changes when the lines before it
+    complete START_TEMPCHANGE_REGEX.  A match can't begin inside the previous one.
+    """
+    recent = recent_lines(scanner, 4)
+    start = recent[0][1]
+    text = b"".join([text for line_number, pos, text in recent])
+    match = d.regex.compile(START_TEMPCHANGE_REGEX).search(text, max(0, scanner.temp_change_end - start))
+    if match is None or match.start('temp_start') != len(text) - len(line):
+        return
+    line_number, pos, line = recent[-1]
+    d.temp_changes.append((pos, line_number))
+    d.line_positions[line_number] = pos
+    scanner.temp_change_end = start + match.end()
+
+
+def scan_final_toolchange(d, scanner, line):
+    """
+    Fakes a toolchange for the final unload, which has no T line, at the first M220 R
+    that completes FINAL_TOOLCHANGE_REGEX.
+    """
+    if d.timeline.final_position is not None:
+        return
+    recent = recent_lines(scanner, 4)
+    final = d.regex.search(FINAL_TOOLCHANGE_REGEX, b"".join([text for line_number, pos, text in recent]))
+    if final is not None:
+        d.timeline.set_final(recent[0][1] + final.start())
+
+
+def scan_progress(d, scanner, line):
+    """
+    Records an M73 progress line, and the positions of the lines that its replacement
+    is written between.
+    """
+    if d.regex.match(PROGRESS_REGEX, line):
+        line_number, pos, line = scanner.window[-1]
+        d.progress_lines.append((line_number, line))
+        d.line_positions[line_number] = pos
+        d.line_positions[line_number + 1] = pos + len(line)
+
+
+def scan_config_block(d, scanner, line):
+    """
+    Records the SKINNYDIP CONFIGURATION block that starts here in d.config_blocks, once
+    the longest block it could be has been read.  get_settings works out which tool it
+    belongs to.
+    """
+    line_number, position, line = scanner.window[-1]
+    scanner.after(line_number + CONFIG_MAX_LINES, scan_config_lines, line_number, position)
+
+
+def scan_config_lines(d, scanner, line_number, position):
+    """
+    The rest of scan_config_block, once the lines of the block are in the window.
+    :param line_number: int: line number of the CONFIG_START line
+    :param position: int: its char position
+    """
+    lines = [text for number, pos, text in scanner.window if number > line_number]
+    d.config_blocks.append((position, line_number, parse_config_block(lines)))
+
+
+def scan_comment(d, scanner, line):
+    """
+    Keeps the comment lines since the last line of gcode, which end up holding the
+    slicer's settings at the end of the input.  Blank lines don't interrupt them.
+    """
+    line_number = scanner.window[-1][0]
+    if line_number != scanner.comments_next:
+        scanner.comments = []
+    if line[:1] == b";":
+        scanner.comments.append(line)
+    scanner.comments_next = line_number + 1
+
+
+# Handlers of the line scanner: (token the lines start with, function of (d, scanner, line)).
+# A new rule that needs something found in the gcode adds its handler here, and plans
+# its insertions in a stage after the scan.
+SCAN_HANDLERS = [
+    (PROCESSED_MARKER, scan_processed_marker),
+    (b"T", scan_toolchange),
+    (b"; CP TOOLCHANGE UNLOAD", scan_temp_change),
+    (CONFIG_START, scan_config_block),
+    (b"M220 R", scan_final_toolchange),
+    (b"M73 ", scan_progress),
+]
+# Handlers added for input that can't be read backwards from its end, to keep the comments
+# that the slicer's settings are in, see get_slicer_settings
+TRAILING_COMMENT_HANDLERS = [
+    (b";", scan_comment),
+    (b"\n", scan_comment),
+    (b"\r\n", scan_comment),
+]
+
+
+def scan_gcode(d, source, handlers=SCAN_HANDLERS):
+    """
+    Runs a LineScanner over the input.  Results are stored in d.timeline, d.config_blocks,
+    d.unloads, d.temp_changes, d.progress_lines and, with TRAILING_COMMENT_HANDLERS,
+    d.trailing_comments.  d.line_positions holds the char positions of the lines that
+    insertions can be planned at, and of the lines after progress lines.
+    :param d: SetupData object
+    :param source: iterable of lines
+    :param handlers: list of (token, handler), see LineScanner
+    :return: None
+    """
+    d.config_blocks = []
+    d.unloads = []
+    d.temp_changes = []
+    d.progress_lines = []
+    d.line_positions = {}
+    scanner = LineScanner(d, handlers)
+    d.stream_size = scanner.scan(source)
+    d.linecount = 0
+    if scanner.window:  # lines that end with a linebreak
+        line_number, pos, line = scanner.window[-1]
+        d.linecount = line_number + (line[-1:] == b"\n")
+        if scanner.comments_next == line_number + 1:  # no gcode after them
+            d.trailing_comments = scanner.comments
+    lprint("  lines in file: " + str(d.linecount))
+    if not len(d.timeline):
+        lprint("No toolchanges found!")
+    lprint("  Toolchange index has " + str(d.timeline.total()) + " elements")
+    lprint(Lazy(pprint.pformat, d.timeline.entries()), False, loglevel=LOG_DEBUG)
+
+
+def mapped_lines(text):
+    """
+    :param text: mmap, or string for an empty file
+    :return: iterator over the lines of text.  A mapping's own readline splits them much
+             faster than iter_lines can.  It reads on from the mapping's position, which
+             is rewound here first.
+    """
+    if not hasattr(text, "readline"):
+        return iter_lines(text)
+    text.seek(0)
+    return iter(text.readline, b"")
+
+
+# STREAMING ENGINE ***********************************************************
+def stream_output(d):
+    """
+    Writes the header, then copies the input to the output in spans, with each planned
+    insertion written ahead of the line it belongs to.
+    :param d: SetupData object
+    :return: None
+    """
+    header = encode_gcode("".join([line + "\n" for line in generate_gcode_header(d).splitlines()]))
+    segments = splice_segments(header, d.insertion_plan, d.line_positions.__getitem__,
+                               d.stream_size)
+    d.fileinfo.write_stream_output(segments)
+
+
+def stream_read_input(d):
+    """
+    Runs the line scanner over the input and checks that it held configuration blocks.
+    Compressed input is read forwards only, so the scan keeps the comments at its end.
+    :param d: SetupData object
+    :return: None
+    """
+    source = d.fileinfo.open_stream()
+    if d.fileinfo.f is None:
+        scan_gcode(d, source, SCAN_HANDLERS + TRAILING_COMMENT_HANDLERS)
+    else:
+        scan_gcode(d, source)
+    check_config_found(d)
+
+
+# PARALLEL ENGINE ************************************************************
+def chunk_boundaries(text, chunks):
+    """
+    Divides text into about equal chunks for parallel_scan.  A chunk ends after the
+    PARALLEL_SPLIT_AFTER line of a wipe tower toolchange when one is near, which keeps
+    every unload in a single chunk, and otherwise at the end of a line.
+    :param text: string or mmap holding the gcode
+    :param chunks: int: number of chunks wanted
+    :return: list of (start, end) char positions of chunks of whole lines
+    """
+    size = len(text)
+    boundaries = [0]
+    for n in range(1, chunks):
+        pos = size * n // chunks
+        toolchange_end = text.find(PARALLEL_SPLIT_AFTER, pos, size * (n + 1) // chunks)
+        if toolchange_end >= 0:
+            pos = toolchange_end
+        pos = text.find(b"\n", pos) + 1
+        if pos == 0 or pos >= size:
+            break
+        if pos > boundaries[-1]:
+            boundaries.append(pos)
+    boundaries.append(size)
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+def scan_chunk(task):
+    """
+    Pool function of parallel_scan.  Each process maps the input file itself, so the
+    page cache holds the only copy of it however many processes read it.
+    :param task: (path of the input file, start, end) of a chunk from chunk_boundaries
+    :return: scan_text_chunk results
+    """
+    path, start, end = task
+    with open(path, "rb") as f:
+        text = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return scan_text_chunk(text, start, end)
+        finally:
+            text.close()
+
+
+def scan_text_chunk(text, start, end, floor=None, temp_change_from=None, regex=re):
+    """
+    Finds the toolchanges, configuration blocks, unloads and temperature changes that
+    begin inside one chunk of the input.  The UNLOAD_WINDOW_LINES lines before the chunk
+    and UNLOAD_WINDOW_LINES + 2 lines after it are read too, for the patterns that span
+    several lines.  Line numbers count from the first line of the chunk.
+    :param text: string or mmap holding the gcode
+    :param start: int: char position of the first line of the chunk
+    :param end: int: char position just after the last line of the chunk
+    :param floor: int: first line that an unload may begin on, or None to allow every line read
+    :param temp_change_from: int: char position to search for temperature changes from, or None for start
+    :param regex: re module, or the RegexCounter of a profiled run
+    :return: dict of the results, merged by parallel_scan
+    """
+    find = text.find
+    context_start = start
+    for n in range(UNLOAD_WINDOW_LINES):
+        if context_start == 0:
+            break
+        context_start = text.rfind(b"\n", 0, context_start - 1) + 1
+    typecode = "I"
+    if len(text) >= 2 ** (8 * array(typecode).itemsize):
+        typecode = "L"
+    starts = array(typecode, [context_start])
+    append = starts.append
+    pos = find(b"\n", context_start)
+    while 0 <= pos < end:
+        append(pos + 1)
+        pos = find(b"\n", pos + 1)
+    for n in range(UNLOAD_WINDOW_LINES + 2):
+        if pos < 0:
+            break
+        append(pos + 1)
+        pos = find(b"\n", pos + 1)
+    context_lines = starts.index(start)
+    context_end = starts[-1]
+
+    def line_at(position):
+        return bisect_right(starts, position) - 1 - context_lines
+
+    toolchanges = []
+    for match in regex.compile(TOOLCHANGE_REGEX, re.MULTILINE).finditer(text, start, end):
+        position = match.start('tool')
+        toolchanges.append((position, line_at(position), tool_number(match.group('tool'))))
+
+    floor = 0 if floor is None else floor + context_lines
+    unloads, floor = match_unloads(text, starts, len(starts) - 1,
+                                   [line + context_lines for position, line, tool in toolchanges], floor)
+    line_positions = []
+    for unload in unloads:
+        for key in ["temp_pause_line", "temp_restore_line", "dip_line"]:
+            line_positions.append((unload[key] - context_lines, starts[unload[key]]))
+        for key in ["temp_pause_line", "temp_restore_line", "dip_line", "new_tool_line"]:
+            unload[key] -= context_lines
+
+    temp_changes = []
+    matches = regex.compile(START_TEMPCHANGE_REGEX).finditer(text, temp_change_from or start, context_end)
+    for match in matches:
+        if match.start() >= end:
+            break
+        changepos = int(match.start('temp_start'))
+        temp_changes.append((match.start(), match.end(), changepos, line_at(changepos)))
+
+    progress_lines = []
+    for match in regex.compile(PROGRESS_REGEX, re.MULTILINE).finditer(text, start, end):
+        progress_lines.append((line_at(match.start()), match.group(0), match.start(), match.end()))
+
+    final = regex.compile(FINAL_TOOLCHANGE_REGEX).search(text, start, context_end)
+    return {"lines": bisect_right(starts, end) - context_lines - 1,
+            "context_lines": context_lines,
+            "toolchanges": toolchanges,
+            "config_blocks": [(position, line_at(position), params)
+                              for position, params in find_config_blocks(text, start, end)],
+            "unloads": unloads,
+            "floor": floor - context_lines if toolchanges else None,
+            "line_positions": line_positions,
+            "temp_changes": temp_changes,
+            "progress_lines": progress_lines,
+            "final": final.start() if final is not None and final.start() < end else None}
+
+
+def parallel_scan(d):
+    """
+    Stands in for the line scanner of the whole-file engine.  The input is split into
+    chunks that a pool of d.fileinfo.jobs processes search at the same time, and their
+    results are merged in file order.
+    The chunks are analysed without knowing what came before them, so a chunk whose
+    first unload or temperature change could have been cut short by the end of the
+    previous chunk is analysed again here, from where that ends.  The results are the
+    same as those of the whole-file engine.
+    Stdin and reprocessed input is held in an unnamed temporary file that other
+    processes can't map, so it is analysed here in chunks instead.
+    :param d: SetupData object
+    :return: None
+    """
+    text = d.gcode_str
+    jobs = d.fileinfo.jobs or multiprocessing.cpu_count()
+    chunks = chunk_boundaries(text, max(1, min(jobs, len(text) // PARALLEL_MIN_CHUNK)))
+    if len(chunks) > 1 and d.fileinfo.mapped_path is not None:
+        lprint("  Analysing " + str(len(chunks)) + " chunks in parallel")
+        pool = multiprocessing.Pool(len(chunks))
+        try:
+            results = pool.map(scan_chunk, [(d.fileinfo.mapped_path, start, end) for start, end in chunks])
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        results = [scan_text_chunk(text, start, end, regex=d.regex) for start, end in chunks]
+
+    d.timeline = ToolTimeline(len(text))
+    d.config_blocks = []
+    d.unloads = []
+    d.temp_changes = []
+    d.progress_lines = []
+    d.line_positions = {}
+    offset = 0  # number of the first line of the chunk
+    floor = 0  # first line the next unload may begin on
+    temp_change_end = 0  # end of the last START_TEMPCHANGE_REGEX match
+    final = None
+    for (start, end), result in zip(chunks, results):
+        if result["toolchanges"]:
+            first_toolchange = offset + result["toolchanges"][0][1]
+            if max(floor, first_toolchange - UNLOAD_WINDOW_LINES) != \
+                    max(offset - result["context_lines"], first_toolchange - UNLOAD_WINDOW_LINES):
+                result = scan_text_chunk(text, start, end, floor - offset, regex=d.regex)
+        if result["temp_changes"] and result["temp_changes"][0][0] < temp_change_end:
+            result = scan_text_chunk(text, start, end, floor - offset, temp_change_end, d.regex)
+        if result["floor"] is not None:
+            floor = offset + result["floor"]
+        for position, line_number, tool in result["toolchanges"]:
+            d.timeline.append(position, offset + line_number, tool)
+        for position, line_number, params in result["config_blocks"]:
+            d.config_blocks.append((position, offset + line_number, params))
+        for unload in result["unloads"]:
+            for key in ["temp_pause_line", "temp_restore_line", "dip_line", "new_tool_line"]:
+                unload[key] += offset
+            d.unloads.append(unload)
+        for line_number, position in result["line_positions"]:
+            d.line_positions[offset + line_number] = position
+        for match_start, match_end, changepos, line_number in result["temp_changes"]:
+            d.temp_changes.append((changepos, offset + line_number))
+            d.line_positions[offset + line_number] = changepos
+            temp_change_end = match_end
+        for line_number, line, position, following in result["progress_lines"]:
+            d.progress_lines.append((offset + line_number, line))
+            d.line_positions[offset + line_number] = position
+            d.line_positions[offset + line_number + 1] = following
+        if final is None:
+            final = result["final"]
+        offset += result["lines"]
+
+    d.linecount = offset
+    lprint("  lines in file: " + str(d.linecount))
+    if not len(d.timeline):
+        lprint("No toolchanges found!")
+    if final is not None:
+        d.timeline.set_final(final)
+    lprint("  Toolchange index has " + str(d.timeline.total()) + " elements")
+    lprint(Lazy(pprint.pformat, d.timeline.entries()), False, loglevel=LOG_DEBUG)
+    check_config_found(d)
+
+
+# COMPRESSED AND BINARY GCODE ************************************************
+def sniff_format(path):
+    """
+    :param path: path of an input file
+    :return: GCODE_FORMAT, GZIP_FORMAT or BGCODE_FORMAT, from the first bytes of the file
+    """
+    with open(path, "rb") as f:
+        magic = f.read(len(BGCODE_MAGIC))
+    if magic[:len(GZIP_MAGIC)] == GZIP_MAGIC:
+        return GZIP_FORMAT
+    if magic == BGCODE_MAGIC:
+        return BGCODE_FORMAT
+    return GCODE_FORMAT
+
+
+def open_gcode(path, file_format):
+    """
+    Opens an input for reading its gcode in a single forward pass, decompressing and
+    decoding as it goes.
+    :param path: path of the input
+    :param file_format: GCODE_FORMAT, GZIP_FORMAT or BGCODE_FORMAT
+    :return: iterable of lines with a close method
+    """
+    if file_format == GZIP_FORMAT:
+        return gzip.GzipFile(path, "rb")
+    if file_format == BGCODE_FORMAT:
+        return BinaryGcodeReader(open(path, "rb"))
+    return open(path, "rb")
+
+
+def gcode_is_processed(path, file_format):
+    """
+    :return: True if the gcode of the input begins with the header this script writes
+    """
+    source = open_gcode(path, file_format)
+    try:
+        first = next(iter(source), b"")
+    finally:
+        source.close()
+    return first[:len(PROCESSED_MARKER)] == PROCESSED_MARKER
+
+
+def copy_line_spans(lines, output, segments):
+    """
+    The forward only counterpart of write_segments.  The (offset, length) spans are read
+    from lines as they go by, so they must follow on from one another, as they do in the
+    segments from splice_segments.
+    :param lines: iterable of the lines of the input
+    :param output: file object for the output, with a write method
+    :param segments: list of bytes and (offset, length) tuples
+    :return: None
+    """
+    lines = iter(lines)
+    pending = b""  # start of a line that belongs to the next span
+    position = 0
+    chunk = []
+    chunk_size = 0
+    for segment in segments:
+        if not isinstance(segment, tuple):
+            chunk.append(segment)
+            chunk_size += len(segment)
+            continue
+        offset, length = segment
+        if offset != position:
+            raise CustomError("Spans of the input must be copied in order.")
+        position += length
+        while length > 0:
+            if not pending:
+                pending = next(lines, b"")
+                if not pending:
+                    raise CustomError("Input ended early.  It changed while it was being processed.")
+            piece = pending[:length]
+            pending = pending[len(piece):]
+            chunk.append(piece)
+            chunk_size += len(piece)
+            length -= len(piece)
+            if chunk_size >= COPY_CHUNK_SIZE:
+                output.write(b"".join(chunk))
+                chunk = []
+                chunk_size = 0
+    output.write(b"".join(chunk))
+
+
+def copy_lines(lines, output):
+    """
+    :param lines: iterable of lines
+    :param output: file object with a write method
+    :return: None
+    """
+    chunk = []
+    chunk_size = 0
+    for line in lines:
+        chunk.append(line)
+        chunk_size += len(line)
+        if chunk_size >= COPY_CHUNK_SIZE:
+            output.write(b"".join(chunk))
+            chunk = []
+            chunk_size = 0
+    output.write(b"".join(chunk))
+
+
+def gzip_writer(f, path):
+    """
+    :param f: file object the compressed gcode is written to
+    :param path: path the output will end up at, whose name is recorded in the gzip header
+    :return: file object that compresses what is written to it.  The modification time in
+             the header is left out, so that the same input always gives the same output.
+    """
+    name = os.path.basename(path)
+    if name.lower().endswith(GZIP_EXTENSION):
+        name = name[:-len(GZIP_EXTENSION)]
+    return gzip.GzipFile(name, "wb", GZIP_LEVEL, f, 0)
+
+
+def heatshrink_decode(data, window_bits, lookahead_bits):
+    """
+    Decompresses heatshrink data: a stream of bits, most significant first, in which a 1
+    is followed by a literal byte and a 0 by a back reference of window_bits bits of
+    distance and lookahead_bits bits of length, each stored minus one.
+    :param data: bytes of compressed data
+    :param window_bits: int
+    :param lookahead_bits: int
+    :return: bytes
+    """
+    data = bytearray(data)
+    size = len(data)
+    out = bytearray()
+    accumulator = 0
+    bits = 0  # number of bits in the accumulator
+    i = 0
+    window_mask = (1 << window_bits) - 1
+    lookahead_mask = (1 << lookahead_bits) - 1
+    while True:
+        if bits < 1:
+            if i >= size:
+                break
+            accumulator = (accumulator << 8) | data[i]
+            i += 1
+            bits += 8
+        bits -= 1
+        if (accumulator >> bits) & 1:
+            if bits < 8:
+                if i >= size:
+                    break
+                accumulator = (accumulator << 8) | data[i]
+                i += 1
+                bits += 8
+            bits -= 8
+            out.append((accumulator >> bits) & 0xFF)
+        else:
+            needed = window_bits + lookahead_bits
+            while bits < needed and i < size:
+                accumulator = (accumulator << 8) | data[i]
+                i += 1
+                bits += 8
+            if bits < needed:  # padding at the end of the data
+                break
+            bits -= window_bits
+            distance = ((accumulator >> bits) & window_mask) + 1
+            bits -= lookahead_bits
+            count = ((accumulator >> bits) & lookahead_mask) + 1
+            if distance > len(out):
+                raise CustomError("Damaged heatshrink data.")
+            start = len(out) - distance
+            if count <= distance:
+                out += out[start:start + count]
+            else:  # the reference overlaps the bytes it produces
+                for n in range(start, start + count):
+                    out.append(out[n])
+        accumulator &= (1 << bits) - 1
+    return bytes(out)
+
+
+def heatshrink_encode(data, window_bits, lookahead_bits):
+    """
+    Compresses data for heatshrink_decode.  Each position looks up the last place the
+    next 3 bytes were seen, and uses it if it is still inside the window.
+    :param data: bytes
+    :param window_bits: int
+    :param lookahead_bits: int
+    :return: bytes of compressed data
+    """
+    size = len(data)
+    window = 1 << window_bits
+    longest = 1 << lookahead_bits
+    reference_bits = 1 + window_bits + lookahead_bits
+    codes = bytearray(data)
+    out = bytearray()
+    accumulator = 0
+    bits = 0
+    last_seen = {}
+    i = 0
+    while i < size:
+        key = data[i:i + 3]
+        candidate = last_seen.get(key)
+        last_seen[key] = i
+        if candidate is not None and i - candidate <= window and size - i >= 3:
+            length = 3
+            limit = min(longest, size - i)
+            while length < limit and codes[candidate + length] == codes[i + length]:
+                length += 1
+            accumulator = (accumulator << reference_bits) | \
+                          ((i - candidate - 1) << lookahead_bits) | (length - 1)
+            bits += reference_bits
+            i += length
+        else:
+            accumulator = (accumulator << 9) | 0x100 | codes[i]
+            bits += 9
+            i += 1
+        while bits >= 8:
+            bits -= 8
+            out.append((accumulator >> bits) & 0xFF)
+        accumulator &= (1 << bits) - 1
+    if bits:
+        out.append((accumulator << (8 - bits)) & 0xFF)
+    return bytes(out)
+
+
+def meatpack_decode(data):
+    """
+    Expands MeatPack encoded gcode, which packs the most common characters two to a byte.
+    A half byte of 0xf stands for a whole character sent after the byte.  Gcode packed
+    without spaces has them put back between the parameters of G lines.
+    :param data: bytes of MeatPack data
+    :return: bytes of gcode
+    """
+    data = bytearray(data)
+    size = len(data)
+    characters = bytearray(MEATPACK_CHARACTERS)
+    newline = characters.index(b"\n")
+    out = bytearray()
+    append = out.append
+    packing = False
+    no_spaces = False
+    nospace_start = None  # where the gcode decoded without spaces begins
+    i = 0
+    while i < size:
+        byte = data[i]
+        if byte == MEATPACK_SIGNAL and i + 2 < size and data[i + 1] == MEATPACK_SIGNAL:
+            command = data[i + 2]
+            i += 3
+            if command == MEATPACK_ENABLE_PACKING:
+                packing = True
+            elif command in [MEATPACK_DISABLE_PACKING, MEATPACK_RESET_ALL]:
+                packing = False
+            if command == MEATPACK_ENABLE_NO_SPACES and not no_spaces:
+                no_spaces = True
+                characters[11] = ord("E")
+                nospace_start = len(out)
+            elif command in [MEATPACK_DISABLE_NO_SPACES, MEATPACK_RESET_ALL] and no_spaces:
+                no_spaces = False
+                characters[11] = ord(" ")
+                out[nospace_start:] = space_gcode_lines(bytes(out[nospace_start:]))
+            continue
+        i += 1
+        if not packing:
+            append(byte)
+            continue
+        low = byte & 0xF
+        if low != 0xF:
+            append(characters[low])
+            if low == newline:  # the other half of the byte is padding
+                continue
+        elif i < size:
+            append(data[i])
+            i += 1
+        high = byte >> 4
+        if high != 0xF:
+            append(characters[high])
+        elif i < size:
+            append(data[i])
+            i += 1
+    if no_spaces:
+        out[nospace_start:] = space_gcode_lines(bytes(out[nospace_start:]))
+    return bytes(out)
+
+
+def space_gcode_lines(gcode):
+    """
+    :param gcode: bytes of gcode written without spaces, eg. G1X10E-2
+    :return: bytes of gcode with a space ahead of each parameter of its G lines, eg. G1 X10 E-2.
+             As in libbgcode, the spacing stops at the first ; of a line, so comments are kept as they are.
+    """
+    parameter = re.compile(b"(?<! )([" + MEATPACK_GLINE_PARAMETERS + b"])")
+    return re.sub(br"(?m)^G[^\n;]*", lambda line: parameter.sub(br" \1", line.group(0)), gcode)
+
+
+class MeatPackPairs(dict):
+    """
+    The MeatPack bytes for each pair of characters, worked out the first time the pair is seen.
+    """
+
+    def __missing__(self, pair):
+        low = MEATPACK_CHARACTERS.find(pair[:1])
+        high = MEATPACK_CHARACTERS.find(pair[1:])
+        packed = bytearray([(low if low >= 0 else 0xF) | ((high if high >= 0 else 0xF) << 4)])
+        if low < 0:
+            packed += pair[:1]
+        if high < 0:
+            packed += pair[1:]
+        self[pair] = bytes(packed)
+        return self[pair]
+
+
+def meatpack_encode(gcode):
+    """
+    Packs gcode for meatpack_decode, keeping every character, spaces and comments included.
+    Characters are paired within each line.  A line ending left over by a line of odd length
+    gets a byte of its own, because the half byte after a packed line ending is padding.
+    :param gcode: bytes of gcode
+    :return: bytes of MeatPack data
+    """
+    if b"\xff" in gcode:
+        raise CustomError("Gcode holding the byte 0xff can't be MeatPack encoded.")
+    pairs = MeatPackPairs()
+    newline = MEATPACK_CHARACTERS.find(b"\n")
+    lone_newline = bytes(bytearray([newline | (newline << 4)]))
+    out = [bytes(bytearray([MEATPACK_SIGNAL, MEATPACK_SIGNAL, MEATPACK_ENABLE_PACKING]))]
+    lines = gcode.split(b"\n")
+    last = lines.pop()  # whatever follows the last line ending
+    for line in lines:
+        if len(line) % 2:
+            line += b"\n"
+            out.append(b"".join([pairs[line[k:k + 2]] for k in range(0, len(line), 2)]))
+        else:
+            out.append(b"".join([pairs[line[k:k + 2]] for k in range(0, len(line), 2)]))
+            out.append(lone_newline)
+    even = len(last) - len(last) % 2
+    out.append(b"".join([pairs[last[k:k + 2]] for k in range(0, even, 2)]))
+    if even < len(last):  # a last character with nothing to pair it with is sent unpacked
+        out.append(bytes(bytearray([MEATPACK_SIGNAL, MEATPACK_SIGNAL, MEATPACK_DISABLE_PACKING])) +
+                   last[even:])
+    return b"".join(out)
+
+
+def parse_ini_metadata(data):
+    """
+    :param data: bytes of a metadata block, "key=value" lines
+    :return: list of (key, value) strings
+    """
+    metadata = []
+    for line in decode_gcode(data).splitlines():
+        key, equals, value = line.partition("=")
+        if equals:
+            metadata.append((key.strip(), value.strip()))
+    return metadata
+
+
+class BinaryGcodeReader():
+    """
+    Reads a binary gcode (.bgcode) file: a file header followed by blocks, each with a
+    header, parameters, data that may be compressed and encoded, and a CRC32.  Iterating
+    over it gives the lines of the gcode blocks, which are decoded one at a time.  The
+    blocks that aren't gcode are kept as they are so that they can be written out again.
+    """
+
+    def __init__(self, f):
+        """
+        :param f: file object of the input, open for binary reading
+        """
+        self.f = f
+        header = f.read(10)
+        if len(header) < 10 or header[:4] != BGCODE_MAGIC:
+            raise CustomError("Not a binary gcode file.")
+        self.version, self.checksum_type = struct.unpack("<IH", header[4:])
+        self.file_header = header
+        self.preamble = []  # raw blocks ahead of the gcode
+        self.trailer = []  # raw blocks that aren't gcode after the first gcode block
+        self.metadata = {}  # block type: list of (key, value)
+        self.gcode_compression = None
+        self.gcode_encoding = None
+        block = self.read_block()
+        while block is not None and block[0] != BGCODE_GCODE:
+            self.keep_block(block, self.preamble)
+            block = self.read_block()
+        self.next_block = block
+        if block is not None:
+            self.gcode_compression = block[1]
+            self.gcode_encoding = block[2]
+
+    def read_exactly(self, count):
+        data = self.f.read(count)
+        if len(data) < count:
+            raise CustomError("Binary gcode file ends in the middle of a block.")
+        return data
+
+    def read_block(self):
+        """
+        :return: (type, compression, encoding, decompressed data, raw bytes of the block),
+                 or None at the end of the file
+        """
+        header = self.f.read(8)
+        if not header:
+            return None
+        if len(header) < 8:
+            raise CustomError("Binary gcode file ends in the middle of a block.")
+        block_type, compression, size = struct.unpack("<HHI", header)
+        stored_size = size
+        if compression != BGCODE_NO_COMPRESSION:
+            header += self.read_exactly(4)
+            stored_size = struct.unpack("<I", header[8:])[0]
+        parameters = self.read_exactly(6 if block_type == BGCODE_THUMBNAIL else 2)
+        data = self.read_exactly(stored_size)
+        raw = header + parameters + data
+        if self.checksum_type == BGCODE_CHECKSUM_CRC32:
+            checksum = self.read_exactly(4)
+            if struct.unpack("<I", checksum)[0] != zlib.crc32(raw) & 0xFFFFFFFF:
+                raise CustomError("Checksum error in a block of the binary gcode file.")
+            raw += checksum
+        encoding = struct.unpack("<H", parameters[:2])[0]
+        if block_type != BGCODE_THUMBNAIL:  # thumbnails are only ever copied
+            data = decompress_block(data, compression)
+            if len(data) != size:
+                raise CustomError("Block of the binary gcode file has the wrong size.")
+        return block_type, compression, encoding, data, raw
+
+    def keep_block(self, block, destination):
+        block_type, compression, encoding, data, raw = block
+        destination.append(raw)
+        if block_type != BGCODE_THUMBNAIL:
+            self.metadata[block_type] = parse_ini_metadata(data)
+
+    def blocks(self):
+        """
+        :return: generator of the decoded gcode of each gcode block
+        """
+        while self.next_block is not None:
+            block_type, compression, encoding, data, raw = self.next_block
+            self.next_block = self.read_block()
+            if block_type != BGCODE_GCODE:
+                self.keep_block((block_type, compression, encoding, data, raw), self.trailer)
+            elif encoding in BGCODE_MEATPACK:
+                yield meatpack_decode(data)
+            else:
+                yield data
+
+    def __iter__(self):
+        pending = b""
+        for data in self.blocks():
+            lines = (pending + data).split(b"\n")
+            pending = lines.pop()
+            for line in lines:
+                yield line + b"\n"
+        if pending:
+            yield pending
+
+    def finish(self):
+        """
+        Reads the blocks that are left, so that the trailer is complete.
+        """
+        for data in self.blocks():
+            pass
+
+    def slicer_settings(self):
+        """
+        :return: dict of the slicer metadata, like read_slicer_settings gives for text gcode
+        """
+        return dict((key, slicer_value(value)) for key, value in
+                    self.metadata.get(BGCODE_SLICER_METADATA, []))
+
+    def close(self):
+        self.f.close()
+
+
+def decompress_block(data, compression):
+    """
+    :param data: bytes of the data of a block, as stored
+    :param compression: compression of the block
+    :return: bytes
+    """
+    if compression == BGCODE_NO_COMPRESSION:
+        return data
+    if compression == BGCODE_DEFLATE:
+        return zlib.decompress(data)
+    if compression in BGCODE_HEATSHRINK:
+        window_bits, lookahead_bits = BGCODE_HEATSHRINK[compression]
+        return heatshrink_decode(data, window_bits, lookahead_bits)
+    raise CustomError("Unknown compression " + str(compression) + " in binary gcode file.")
+
+
+def compress_block(data, compression):
+    """
+    :param data: bytes
+    :param compression: compression to store the data with
+    :return: bytes
+    """
+    if compression == BGCODE_NO_COMPRESSION:
+        return data
+    if compression == BGCODE_DEFLATE:
+        return zlib.compress(data)
+    if compression in BGCODE_HEATSHRINK:
+        window_bits, lookahead_bits = BGCODE_HEATSHRINK[compression]
+        return heatshrink_encode(data, window_bits, lookahead_bits)
+    raise CustomError("Unknown compression " + str(compression) + " for binary gcode file.")
+
+
+class BinaryGcodeWriter():
+    """
+    Writes a binary gcode file with the same file header, metadata and thumbnails as the
+    one a BinaryGcodeReader is reading, and the gcode written to it cut into blocks of up
+    to BGCODE_BLOCK_SIZE bytes at line endings.  Gcode blocks get the compression and
+    encoding of the first gcode block of the input.
+    """
+
+    def __init__(self, f, reader):
+        """
+        :param f: file object of the output, open for binary writing
+        :param reader: BinaryGcodeReader of the input
+        """
+        self.f = f
+        self.reader = reader
+        self.compression = reader.gcode_compression
+        self.encoding = reader.gcode_encoding
+        if self.compression is None:  # the input had no gcode
+            self.compression = BGCODE_DEFLATE
+            self.encoding = 0
+        self.pending = []
+        self.pending_size = 0
+        f.write(reader.file_header)
+        for raw in reader.preamble:
+            f.write(raw)
+
+    def write(self, data):
+        self.pending.append(data)
+        self.pending_size += len(data)
+        if self.pending_size >= BGCODE_BLOCK_SIZE:
+            self.write_blocks(False)
+
+    def write_blocks(self, final):
+        """
+        :param final: True to write out everything, False to keep the bytes that don't fill a block
+        """
+        data = b"".join(self.pending)
+        start = 0
+        while len(data) - start >= BGCODE_BLOCK_SIZE or (final and start < len(data)):
+            end = data.rfind(b"\n", start, start + BGCODE_BLOCK_SIZE) + 1
+            if end <= start:  # a line longer than a block
+                end = start + BGCODE_BLOCK_SIZE
+            if final and len(data) - start <= BGCODE_BLOCK_SIZE:
+                end = len(data)
+            self.write_gcode_block(data[start:end])
+            start = end
+        self.pending = [data[start:]]
+        self.pending_size = len(data) - start
+
+    def write_gcode_block(self, gcode):
+        payload = gcode
+        if self.encoding in BGCODE_MEATPACK:
+            payload = meatpack_encode(gcode)
+        stored = compress_block(payload, self.compression)
+        header = struct.pack("<HHI", BGCODE_GCODE, self.compression, len(payload))
+        if self.compression != BGCODE_NO_COMPRESSION:
+            header += struct.pack("<I", len(stored))
+        block = header + struct.pack("<H", self.encoding) + stored
+        self.f.write(block)
+        if self.reader.checksum_type == BGCODE_CHECKSUM_CRC32:
+            self.f.write(struct.pack("<I", zlib.crc32(block) & 0xFFFFFFFF))
+
+    def close(self):
+        self.write_blocks(True)
+        self.reader.finish()
+        for raw in self.reader.trailer:
+            self.f.write(raw)
+
+
+# BATCH MODE *****************************************************************
+def is_gcode_name(name):
+    """
+    :return: True for gcode file names, other than the temporary and backup files this script makes
+    """
+    stem, extension = os.path.splitext(name)
+    if extension.lower() == GZIP_EXTENSION:
+        stem, extension = os.path.splitext(stem)
+    return extension.lower() in BATCH_EXTENSIONS and not stem.endswith(("_skinnydip", "_original"))
+
+
+def expand_batch_paths(paths):
+    """
+    Turns the arguments of a batch into a list of gcode files.  Directories contribute
+    the gcode files they contain, patterns are expanded with glob, and @name reads a
+    list of paths from the file name, one per line.
+    :param paths: list of strings
+    :return: list of real paths without duplicates, in the order they were given
+    """
+    found = []
+    for path in paths:
+        if path.startswith("@"):
+            with open(path[1:]) as listfile:
+                found.extend(expand_batch_paths([line.strip() for line in listfile if line.strip()]))
+        elif os.path.isdir(path):
+            for name in sorted(os.listdir(path)):
+                if is_gcode_name(name):
+                    found.append(os.path.join(path, name))
+        elif glob.has_magic(path):
+            found.extend(sorted(glob.glob(path)))
+        else:
+            found.append(path)
+    batch = []
+    for path in found:
+        path = os.path.realpath(path)
+        if path not in batch:
+            batch.append(path)
+    return batch
+
+
+def file_signature(path):
+    """
+    :return: [size, modification time] of a file, to tell whether it changed since it was journaled
+    """
+    status = os.stat(path)
+    return [status.st_size, status.st_mtime]
+
+
+def batch_options(args):
+    """
+    :param args: dict of FileInfo.task_args
+    :return: the options in args that change what a batch does to its files, as they read
+             back from the journal
+    """
+    return json.loads(json.dumps(dict((key, value) for key, value in args.items() if key != "cache_dir")))
+
+
+def journal_file_for(paths, args):
+    """
+    :param paths: the arguments of a batch
+    :param args: dict of FileInfo.task_args
+    :return: path of the journal of the batch, in the journal directory beside the script.
+             It is named after a hash of the resolved arguments and the batch_options, so
+             only the same batch run again resumes from it.
+    """
+    inputs = ["@" + os.path.realpath(path[1:]) if path.startswith("@") else os.path.realpath(path)
+              for path in paths]
+    key = hashlib.sha1(encode_gcode(json.dumps([inputs, batch_options(args)], sort_keys=True)))
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), JOURNAL_DIR,
+                        "batch-" + key.hexdigest()[:16] + ".journal")
+
+
+def read_journal(filename, options):
+    """
+    Reads the journal of a previous batch.  The last entry for a file wins.  Entries of
+    batches run with other options, eg. --unprocess or --set, are ignored, because those
+    batches did something else to the files.
+    :param filename: path of the journal
+    :param options: batch_options of this batch
+    :return: dict of path to the signature each finished file had when it was journaled
+    """
+    finished = {}
+    if not os.path.exists(filename):
+        return finished
+    with open(filename) as journal:
+        for line in journal:
+            try:
+                entry = json.loads(line)
+            except ValueError:  # last line cut short by an interruption
+                continue
+            if entry.get("options") != options:
+                continue
+            if entry.get("status") in ["ok", "skipped"]:
+                finished[entry["path"]] = entry["signature"]
+            else:
+                finished.pop(entry.get("path"), None)
+    return finished
+
+
+def batch_worker_init():
+    """
+    Runs once in each pool process.  Workers report through their results, so their
+    console messages are dropped.
+    """
+    sys.stdout = open(os.devnull, "w")
+    set_log_console(sys.stdout)
+
+
+def batch_process(task):
+    """
+    Processes one file of a batch.  Runs in a pool process, so errors are returned
+    in the result rather than raised.
+    :param task: tuple of (path, log level, dict of FileInfo.task_args)
+    :return: dict with the path, status, message and (on failure) the end of the log
+             of the file and where the rest of it was written
+    """
+    path, log_level, args = task
+    previous_log = start_log(log_level)
+    started = time.time()
+    result = {"path": path, "status": "ok"}
+    try:
+        previously_processed = gcode_is_processed(path, sniff_format(path))
+        if args.get("unprocess") and not previously_processed:
+            result["status"] = "skipped"
+            result["message"] = "not processed"
+        elif previously_processed and not (args.get("unprocess") or args.get("reprocess")):
+            result["status"] = "skipped"
+            result["message"] = "previously processed"
+        else:
+            d = SetupData(path, **args)
+            d.open_log_file()
+            run_pipeline(d)
+            if args.get("unprocess"):
+                result["message"] = "stripped " + str(d.insertions_stripped) + " insertions"
+            else:
+                result["message"] = str(d.dips_inserted) + " dips, " + \
+                                    str(d.temp_drops_inserted) + " temperature changes"
+        result["signature"] = file_signature(path)
+    except Exception as e:
+        result["status"] = "failed"
+        result["message"] = (str(e).strip() or e.__class__.__name__).splitlines()[0]
+        result["log"] = current_log().tail()
+        result["log_file"] = current_log().file_name
+    finally:
+        restore_log(previous_log)
+    result["seconds"] = round(time.time() - started, 2)
+    return result
+
+
+def batch_main(fileinfo):
+    """
+    Processes every file of a batch across a pool of processes, one per core unless
+    fileinfo.jobs says otherwise.  Each result is appended to the journal as soon as
+    it arrives, so an interrupted batch that is run again skips the files it finished.
+    The journal is deleted once every file of the batch has succeeded.
+    :param fileinfo: FileInfo object holding the batch arguments
+    :return: int: number of files that failed
+    """
+    options = batch_options(fileinfo.task_args())
+    finished = read_journal(fileinfo.journal_file_name, options)
+    tasks = []
+    for path in expand_batch_paths(fileinfo.batch_paths):
+        if not os.path.isfile(path):
+            lprint("  not found: " + path)
+        elif finished.get(path) == file_signature(path):
+            lprint("  already finished: " + path)
+        else:
+            tasks.append((path, current_log().level, fileinfo.task_args()))
+    if not tasks:
+        lprint("Nothing to process.")
+        remove_journal(fileinfo.journal_file_name)
+        return 0
+
+    jobs = fileinfo.jobs
+    if not jobs:
+        try:
+            jobs = multiprocessing.cpu_count()
+        except NotImplementedError:
+            jobs = 1
+    jobs = max(1, min(jobs, len(tasks)))
+    lprint("Processing " + str(len(tasks)) + " files with " + str(jobs) + " workers.  Journal: " +
+           fileinfo.journal_file_name)
+
+    failures = 0
+    directory = os.path.dirname(fileinfo.journal_file_name)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    journal = open(fileinfo.journal_file_name, "a")
+    pool = multiprocessing.Pool(jobs, batch_worker_init)
+    try:
+        results = pool.imap_unordered(batch_process, tasks)
+        for count in range(1, len(tasks) + 1):
+            result = results.next(BATCH_RESULT_WAIT)
+            entry = dict((key, result[key]) for key in ["path", "status", "signature"] if key in result)
+            entry["options"] = options
+            journal.write(json.dumps(entry) + "\n")
+            journal.flush()
+            lprint("  [" + str(count) + "/" + str(len(tasks)) + "] " + result["status"].ljust(8) +
+                   result["path"] + " (" + result["message"] + ", " + str(result["seconds"]) + "s)")
+            if result["status"] == "failed":
+                failures += 1
+                if result["log_file"] is not None:
+                    lprint("           log: " + result["log_file"])
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        journal.close()
+    lprint("Batch complete: " + str(len(tasks) - failures) + " succeeded, " + str(failures) + " failed.")
+    if not failures:
+        remove_journal(fileinfo.journal_file_name)
+    return failures
+
+
+def remove_journal(filename):
+    """
+    Deletes the journal of a batch that completed, so that running it again starts afresh.
+    :param filename: path of the journal
+    :return: None
+    """
+    if os.path.exists(filename):
+        os.remove(filename)
+
+
+# WATCH MODE *****************************************************************
+def scan_watch_dirs(directories):
+    """
+    :param directories: list of directories
+    :return: list of (directory, path) of the gcode files in them
+    """
+    found = []
+    for directory in directories:
+        try:
+            names = sorted(os.listdir(directory))
+        except OSError:
+            continue
+        for name in names:
+            path = os.path.join(directory, name)
+            if is_gcode_name(name) and os.path.isfile(path):
+                found.append((directory, path))
+    return found
+
+
+class InotifyWatcher():
+    """
+    Reports files that were closed after writing in, or moved into, the watched
+    directories.  Uses the linux inotify API through ctypes, so a file is reported
+    as soon as the program writing it closes it.
+    """
+
+    def __init__(self, directories):
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = libc.inotify_init()
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init failed")
+        self.directories = {}  # watch descriptor: directory
+        for directory in directories:
+            wd = libc.inotify_add_watch(self.fd, fsencode(directory), IN_CLOSE_WRITE | IN_MOVED_TO)
+            if wd < 0:
+                os.close(self.fd)
+                raise OSError(ctypes.get_errno(), "can't watch " + directory)
+            self.directories[wd] = directory
+        # files that were already there were not announced by an event.  Any that are
+        # still being written will be announced when they are closed.
+        self.startup = settled_files(scan_watch_dirs(directories))
+
+    def wait(self):
+        """
+        Blocks until the kernel reports events for the watched directories.
+        :return: list of (directory, path) of the files that are ready
+        """
+        if self.startup:
+            ready, self.startup = self.startup, []
+            return ready
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except OSError as e:
+            if e.errno == errno.EINTR:
+                return []
+            raise
+        ready = []
+        offset = 0
+        while offset + 16 <= len(data):
+            # struct inotify_event {int wd; uint32_t mask, cookie, len; char name[];}
+            wd, mask, cookie, length = struct.unpack_from("iIII", data, offset)
+            name = fsdecode(data[offset + 16:offset + 16 + length].rstrip(b"\0"))
+            offset += 16 + length
+            if mask & IN_Q_OVERFLOW:
+                ready.extend(scan_watch_dirs(self.directories.values()))  # events were lost
+            elif wd in self.directories and is_gcode_name(name):
+                ready.append((self.directories[wd], os.path.join(self.directories[wd], name)))
+        return ready
+
+
+class PollingWatcher():
+    """
+    Fallback for systems without inotify.  Scans the watched directories every
+    WATCH_POLL_INTERVAL seconds and reports files whose size and modification time
+    did not change between two scans.
+    """
+
+    def __init__(self, directories):
+        self.directories = directories
+        self.signatures = {}  # path: signature at the last scan
+
+    def wait(self):
+        """
+        :return: list of (directory, path) of the files that are ready
+        """
+        time.sleep(WATCH_POLL_INTERVAL)
+        ready = []
+        signatures = {}
+        for directory, path in scan_watch_dirs(self.directories):
+            try:
+                signatures[path] = file_signature(path)
+            except OSError:  # removed since the scan
+                continue
+            if self.signatures.get(path) == signatures[path]:
+                ready.append((directory, path))
+        self.signatures = signatures
+        return ready
+
+
+def settled_files(found):
+    """
+    Filters out files that are still being written.
+    :param found: list of (directory, path)
+    :return: the entries whose files did not change over WATCH_POLL_INTERVAL seconds
+    """
+    def signature(path):
+        try:
+            return file_signature(path)
+        except OSError:
+            return None
+
+    if not found:
+        return []
+    before = [signature(path) for directory, path in found]
+    time.sleep(WATCH_POLL_INTERVAL)
+    return [entry for entry, previous in zip(found, before)
+            if previous is not None and signature(entry[1]) == previous]
+
+
+def move_file(source, destination):
+    """
+    Moves a file, copying it when the destination is on another filesystem.
+    """
+    try:
+        replace_file(source, destination)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        shutil.move(source, destination)
+
+
+def compile_patterns():
+    """
+    Compiles the regular expressions that the handlers of SCAN_HANDLERS and the parallel
+    scan run on every file, so that the re module's cache already holds them when the
+    first file arrives.
+    :return: None
+    """
+    for pattern in [TOOLCHANGE_REGEX, START_TEMPCHANGE_REGEX, FINAL_TOOLCHANGE_REGEX, PROGRESS_REGEX]:
+        re.compile(pattern)
+    for pattern in [TOOLCHANGE_REGEX, PROGRESS_REGEX]:
+        re.compile(pattern, re.MULTILINE)
+
+
+def watch_process(fileinfo, directory, path):
+    """
+    Moves a file that arrived in a watched directory to the output directory and
+    processes it there.  Files that fail are moved on to a failed folder, along with
+    their log.
+    :param fileinfo: FileInfo object holding the watch arguments
+    :param directory: watched directory the file arrived in
+    :param path: path of the file
+    :return: None
+    """
+    if not os.path.isfile(path):  # reported twice, and already handled
+        return
+    output_dir = fileinfo.output_dir or os.path.join(directory, WATCH_OUTPUT_DIR)
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    destination = os.path.join(output_dir, os.path.basename(path))
+    move_file(path, destination)
+    result = batch_process((destination, current_log().level, fileinfo.task_args()))
+    if result["status"] == "failed":
+        failed_dir = os.path.join(output_dir, WATCH_FAILED_DIR)
+        if not os.path.isdir(failed_dir):
+            os.makedirs(failed_dir)
+        destination = os.path.join(failed_dir, os.path.basename(path))
+        move_file(os.path.join(output_dir, os.path.basename(path)), destination)
+        with open(destination + ".log", "w") as logfile:
+            logfile.write(result["log"])
+    lprint("  " + result["status"].ljust(8) + destination + " (" + result["message"] + ", " +
+           str(result["seconds"]) + "s)")
+
+
+def watch_main(fileinfo):
+    """
+    Long running mode that processes gcode files as they are dropped into the
+    watched directories.  Files are handled one at a time in this process, which
+    stays warm between files.
+    :param fileinfo: FileInfo object holding the watch arguments
+    :return: None
+    """
+    compile_patterns()
+    watcher = None
+    if not fileinfo.poll:
+        try:
+            watcher = InotifyWatcher(fileinfo.watch_dirs)
+        except (AttributeError, OSError) as e:  # not linux, or out of watches
+            lprint("inotify unavailable (" + str(e) + "), scanning every " +
+                   str(WATCH_POLL_INTERVAL) + "s instead.")
+    if watcher is None:
+        watcher = PollingWatcher(fileinfo.watch_dirs)
+    lprint("Waiting for files.  Press ctrl-c to stop.")
+    try:
+        while True:
+            for directory, path in watcher.wait():
+                watch_process(fileinfo, directory, path)
+    except KeyboardInterrupt:
+        lprint("Stopped watching.")
+
+
+# ANALYSIS CACHE *************************************************************
+def hash_file(file_name, overrides=()):
+    """
+    :param file_name: path of the input
+    :param overrides: list of the setting overrides the file is processed with
+    :return: string: hex digest of the file's contents, the overrides, this version of the
+             script and the cache format, so that entries made by other versions never match
+    """
+    hasher = hashlib.sha1(encode_gcode(VERSION + "\0" + str(CACHE_FORMAT) + "\0" +
+                                       json.dumps(list(overrides)) + "\0"))
+    return hash_contents(file_name, hasher)
+
+
+def hash_contents(file_name, hasher=None):
+    """
+    :param file_name: path of a file
+    :param hasher: hashlib object to add the contents to.  Defaults to a new sha1
+    :return: string: hex digest of everything given to hasher
+    """
+    if hasher is None:
+        hasher = hashlib.sha1()
+    with open(file_name, "rb") as f:
+        chunk = f.read(HASH_CHUNK_SIZE)
+        while chunk:
+            hasher.update(chunk)
+            chunk = f.read(HASH_CHUNK_SIZE)
+    return hasher.hexdigest()
+
+
+def native_strings(value):
+    """
+    json gives unicode strings on python 2, which would show up as u'..' in the header.
+    :param value: value loaded from json
+    :return: value with its strings converted to native strings
+    """
+    if isinstance(value, dict):
+        return dict((native_strings(k), native_strings(v)) for k, v in value.items())
+    if isinstance(value, list):
+        return [native_strings(item) for item in value]
+    if str is bytes and isinstance(value, type(u"")):
+        return value.encode(GCODE_ENCODING)
+    return value
+
+
+class AnalysisCache():
+    """
+    Directory of the results of analysing input files, keyed by hash_file.  A file that
+    was analysed before goes straight to the output stage.  Entries are compressed json;
+    each hit refreshes the entry's modification time, and the least recently used
+    entries are removed once the directory grows past max_bytes.
+    """
+
+    def __init__(self, directory, max_bytes=CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def path(self, key):
+        return os.path.join(self.directory, key + CACHE_EXTENSION)
+
+    def load(self, key):
+        """
+        :param key: string from hash_file
+        :return: dict stored under key, or None
+        """
+        path = self.path(key)
+        try:
+            with open(path, "rb") as f:
+                entry = native_strings(json.loads(zlib.decompress(f.read()).decode("ascii")))
+            os.utime(path, None)
+        except (IOError, OSError):
+            return None
+        except (ValueError, zlib.error):  # damaged entry
+            lprint("Discarding unreadable cache entry " + path, False, loglevel=LOG_WARNING)
+            self.remove(path)
+            return None
+        if entry.get("format") != CACHE_FORMAT:
+            return None
+        return entry
+
+    def store(self, key, entry):
+        """
+        Writes an entry atomically, so that concurrent runs never read half of one.
+        :param key: string from hash_file
+        :param entry: dict that json can serialize
+        :return: None
+        """
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        data = zlib.compress(json.dumps(entry, sort_keys=True).encode("ascii"), 1)
+        handle, temp_path = tempfile.mkstemp(prefix=key, suffix=".tmp", dir=self.directory)
+        try:
+            write_all(handle, data)
+        finally:
+            os.close(handle)
+        replace_file(temp_path, self.path(key))
+        self.evict()
+
+    def remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:  # already removed by a concurrent run
+            pass
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the cache fits in max_bytes.
+        :return: None
+        """
+        entries = []
+        total = 0
+        for name in os.listdir(self.directory):
+            if not name.endswith(CACHE_EXTENSION):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                info = os.stat(path)
+            except OSError:
+                continue
+            entries.append((info.st_mtime, info.st_size, path))
+            total += info.st_size
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            self.remove(path)
+            total -= size
+
+
+def load_analysis(d):
+    """
+    Looks the input up in the analysis cache and, on a hit, restores everything the
+    output stage needs into d.
+    :param d: SetupData object
+    :return: None.  d.analysis_cached says whether the analysis was found.
+    """
+    d.cache_key = hash_file(d.fileinfo.file_to_process, d.overrides)
+    entry = d.cache.load(d.cache_key)
+    if entry is None:
+        lprint("Analysis not cached, key " + d.cache_key, False)
+        return
+    restore_analysis(d, entry)
+    lprint("Reusing cached analysis " + d.cache_key + ": " + str(d.dips_inserted) + " dips, " +
+           str(d.temp_drops_inserted) + " temperature changes")
+
+
+def restore_analysis(d, entry):
+    """
+    :param d: SetupData object
+    :param entry: dict made by analysis_entry
+    :return: None
+    """
+    d.configured_tools = entry["configured_tools"]
+    d.tool_count = entry["tool_count"]
+    d.utool_settings = entry["config_settings"]
+    d.tool_settings = entry["tool_settings"]
+    d.auto_insertion_distance = entry["auto_insertion_distance"]
+    d.notices = entry["notices"]
+    d.dips_inserted = entry["dips_inserted"]
+    d.temp_drops_inserted = entry["temp_drops_inserted"]
+    d.added_seconds = entry["added_seconds"]
+    d.progress_corrected = entry["progress_corrected"]
+    d.stream_size = entry["size"]
+    d.timeline = ToolTimeline(entry["size"])
+    for position, line_number, tool in entry["timeline"]:
+        d.timeline.append(position, line_number, tool)
+    d.timeline.final_position = entry["final_position"]
+    payloads = [encode_gcode(payload) for payload in entry["payloads"]]
+    for line_number, priority, payload in entry["plan"]:
+        d.insertion_plan.add_payload(line_number, priority, payloads[payload])
+    d.insertion_plan.sort()
+    d.line_positions = dict(entry["line_positions"])
+    d.analysis_cached = True
+
+
+def store_analysis(d):
+    """
+    Saves the results of the analysis stages in the analysis cache.  A cache that can't
+    be written is reported but doesn't stop the run.
+    :param d: SetupData object
+    :return: None
+    """
+    if d.cache is None:
+        return
+    try:
+        d.cache.store(d.cache_key, analysis_entry(d))
+    except (IOError, OSError, ValueError, UnicodeError) as e:
+        lprint("Analysis not cached: " + str(e), loglevel=LOG_WARNING)
+
+
+def analysis_entry(d):
+    """
+    Collects the results of the analysis stages: everything the output stage needs to
+    write the output, with the insertions by line and the lines by char position.
+    :param d: SetupData object
+    :return: dict that json can serialize
+    """
+    payloads = {}  # number of each distinct payload
+    plan = [[line_number, priority, payloads.setdefault(gcode, len(payloads))]
+            for line_number, priority, sequence, gcode in d.insertion_plan]
+    return {"format": CACHE_FORMAT,
+             "version": VERSION,
+             "size": d.stream_size if d.stream_size is not None else len(d.gcode_str),
+             "configured_tools": d.configured_tools,
+             "tool_count": d.tool_count,
+             "config_settings": d.utool_settings,
+             "tool_settings": d.tool_settings,
+             "auto_insertion_distance": d.auto_insertion_distance,
+             "notices": d.notices,
+             "dips_inserted": d.dips_inserted,
+             "temp_drops_inserted": d.temp_drops_inserted,
+             "added_seconds": d.added_seconds,
+             "progress_corrected": d.progress_corrected,
+             "timeline": [[position, line_number, tool] for line_number, position, tool in
+                          zip(d.timeline.lines, d.timeline.positions, d.timeline.tools)],
+             "final_position": d.timeline.final_position,
+             "payloads": [decode_gcode(payload) for payload in sorted(payloads, key=payloads.get)],
+             "plan": plan,
+             "line_positions": sorted(d.line_positions.items())}
+
+
+# INSERTION PLAN FILES *******************************************************
+def write_plan(d):
+    """
+    Saves the analysis to d.fileinfo.plan_file in place of the output, for --apply to
+    write into the input later, on this machine or another.  The plan holds every
+    insertion by line number and payload, the tool settings and a hash of the input.
+    :param d: SetupData object
+    :return: None
+    """
+    plan = {"format": PLAN_FORMAT,
+            "version": VERSION,
+            "input": d.fileinfo.inputfull,
+            "input_hash": hash_contents(d.fileinfo.file_to_process),
+            "analysis": analysis_entry(d)}
+    data = json.dumps(plan, sort_keys=True, separators=(",", ":")).encode("ascii")
+    temp_path = d.fileinfo.plan_file + ".tmp"
+    handle = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | O_BINARY, 0o666)
+    try:
+        write_all(handle, data)
+    finally:
+        os.close(handle)
+    replace_file(temp_path, d.fileinfo.plan_file)
+    lprint("Insertion plan written to " + d.fileinfo.plan_file + ": " + str(d.dips_inserted) + " dips, " +
+           str(d.temp_drops_inserted) + " temperature changes")
+
+
+def load_plan(d):
+    """
+    Reads the plan that --plan saved for the input into d, in place of the analysis
+    stages.  A plan made from different gcode, or by an incompatible version of this
+    script, is refused.
+    :param d: SetupData object
+    :return: None
+    """
+    try:
+        with open(d.fileinfo.apply_file, "rb") as f:
+            plan = native_strings(json.loads(f.read().decode("ascii")))
+    except (IOError, OSError) as e:
+        raise CustomError("Can't read the insertion plan: " + str(e))
+    except (ValueError, UnicodeError):
+        raise CustomError("Insertion plan " + d.fileinfo.apply_file + " is damaged.")
+    if plan.get("format") != PLAN_FORMAT or plan["analysis"].get("format") != CACHE_FORMAT:
+        raise CustomError("Insertion plan " + d.fileinfo.apply_file + " was made by an incompatible " +
+                          "version of this script (" + str(plan.get("version")) + ").  Run --plan again.")
+    if plan["input_hash"] != hash_contents(d.fileinfo.file_to_process):
+        raise CustomError("Insertion plan " + d.fileinfo.apply_file + " was made for different gcode (" +
+                          str(plan.get("input")) + ").  Run --plan again.")
+    restore_analysis(d, plan["analysis"])
+    lprint("Applying insertion plan " + d.fileinfo.apply_file + ": " + str(d.dips_inserted) + " dips, " +
+           str(d.temp_drops_inserted) + " temperature changes")
+
+
+# PROFILING ******************************************************************
+def clock():
+    return time.perf_counter() if hasattr(time, "perf_counter") else time.time()
+
+
+def cpu_time():
+    times = os.times()
+    return times[0] + times[1]
+
+
+class CountingPattern():
+    """
+    Compiled pattern that reports its calls and matches to a RegexCounter.
+    """
+
+    def __init__(self, counter, compiled, pattern):
+        self.counter = counter
+        self.compiled = compiled
+        self.pattern = pattern
+
+    def __getattr__(self, name):
+        return getattr(self.compiled, name)
+
+    def search(self, *args):
+        return self.counter.timed(self.pattern, self.compiled.search, args)
+
+    def match(self, *args):
+        return self.counter.timed(self.pattern, self.compiled.match, args)
+
+    def finditer(self, *args):
+        return self.counter.timed_iter(self.pattern, self.compiled.finditer, args)
+
+
+class RegexCounter():
+    """
+    Stands in for the re module as d.regex of a profiled run, so that only that run's
+    regular expressions are counted.  Counts the calls, matches and time spent for each
+    pattern, by the name of the constant that holds it.
+    """
+
+    def __init__(self, module):
+        self.module = module
+        self.counts = {}  # pattern name: {"calls": n, "matches": n, "seconds": s}
+        self.names = {}
+        for name, value in globals().items():
+            if name.endswith("_REGEX") and isinstance(value, bytes):
+                self.names[value] = name
+
+    def __getattr__(self, name):
+        return getattr(self.module, name)
+
+    def tally(self, pattern):
+        name = self.names.get(pattern, repr(pattern)[:60])
+        if name not in self.counts:
+            self.counts[name] = {"calls": 0, "matches": 0, "seconds": 0.0}
+        return self.counts[name]
+
+    def timed(self, pattern, function, args):
+        tally = self.tally(pattern)
+        started = clock()
+        match = function(*args)
+        tally["seconds"] += clock() - started
+        tally["calls"] += 1
+        if match is not None:
+            tally["matches"] += 1
+        return match
+
+    def timed_iter(self, pattern, function, args):
+        tally = self.tally(pattern)
+        tally["calls"] += 1
+        started = clock()
+        matches = function(*args)
+        while True:
+            try:
+                match = next(matches)
+            except StopIteration:
+                break
+            finally:
+                tally["seconds"] += clock() - started
+            tally["matches"] += 1
+            yield match
+            started = clock()
+
+    def search(self, pattern, string, flags=0):
+        return self.timed(pattern, self.module.search, (pattern, string, flags))
+
+    def match(self, pattern, string, flags=0):
+        return self.timed(pattern, self.module.match, (pattern, string, flags))
+
+    def finditer(self, pattern, string, flags=0):
+        return self.timed_iter(pattern, self.module.finditer, (pattern, string, flags))
+
+    def compile(self, pattern, flags=0):
+        return CountingPattern(self, self.module.compile(pattern, flags), pattern)
+
+
+class HandlerCounter():
+    """
+    Set as d.handler_counter of a profiled run.  Counts the calls and time spent in each
+    handler of the line scanner, and in each function it is given to call later, by the
+    name of the function.
+    """
+
+    def __init__(self):
+        self.counts = {}  # function name: {"calls": n, "seconds": s}
+
+    def timed(self, function):
+        """
+        :param function: handler, or function given to LineScanner.after
+        :return: function that does the same and adds to its tally
+        """
+        name = function.__name__
+        if name not in self.counts:
+            self.counts[name] = {"calls": 0, "seconds": 0.0}
+        tally = self.counts[name]
+
+        def counted(*args):
+            started = clock()
+            try:
+                return function(*args)
+            finally:
+                tally["seconds"] += clock() - started
+                tally["calls"] += 1
+        return counted
+
+
+class Profiler():
+    """
+    Opt-in instrumentation for run_pipeline.  Records the wall time, CPU time and
+    (where tracemalloc is available) memory allocated by each stage, counts the use of
+    every regular expression of the run, and times each handler of the line scanner.  Optionally records a cProfile of the whole run.
+    Usage:
+        profiler = Profiler(cprofile_file="run.prof")
+        run_pipeline(d, profiler)
+        profiler.write_report("profile.json")
+    """
+
+    def __init__(self, trace_memory=True, cprofile_file=None, count_regex=True, count_handlers=True):
+        self.trace_memory = trace_memory and tracemalloc is not None
+        self.cprofile_file = cprofile_file
+        self.count_regex = count_regex
+        self.count_handlers = count_handlers
+        self.cprofile = None
+        self.regex = None
+        self.handlers = None
+        self.stages = []
+        self.started = None
+        self.total = {}
+
+    def start(self, d):
+        """
+        :param d: SetupData object of the run, whose regular expressions and scan handlers are counted
+        """
+        if self.count_regex:
+            self.regex = RegexCounter(d.regex)
+            d.regex = self.regex
+        if self.count_handlers:
+            self.handlers = HandlerCounter()
+            d.handler_counter = self.handlers
+        if self.trace_memory:
+            tracemalloc.start()
+        if self.cprofile_file is not None:
+            import cProfile
+            self.cprofile = cProfile.Profile()
+            self.cprofile.enable()
+        self.started = (clock(), cpu_time())
+
+    def stop(self, d):
+        self.total = {"wall_s": clock() - self.started[0], "cpu_s": cpu_time() - self.started[1]}
+        if self.cprofile is not None:
+            self.cprofile.disable()
+            self.cprofile.dump_stats(self.cprofile_file)
+        if self.trace_memory:
+            self.total["peak_bytes"] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        if self.regex is not None:
+            d.regex = self.regex.module
+        d.handler_counter = None
+
+    def run_stage(self, name, stage, d):
+        """
+        Runs one stage of the pipeline and records what it cost.
+        :param name: stage name
+        :param stage: function of d
+        :param d: SetupData object
+        :return: None
+        """
+        record = {"name": name}
+        if self.trace_memory:
+            if hasattr(tracemalloc, "reset_peak"):
+                tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+        wall = clock()
+        cpu = cpu_time()
+        try:
+            stage(d)
+        finally:
+            record["wall_s"] = clock() - wall
+            record["cpu_s"] = cpu_time() - cpu
+            if self.trace_memory:
+                current, peak = tracemalloc.get_traced_memory()
+                record["peak_bytes"] = peak - before
+                record["allocated_bytes"] = current - before
+            self.stages.append(record)
+
+    def report(self):
+        """
+        :return: dict of the measurements, ready to be written as JSON
+        """
+        return {"skinnydip_version": VERSION,
+                "python": sys.version.split()[0],
+                "memory_traced": self.trace_memory,
+                "total": self.total,
+                "stages": self.stages,
+                "regex": self.regex.counts if self.regex is not None else {},
+                "scan_handlers": self.handlers.counts if self.handlers is not None else {}}
+
+    def write_report(self, filename):
+        with open(filename, "w") as report:
+            json.dump(self.report(), report, indent=2, sort_keys=True)
+            report.write("\n")
+
+
 # MAIN PROGRAM****************************************************************
+def open_input(d):
+    d.open_target_file()
+    d.check_target_file()
+
+
+def strip_insertions(d):
+    """
+    Works out the segments of the original gcode of a processed file.  They are written
+    by SetupData.write_stream_output.
+    :param d: SetupData object
+    :return: None
+    """
+    d.output_segments, d.insertions_stripped = original_segments(d.gcode_str)
+    lprint("  Stripping the header and " + str(d.insertions_stripped) + " insertions")
+
+
+def stream_strip_insertions(d):
+    """
+    Writes the original gcode of a processed gzip or binary gcode input over it.
+    :param d: SetupData object
+    :return: None
+    """
+    if not gcode_is_processed(d.fileinfo.file_to_process, d.fileinfo.file_format):
+        raise CustomError("File was not processed by this script.  Nothing to strip.")
+    d.insertions_stripped = d.fileinfo.write_encoded_output(None).insertions
+    lprint("  Stripped the header and " + str(d.insertions_stripped) + " insertions")
+
+
+# Stages that every engine runs between the scan of its input and its output:
+# (name, progress message, function of d)
+ANALYSIS_STAGES = [
+    ("get_slicer_settings", "Reading slicer settings from the end of the file...", get_slicer_settings),
+    ("get_extruder_settings", "Looking up extruder settings", get_extruder_settings),
+    ("auto_calculate_insertion_distance", None, auto_calculate_insertion_distance),
+    ("get_settings", "Reading configuration parameters...", get_settings),
+    ("clean_settings", "Validating User Settings...", clean_settings),
+    ("compile_templates", "Compiling insertion gcode...", compile_templates),
+    ("get_insertion_points", "Planning skinnydip, wait for temperature, and temperature " +
+                             "restore gcode...", get_insertion_points),
+    ("get_temperature_change_positions", "Planning initial temperature change gcode...",
+     get_temperature_change_positions),
+    ("plan_progress_updates", "Estimating the print time added...", plan_progress_updates),
+    ("prepare_insertions", "Compiling final insertion list...", prepare_insertions),
+    ("store_analysis", None, store_analysis),
+]
+
+# Stages of the whole-file engine
+PIPELINE_STAGES = [
+    ("open_input", None, open_input),
+    ("scan_input", "Scanning gcode in a single pass...", scan_input),
+] + ANALYSIS_STAGES + [
+    ("assemble_final_output", "Preparing to build output file", assemble_final_output),
+    ("write_output", None, SetupData.write_output_segments),
+]
+
+# Stages of the whole-file engine with the scan done in chunks on several cores.
+# parallel_scan finds what the line scanner would, with searches of each chunk.
+PARALLEL_STAGES = [
+    ("open_input", None, open_input),
+    ("parallel_scan", "Scanning gcode in parallel...", parallel_scan),
+] + ANALYSIS_STAGES + [
+    ("assemble_final_output", "Preparing to build output file", assemble_final_output),
+    ("write_output", None, SetupData.write_output_segments),
+]
+
+# Stages of the constant-memory streaming engine.  The input is analysed in one
+# forward pass, then copied to the output in a second sequential pass with the
+# insertions spliced in.  The insertions can't be written during the first pass
+# because they depend on slicer settings that sit at the end of the file, and the
+# header has to come first.  Memory use grows with the number of toolchanges, not
+# with the size of the file.
+STREAM_STAGES = [
+    ("stream_read_input", "Scanning gcode in a single pass...", stream_read_input),
+] + ANALYSIS_STAGES + [
+    ("stream_output", "Preparing to build output file", stream_output),
+]
+
+
+# Stages that look the input up in the analysis cache, and the stages that remain
+# when it is found there.  Either engine's output can be built from a cached analysis;
+# gzip and binary gcode is written from it in a forward pass.
+CACHE_LOOKUP_STAGES = [
+    ("load_analysis", "Checking the analysis cache...", load_analysis),
+]
+CACHED_STAGES = [
+    ("open_input", None, open_input),
+    ("assemble_final_output", "Preparing to build output file", assemble_final_output),
+    ("write_output", None, SetupData.write_output_segments),
+]
+CACHED_STREAM_STAGES = [
+    ("stream_output", "Preparing to build output file", stream_output),
+]
+
+
+# Stages that give back the gcode that the slicer wrote, from a file this script processed.
+# Gzip and binary gcode is stripped in a single forward pass.
+UNPROCESS_STAGES = [
+    ("open_input", None, SetupData.open_target_file),
+    ("strip_insertions", "Stripping the insertions of a previous run...", strip_insertions),
+    ("write_output", None, SetupData.write_stream_output),
+]
+UNPROCESS_STREAM_STAGES = [
+    ("strip_insertions", "Stripping the insertions of a previous run...", stream_strip_insertions),
+]
+
+
+# Stage that replaces the output stages with --plan, and the stage that replaces the
+# analysis stages with --apply.  The output stages of a cached analysis follow it.
+PLAN_STAGES = [
+    ("write_plan", "Saving insertion plan...", write_plan),
+]
+APPLY_STAGES = [
+    ("load_plan", "Reading insertion plan...", load_plan),
+]
+
+
+def analysis_stages(stages):
+    """
+    :param stages: stage list of one of the engines
+    :return: the stages of the list up to the end of the analysis
+    """
+    names = [name for name, message, stage in stages]
+    return stages[:names.index("store_analysis") + 1]
+
+
+def run_stages(d, stages, profiler=None):
+    """
+    :param d: SetupData object
+    :param stages: list of (name, progress message, function of d)
+    :param profiler: Profiler to measure the stages with, or None
+    :return: None - the wall time of each stage is added to d.stage_seconds
+    """
+    for name, message, stage in stages:
+        if message is not None:
+            lprint(message)
+        started = clock()
+        if profiler is not None:
+            profiler.run_stage(name, stage, d)
+        else:
+            stage(d)
+        d.stage_seconds.append((name, clock() - started))
+
+
+def run_pipeline(d, profiler=None):
+    """
+    Runs every stage of post processing on the input described by d.fileinfo and
+    replaces it with the output.  With fileinfo.unprocess, the output is the original
+    gcode of a processed input instead.  With fileinfo.plan_file, the analysis is saved
+    there and nothing else is written; with fileinfo.apply_file, the analysis is read
+    from there.
+    :param d: SetupData object
+    :param profiler: Profiler to measure the stages with, or None
+    :return: None
+    """
+    stages = PARALLEL_STAGES if d.fileinfo.parallel else PIPELINE_STAGES
+    if d.fileinfo.stream:
+        stages = STREAM_STAGES
+    output_stages = CACHED_STAGES if d.fileinfo.file_format == GCODE_FORMAT else CACHED_STREAM_STAGES
+    if d.fileinfo.plan_file is not None:
+        stages = analysis_stages(stages) + PLAN_STAGES
+    if d.fileinfo.apply_file is not None:
+        stages = APPLY_STAGES + output_stages
+    if d.fileinfo.unprocess:
+        stages = UNPROCESS_STAGES if d.fileinfo.file_format == GCODE_FORMAT else UNPROCESS_STREAM_STAGES
+    if profiler is not None:
+        profiler.start(d)
+    try:
+        if d.cache is not None:
+            run_stages(d, CACHE_LOOKUP_STAGES, profiler)
+            if d.analysis_cached:
+                stages = PLAN_STAGES if d.fileinfo.plan_file is not None else output_stages
+        run_stages(d, stages, profiler)
+    finally:
+        if profiler is not None:
+            profiler.stop(d)
+
+
+# LIBRARY API ****************************************************************
+class Result():
+    """
+    What process() did to one input.
+    """
+
+    def __init__(self, d, seconds):
+        """
+        :param d: SetupData object of the run
+        :param seconds: float: wall time of the whole run
+        """
+        self.dips_inserted = getattr(d, "dips_inserted", 0)
+        self.temp_drops_inserted = getattr(d, "temp_drops_inserted", 0)
+        self.insertions_stripped = d.insertions_stripped
+        self.toolchanges = d.timeline.total()
+        self.tool_count = d.tool_count
+        self.configured_tools = tool_names(d.configured_tools)
+        self.added_seconds = d.added_seconds
+        self.progress_corrected = d.progress_corrected
+        self.notices = [notice.strip() for notice in d.notices]
+        self.plan = [(line_number, priority, decode_gcode(gcode))
+                     for line_number, priority, sequence, gcode in d.insertion_plan]
+        self.analysis_cached = d.analysis_cached
+        self.timings = list(d.stage_seconds)  # (stage name, seconds)
+        self.seconds = seconds
+        self.log = current_log().tail()
+
+    def __repr__(self):
+        return "<Result " + str(self.dips_inserted) + " dips, " + str(self.temp_drops_inserted) + \
+               " temperature changes, " + str(self.insertions_stripped) + " insertions stripped>"
+
+
+def is_path(value):
+    """
+    :return: True if value names a file, rather than holding gcode or being a file object.
+             On python 2 paths are bytes too, and are told from gcode by having no linebreak.
+    """
+    if isinstance(value, bytes):
+        return bytes is str and b"\n" not in value
+    return isinstance(value, type(u"")) or hasattr(value, "__fspath__")
+
+
+def copy_source(source, path):
+    """
+    Writes the input handed to process() to path.
+    :param source: path, binary file object, or bytes-like object holding gcode
+    :param path: path of the file to write
+    :return: None
+    """
+    if is_path(source):
+        shutil.copyfile(source, path)
+        return
+    with open(path, "wb") as f:
+        if hasattr(source, "read"):
+            shutil.copyfileobj(source, f, COPY_CHUNK_SIZE)
+        else:
+            f.write(source)
+
+
+def copy_to_sink(path, sink):
+    """
+    :param path: path of the finished output
+    :param sink: binary file object to write it to, or bytearray to extend with it
+    :return: None
+    """
+    with open(path, "rb") as f:
+        if isinstance(sink, bytearray):
+            for data in iter(lambda: f.read(COPY_CHUNK_SIZE), b""):
+                sink.extend(data)
+        else:
+            shutil.copyfileobj(f, sink, COPY_CHUNK_SIZE)
+
+
+def process(source, sink, settings_overrides=None, stream=False, parallel=False, jobs=None,
+            cache_dir=None, reprocess=False, unprocess=False, log_level=None, log_file=None,
+            console=None):
+    """
+    Post processes one gcode file in the calling process and thread, for use as a library.
+    Nothing is read from the command line and nothing exits; errors are raised as
+    CustomError.  Each call keeps its own state and log, so calls on different threads
+    can run at the same time.  Binary and gzipped gcode are recognised as on the command
+    line.
+    Usage:
+        result = skinnydip.process("in.gcode", "out.gcode", {"T1.insertion_distance": 40})
+    :param source: path of the input, a binary file object to read it from, or bytes
+    :param sink: path to write the output to (the input's own path processes it in place),
+                 a binary file object to write it to, or a bytearray to extend with it
+    :param settings_overrides: dict of "[TOOL.]SETTING" to value, or list of
+                               "[TOOL.]SETTING=VALUE" strings, as for --set
+    :param stream, parallel, jobs, reprocess, unprocess: as the command line options
+    :param cache_dir: directory of the analysis cache, or None to analyse every input
+    :param log_level: name of the lowest level to log, or None for info
+    :param log_file: path to write the log to as well, or None to keep it in memory only
+    :param console: stream to display progress messages on, or None for no messages
+    :return: Result
+    """
+    if settings_overrides is None:
+        settings_overrides = []
+    if hasattr(settings_overrides, "items"):
+        settings_overrides = [str(name) + "=" + str(value)
+                              for name, value in sorted(settings_overrides.items())]
+    overrides = [parse_setting_override(text) for text in settings_overrides]
+    previous_log = start_log(LOG_LEVELS[log_level] if log_level is not None else LOG_INFO)
+    previous_console = set_log_console(console)
+    workdir = None
+    started = clock()
+    try:
+        if is_path(source):
+            input_name = os.path.realpath(source)
+        else:
+            input_name = getattr(source, "name", None)
+            if not isinstance(input_name, str):
+                input_name = "<stream>" if hasattr(source, "read") else "<buffer>"
+        if is_path(sink):
+            target = os.path.realpath(sink)
+            if target != input_name:
+                copy_source(source, target)
+        else:
+            workdir = tempfile.mkdtemp(prefix="skinnydip")
+            target = os.path.join(workdir, "input.gcode")
+            copy_source(source, target)
+        d = SetupData(target, stream=stream, parallel=parallel, jobs=jobs, cache_dir=cache_dir,
+                      reprocess=reprocess, unprocess=unprocess, overrides=overrides, input_name=input_name)
+        if log_file is not None:
+            d.fileinfo.log_file_name = os.path.realpath(log_file)
+            d.open_log_file()
+        run_pipeline(d)
+        if workdir is not None:
+            copy_to_sink(target, sink)
+        return Result(d, clock() - started)
+    finally:
+        restore_log(previous_log)
+        set_log_console(previous_console)
+        if workdir is not None:
+            shutil.rmtree(workdir, True)
+
+
 def main(target_file=None):
     """
     Primary loop of program.
     :param target_file: file name of input file.
-    :return:
+    :return: int: exit status
     """
-    lprint("Skinnydip MMU2 String Eliminator v" + VERSION)
     d = SetupData(target_file)
+    lprint("Skinnydip MMU2 String Eliminator v" + VERSION)
+    d.open_log_file()
+    if d.fileinfo.batch:
+        failures = batch_main(d.fileinfo)
+        d.write_log_file()
+        return 1 if failures else 0
+    if d.fileinfo.watch:
+        watch_main(d.fileinfo)
+        d.write_log_file()
+        return 0
     # try:
-    d.open_target_file()
-    d.check_target_file()
-    d.init_log_file("skinnydip.log")
-    lprint("Looking up extruder settings")
-    get_extruder_settings(d)
-    auto_calculate_insertion_distance(d)
-    lprint("Indexing linebreaks")
-    index_linebreaks(d)
-    lprint("Indexing toolchanges...")
-    index_toolchanges(d)
-    lprint("Scanning gcode for configuration parameters...")
-    get_settings(d)
-    lprint("Validating User Settings...")
-    clean_settings(d)
-    lprint("Searching for skinnydip, wait for temperature, and temperature restore gcode injection locations...")
-    get_insertion_points(d)
-    lprint("Searching for initial temperature change gcode injection locations...")
-    get_temperature_change_positions(d)
-    lprint("Compiling final insertion list...")
-    prepare_insertions(d)
-    d.close_target_file()
-    lprint("Preparing to build output file")
-    d.open_target_file_lines()
-    assemble_final_output(d)
-    d.write_output_file_lines()
+    profiler = None
+    if d.fileinfo.profile_file is not None:
+        profiler = Profiler(cprofile_file=d.fileinfo.cprofile_file)
+    run_pipeline(d, profiler)
+    if profiler is not None:
+        profiler.write_report(d.fileinfo.profile_file)
+        lprint("Profile written to " + d.fileinfo.profile_file)
     d.write_log_file()
     lprint("Post processing complete.  Exiting...")
-    exit(0)
+    return 0
 
     # These error handlers provide tidy error messages, but they are making bugs hard to track.
     # they are being disabled until this script comes out of beta
     """
-    except Exception, e:
+    except Exception as e:
         exc_type, exc_obj, exc_tb = sys.exc_info()
         fname = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
         d.write_log_file()
@@ -1123,12 +4928,12 @@ def main(target_file=None):
 if __name__ == "__main__":
     target_file = None
     try:
-        if TEST_FILE is not None:
+        if TEST_FILE:
             shutil.copyfile(RESOURCE_PATH + TEST_FILE, PROJECT_PATH + TEST_FILE)
             target_file = PROJECT_PATH + TEST_FILE
     except:
         pass
-    main(target_file)
+    sys.exit(main(target_file))
 
 
 
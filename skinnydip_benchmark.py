@@ -0,0 +1,441 @@
+#!/usr/bin/python
+# coding=utf8
+"""
+Skinnydip benchmark suite
+Generates deterministic, synthetic PrusaSlicer style MMU gcode and measures the time
+and memory that every stage of skinnydip.py takes to process it.  Results are written
+as JSON so that scaling curves can be compared from one release to the next.
+
+    python skinnydip_benchmark.py generate synthetic.gcode --size 50M --thumbnail 220x124
+    python skinnydip_benchmark.py run --sizes 1M,10M,100M,1G --output results.json
+
+GNU PUBLIC LICENSE:  see skinnydip.py
+"""
+
+#  MODULES  ************************************************
+from __future__ import print_function
+import argparse
+import base64
+import json
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import skinnydip
+try:
+    import resource
+except ImportError:  # windows
+    resource = None
+
+
+#  CONSTANTS ************************************************
+BENCHMARK_VERSION = 2  # bump when the generated gcode or the JSON layout changes
+
+SIZE_UNITS = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+DEFAULT_SIZES = "1M,10M,100M"
+DEFAULT_TOOLCHANGE_SPACING = 20000  # bytes of print moves between two toolchanges
+DEFAULT_TOOLS = 5
+DEFAULT_COOLING_MOVES = 4
+DEFAULT_ENGINES = "classic,stream"
+DEFAULT_REPEAT = 3
+
+TOOL_TEMPERATURES = [215, 240, 215, 220, 230]  # cycled for tools beyond T4
+MOVE_POOL_LINES = 4096  # distinct print moves, repeated to fill the file
+PROGRESS_CHANCE = 0.3  # chance of an M73 progress line at each point the slicer may put one
+TOOLCHANGE_ESTIMATE = 1500  # bytes in a toolchange block, until the real average is known
+THUMBNAIL_LINE = 78  # base64 chars per thumbnail line
+
+# Slicer settings at the end of the file.  skinnydip reads these as integers.
+SLICER_SETTINGS = [("cooling_tube_length", 20), ("cooling_tube_retraction", 40),
+                   ("extra_loading_move", -2), ("parking_pos_retraction", 92)]
+
+ENGINES = {"classic": False, "stream": True}  # engine name: SetupData stream option
+
+
+# GENERATOR ******************************************************************
+class GcodeWriter():
+    """
+    Wraps the output file and counts what has been written, so the generator can
+    spread the print moves to reach the requested size.
+    """
+
+    def __init__(self, f):
+        self.f = f
+        self.written = 0
+
+    def write(self, text):
+        self.f.write(text.encode("ascii"))
+        self.written += len(text)
+
+
+def parse_size(text):
+    """
+    :param text: size such as 500K, 10M, 2.5G or a plain number of bytes
+    :return: int: bytes
+    """
+    text = text.strip().upper().rstrip("B")
+    if text and text[-1] in SIZE_UNITS:
+        return int(float(text[:-1]) * SIZE_UNITS[text[-1]])
+    return int(text)
+
+
+def pick(rng, n):
+    """
+    :return: a random int in range(n).  Unlike randrange, it is the same on python 2 and 3.
+    """
+    return int(rng.random() * n)
+
+
+def tool_temperature(tool):
+    return TOOL_TEMPERATURES[tool % len(TOOL_TEMPERATURES)]
+
+
+def make_move_pool(rng):
+    """
+    Builds the print moves that fill the space between toolchanges.  The same pool is
+    repeated through the file, which keeps generation fast enough for files of several GB.
+    :param rng: random.Random
+    :return: string of MOVE_POOL_LINES lines
+    """
+    lines = []
+    for i in range(MOVE_POOL_LINES):
+        lines.append("G1 X%.3f Y%.3f E%.5f\n" % (rng.uniform(50, 150), rng.uniform(50, 150),
+                                                  rng.uniform(0.01, 1)))
+    return "".join(lines)
+
+
+def write_moves(out, pool, state, size):
+    """
+    Writes print moves from the pool, continuing where the previous call stopped.
+    :param out: GcodeWriter
+    :param pool: string from make_move_pool
+    :param state: dict holding the position in the pool
+    :param size: int: bytes to write.  Rounded up to the end of a line.
+    :return: None
+    """
+    pos = state["pool_pos"]
+    while size > 0:
+        if size >= len(pool) - pos:
+            size -= len(pool) - pos
+            out.write(pool[pos:])
+            pos = 0
+        else:
+            end = pool.find("\n", pos + size - 1) + 1
+            out.write(pool[pos:end])
+            pos = end % len(pool)
+            size = 0
+    state["pool_pos"] = pos
+
+
+def config_block(tool):
+    """
+    :param tool: int: tool number
+    :return: string: filament start gcode holding a SKINNYDIP CONFIGURATION block.  The
+             values vary between tools so that every kind of setting is exercised.
+    """
+    return ("M900 K30 ; Filament gcode\n"
+            "; SKINNYDIP CONFIGURATION START\n"
+            "; material_type PLA\n"
+            "; material_name Spool %d\n"
+            "; insertion_speed 2000\n"
+            "; extraction_speed 4000\n"
+            "; insertion_pause %d\n"
+            "; insertion_distance %s\n"
+            "; removal_pause 0\n"
+            "; toolchange_temp %s\n"
+            "; beep_on_dip %s\n"
+            "; beep_on_temp off\n"
+            "; SKINNYDIP CONFIGURATION END\n" % (
+                tool, 0 if tool % 2 else 100, "auto" if tool % 5 == 2 else str(30 + tool % 10),
+                "off" if tool % 5 == 3 else str(tool_temperature(tool) - 15),
+                "on" if tool % 5 == 4 else "off"))
+
+
+def thumbnail_block(rng, dimensions):
+    """
+    :param rng: random.Random
+    :param dimensions: string such as 220x124
+    :return: string: PrusaSlicer thumbnail comment block with random image data
+    """
+    width, height = [int(n) for n in dimensions.lower().split("x")]
+    data = bytearray(pick(rng, 256) for i in range(max(1, width * height // 8)))
+    encoded = base64.b64encode(bytes(data)).decode("ascii")
+    lines = [";", "; thumbnail begin %dx%d %d" % (width, height, len(encoded))]
+    for i in range(0, len(encoded), THUMBNAIL_LINE):
+        lines.append("; " + encoded[i:i + THUMBNAIL_LINE])
+    lines += ["; thumbnail end", ";", ""]
+    return "\n".join(lines) + "\n"
+
+
+def toolchange_block(rng, number, old, new, cooling_moves, y, configured):
+    """
+    One wipe tower toolchange in the shape PrusaSlicer writes, which is the shape that
+    START_TEMPCHANGE_REGEX and INSERTIONS_REGEX look for.  The cooling move variants
+    (progress lines inside the unload, a temperature change or none) are picked by rng.
+    :return: string of gcode
+    """
+    lines = [";------------------", "; CP TOOLCHANGE START", "; toolchange #%d" % number,
+             "; material : PLA -> PLA", ";------------------", "M220 B", "M220 S100"]
+    if rng.random() < PROGRESS_CHANCE:
+        lines.append("M73 P%d R%d" % (number % 100, 50))
+    lines.append("; CP TOOLCHANGE UNLOAD")
+    for i in range(5):
+        lines.append("G1 X%.3f E%.4f F%d" % (170 + i, 0.5, 1200))
+    lines += ["G1 E-15.0000 F3000", "G1 E-24.5000 F4800"]
+    if rng.random() < PROGRESS_CHANCE:
+        lines.append("M73 P%d R%d" % (number % 100, 40))
+    lines += ["G1 E-7.0000 F2400", "G1 E-3.5000 F1440"]
+    if tool_temperature(new) != tool_temperature(old):
+        lines.append("M104 S%d" % tool_temperature(new))
+    lines.append("G1 X170.000 Y%.3f F2400" % y)
+    for i in range(cooling_moves):
+        lines.append("G1 X180.000 E20.0000 F%d" % (1000 + i * 50))
+        lines.append("G1 X170.000 E-20.0000 F%d" % (1100 + i * 50))
+    lines += ["G1 E-42.0000 F2000", "G4 S0", "T%d" % new, "G4 S0", "; CP TOOLCHANGE LOAD"]
+    for i in range(8):
+        lines.append("G1 X%.3f E%.4f F%d" % (170 + i, 5.0, 3000))
+    text = "\n".join(lines) + "\n"
+    text += config_block(new) if new in configured else "M900 K30 ; Filament gcode\n"
+    text += "; CP TOOLCHANGE WIPE\n"
+    for i in range(6):
+        text += "G1 X%.3f Y%.3f E%.4f F%d\n" % (170 + i, y, 0.5, 2000)
+    text += "; CP TOOLCHANGE END\n;------------------\nM220 R\n"
+    return text
+
+
+def final_unload_block(number, y):
+    """
+    The unload at the end of the print, in the shape FINAL_TOOLCHANGE_REGEX looks for.
+    """
+    return (";------------------\n; CP TOOLCHANGE START\n; toolchange #%d\n"
+            "M220 B\nM220 S100\n; CP TOOLCHANGE UNLOAD\n"
+            "G1 E-15.0000 F3000\nG1 E-24.5000 F4800\nG1 E-7.0000 F2400\nG1 E-3.5000 F1440\n"
+            "G1 X170.000 Y%.3f F2400\nG1 E-42.0000 F2000\nG1 X160.000 F3000\nG4 S0\nM220 R\n"
+            % (number, y))
+
+
+def slicer_settings_block(tools):
+    """
+    The settings PrusaSlicer lists at the end of the file, including the ones
+    skinnydip reads.
+    """
+    temperatures = ",".join(str(tool_temperature(tool)) for tool in range(tools))
+    lines = ["; filament used [mm] = 123.4", "", "; bed_temperature = " + ",".join(["60"] * tools)]
+    for name, value in SLICER_SETTINGS:
+        lines.append("; %s = %d" % (name, value))
+    lines += ["; first_layer_temperature = " + temperatures,
+              "; single_extruder_multi_material = 1",
+              "; temperature = " + temperatures,
+              "; wipe_tower = 1"]
+    return "\n".join(lines) + "\n"
+
+
+def generate_gcode(f, size, toolchanges=None, tools=DEFAULT_TOOLS, seed=1, configured=None,
+                   thumbnail=None, cooling_moves=DEFAULT_COOLING_MOVES):
+    """
+    Writes a synthetic MMU print.  The same arguments always produce the same file.
+    :param f: file object open for writing in binary mode
+    :param size: int: approximate size of the file in bytes
+    :param toolchanges: int: number of toolchanges.  Defaults to one per
+                        DEFAULT_TOOLCHANGE_SPACING bytes
+    :param tools: int: number of extruders
+    :param seed: int: seed for the choice of tools, variants and print moves
+    :param configured: list of the tool numbers that get a SKINNYDIP CONFIGURATION block.
+                       Defaults to all of them.
+    :param thumbnail: string such as 220x124 to include a thumbnail, or None
+    :param cooling_moves: int: number of cooling moves in each unload
+    :return: dict describing the file
+    """
+    rng = random.Random(seed)
+    if toolchanges is None:
+        toolchanges = max(1, size // DEFAULT_TOOLCHANGE_SPACING)
+    if configured is None:
+        configured = list(range(tools))
+    out = GcodeWriter(f)
+    pool = make_move_pool(rng)
+    state = {"pool_pos": 0}
+
+    out.write("; generated by PrusaSlicer 2.0.0+linux64 on 2019-05-29 at 21:05:14\n")
+    out.write(";\n; external perimeters extrusion width = 0.45mm\n\n")
+    if thumbnail:
+        out.write(thumbnail_block(rng, thumbnail))
+    out.write("M73 P0 R60\nM73 Q0 S61\nM201 X1000 Y1000 Z200 E5000\nM107\nG28 W\nG80\nT0\n")
+    out.write(config_block(0) if 0 in configured else "M900 K30 ; Filament gcode\n")
+    out.write("G21 ; set units to millimeters\nG90\nM83\n")
+
+    tail = final_unload_block(toolchanges + 1, 0) + "G1 Z10\nM84\nM73 P100 R0\nM73 Q100 S0\n" + \
+        slicer_settings_block(tools)
+    toolchange_bytes = 0
+    current = 0
+    y = 10.0
+    for number in range(1, toolchanges + 1):
+        average = toolchange_bytes // (number - 1) if number > 1 else TOOLCHANGE_ESTIMATE
+        remaining = size - out.written - len(tail) - average * (toolchanges - number + 1)
+        out.write("M73 P%d R%d\n" % (100 * number // (toolchanges + 1), 60 - 60 * number // (toolchanges + 1)))
+        write_moves(out, pool, state, remaining // (toolchanges - number + 2))
+        new = current
+        if tools > 1:
+            new = pick(rng, tools - 1)
+            new += 1 if new >= current else 0
+        block = toolchange_block(rng, number, current, new, cooling_moves, y, configured)
+        toolchange_bytes += len(block)
+        out.write(block)
+        current = new
+        y += 0.5
+    write_moves(out, pool, state, size - out.written - len(tail))
+    out.write(final_unload_block(toolchanges + 1, y) + "G1 Z10\nM84\nM73 P100 R0\nM73 Q100 S0\n" +
+              slicer_settings_block(tools))
+    return {"size_bytes": out.written, "requested_size": size, "toolchanges": toolchanges,
+            "tools": tools, "seed": seed, "configured": configured, "thumbnail": thumbnail,
+            "cooling_moves": cooling_moves}
+
+
+# BENCHMARK ******************************************************************
+def measure_stages(path, engine, trace_memory):
+    """
+    Processes a file one pipeline stage at a time and measures each stage.  Runs in a
+    fresh process, so that the peak resident memory belongs to this run alone.
+    :param path: path of the gcode file.  It is replaced by the output.
+    :param engine: key of ENGINES
+    :param trace_memory: bool: measure python allocations with tracemalloc.  This slows
+                         the stages down, so traced runs are kept apart from timed ones.
+    :return: dict of measurements
+    """
+    sys.stdout = open(os.devnull, "w")
+    skinnydip.set_log_console(sys.stdout)
+    skinnydip.start_log()
+    d = skinnydip.SetupData(path, stream=ENGINES[engine])
+    profiler = skinnydip.Profiler(trace_memory=trace_memory, count_regex=False, count_handlers=False)
+    skinnydip.run_pipeline(d, profiler)
+    measurements = {"stages": profiler.stages,
+                    "total": profiler.total,
+                    "lines": getattr(d, "linecount", None),
+                    "toolchanges": len(d.timeline),
+                    "dips": d.dips_inserted,
+                    "temperature_changes": d.temp_drops_inserted}
+    if resource is not None:
+        measurements["max_rss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return measurements
+
+
+def run_in_child(path, engine, trace_memory):
+    pool = multiprocessing.Pool(1)
+    try:
+        return pool.apply(measure_stages, (path, engine, trace_memory))
+    finally:
+        pool.close()
+        pool.join()
+
+
+def benchmark(args):
+    """
+    Generates (or reuses) an input of each size and runs every engine on a fresh copy
+    of it, args.repeat times for timing plus once with tracemalloc for memory.
+    :param args: parsed command line
+    :return: dict ready to be written as JSON
+    """
+    workdir = args.workdir or tempfile.mkdtemp(prefix="skinnydip_benchmark_")
+    if not os.path.isdir(workdir):
+        os.makedirs(workdir)
+    trace_memory = skinnydip.tracemalloc is not None and not args.no_memory
+    report = {"benchmark_version": BENCHMARK_VERSION,
+              "skinnydip_version": skinnydip.VERSION,
+              "python": platform.python_version(),
+              "implementation": platform.python_implementation(),
+              "platform": platform.platform(),
+              "cpu_count": multiprocessing.cpu_count(),
+              "started": time.strftime("%Y-%m-%dT%H:%M:%S"),
+              "runs": []}
+    try:
+        for size in [parse_size(text) for text in args.sizes.split(",")]:
+            toolchanges = args.toolchanges or max(1, size // args.toolchange_spacing)
+            source = os.path.join(workdir, "synthetic_%d_%d_%d_%d_%s.gcode" % (
+                size, toolchanges, args.tools, args.seed, args.thumbnail or "none"))
+            description = None
+            if os.path.exists(source) and os.path.exists(source + ".json"):
+                with open(source + ".json") as f:
+                    description = json.load(f)
+            if description is None:
+                print("generating " + source, file=sys.stderr)
+                with open(source, "wb") as f:
+                    description = generate_gcode(f, size, toolchanges, args.tools, args.seed,
+                                                 thumbnail=args.thumbnail)
+                with open(source + ".json", "w") as f:
+                    json.dump(description, f)
+            copy = os.path.join(workdir, "work.gcode")
+            for engine in args.engines.split(","):
+                runs = [False] * args.repeat + ([True] if trace_memory else [])
+                for repeat, traced in enumerate(runs):
+                    shutil.copyfile(source, copy)
+                    print("%s %s run %d%s" % (os.path.basename(source), engine, repeat,
+                                              " (memory)" if traced else ""), file=sys.stderr)
+                    run = {"input": description, "engine": engine, "repeat": repeat,
+                           "memory_traced": traced}
+                    run.update(run_in_child(copy, engine, traced))
+                    report["runs"].append(run)
+            os.remove(copy)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir)
+    return report
+
+
+# MAIN PROGRAM****************************************************************
+def main():
+    parser = argparse.ArgumentParser(description="Synthetic gcode generator and benchmark for skinnydip.py")
+    commands = parser.add_subparsers(dest="command")
+
+    generate = commands.add_parser("generate", help="write a synthetic MMU gcode file")
+    generate.add_argument("output", help="file to write")
+    generate.add_argument("--size", default="10M", help="approximate file size, eg. 500K, 10M, 2G")
+    generate.add_argument("--toolchanges", type=int, default=None,
+                          help="number of toolchanges (default: one per %d bytes)" % DEFAULT_TOOLCHANGE_SPACING)
+    generate.add_argument("--tools", type=int, default=DEFAULT_TOOLS, help="number of extruders")
+    generate.add_argument("--seed", type=int, default=1)
+    generate.add_argument("--unconfigured", default="",
+                          help="comma separated tool numbers to leave without a configuration block")
+    generate.add_argument("--thumbnail", default=None, help="add a thumbnail of this size, eg. 220x124")
+    generate.add_argument("--cooling-moves", type=int, default=DEFAULT_COOLING_MOVES)
+
+    run = commands.add_parser("run", help="time every stage of skinnydip.py on synthetic files")
+    run.add_argument("--sizes", default=DEFAULT_SIZES, help="comma separated file sizes")
+    run.add_argument("--toolchanges", type=int, default=None, help="toolchanges in every file")
+    run.add_argument("--toolchange-spacing", type=int, default=DEFAULT_TOOLCHANGE_SPACING,
+                     help="bytes between toolchanges, when --toolchanges isn't given")
+    run.add_argument("--tools", type=int, default=DEFAULT_TOOLS)
+    run.add_argument("--seed", type=int, default=1)
+    run.add_argument("--thumbnail", default=None)
+    run.add_argument("--engines", default=DEFAULT_ENGINES, help="comma separated: classic, stream")
+    run.add_argument("--repeat", type=int, default=DEFAULT_REPEAT, help="timed runs of each engine")
+    run.add_argument("--no-memory", action="store_true", help="skip the tracemalloc run")
+    run.add_argument("--workdir", default=None,
+                     help="keep generated files here and reuse them (default: a temporary directory)")
+    run.add_argument("--output", default=None, help="JSON report file (default: stdout)")
+    args = parser.parse_args()
+
+    if args.command == "generate":
+        unconfigured = [int(n) for n in args.unconfigured.split(",") if n.strip()]
+        with open(args.output, "wb") as f:
+            description = generate_gcode(f, parse_size(args.size), args.toolchanges, args.tools,
+                                         args.seed, [n for n in range(args.tools) if n not in unconfigured],
+                                         args.thumbnail, args.cooling_moves)
+        print(json.dumps(description, sort_keys=True))
+    elif args.command == "run":
+        report = json.dumps(benchmark(args), indent=2, sort_keys=True)
+        if args.output:
+            with open(args.output, "w") as f:
+                f.write(report + "\n")
+        else:
+            print(report)
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,395 @@
+; generated by PrusaSlicer 2.0.0+linux64 on 2019-05-29 at 21:05:14
+;
+; external perimeters extrusion width = 0.45mm
+
+M73 P0 R60
+M73 Q0 S61
+M201 X1000 Y1000 Z200 E5000
+M107
+G28 W
+G80
+T0
+M900 K30 ; Filament gcode
+; SKINNYDIP CONFIGURATION START
+; material_type PLA
+; material_name Spool 0
+; insertion_speed 2000
+; extraction_speed 4000
+; insertion_pause 100
+; insertion_distance 30
+; removal_pause 0
+; toolchange_temp 200
+; beep_on_dip off
+; beep_on_temp off
+; SKINNYDIP CONFIGURATION END
+G21 ; set units to millimeters
+G90
+M83
+G1 X82.383 Y65.085 E0.65443
+G1 X103.588 Y86.569 E0.06742
+G1 X53.750 Y93.365 E0.07916
+G1 X92.452 Y132.685 E0.13256
+G1 X112.743 Y144.771 E0.58133
+G1 X147.626 Y54.658 E0.85988
+G1 X64.426 Y61.779 E0.31540
+G1 X68.073 Y108.160 E0.64252
+G1 X104.774 Y56.279 E0.06901
+G1 X118.040 Y92.759 E0.32101
+G1 X95.318 Y79.977 E0.79644
+G1 X74.410 Y107.442 E0.52994
+G1 X122.945 Y78.794 E0.98037
+G1 X91.812 Y125.714 E0.16046
+G1 X53.921 Y116.822 E0.76693
+G1 X137.548 Y81.375 E0.69834
+G1 X107.990 Y95.621 E0.84157
+G1 X97.410 Y116.415 E0.07006
+G1 X114.713 Y149.310 E0.82371
+G1 X88.579 Y116.865 E0.03234
+G1 X66.805 Y61.710 E0.06836
+G1 X62.934 Y74.761 E0.39704
+G1 X58.058 Y94.919 E0.55395
+G1 X131.928 Y136.398 E0.28564
+G1 X85.877 Y138.419 E0.95815
+G1 X67.622 Y73.196 E0.24100
+G1 X108.912 Y76.275 E0.01405
+G1 X86.925 Y106.634 E0.95357
+G1 X101.549 Y111.759 E0.67944
+G1 X139.953 Y127.997 E0.87577
+G1 X89.238 Y89.898 E0.11250
+G1 X56.225 Y56.735 E0.21668
+G1 X84.005 Y55.258 E0.01023
+G1 X60.146 Y86.361 E0.03525
+G1 X111.407 Y64.855 E0.25974
+G1 X86.416 Y62.284 E0.85045
+G1 X96.599 Y98.383 E0.09503
+G1 X84.264 Y76.476 E0.83057
+G1 X52.310 Y145.099 E0.53297
+G1 X104.317 Y52.704 E0.53283
+G1 X136.333 Y119.620 E0.26850
+G1 X66.704 Y127.194 E0.53727
+G1 X82.966 Y72.304 E0.81340
+G1 X135.263 Y130.608 E0.82015
+G1 X72.674 Y101.764 E0.36201
+G1 X52.794 Y77.942 E0.26658
+G1 X145.652 Y94.723 E0.93765
+G1 X145.500 Y86.464 E0.22826
+;------------------
+; CP TOOLCHANGE START
+; toolchange #1
+; material : PLA -> PLA
+;------------------
+M220 B
+M220 S100
+; CP TOOLCHANGE UNLOAD
+G1 X170.000 E0.5000 F1200
+G1 X171.000 E0.5000 F1200
+G1 X172.000 E0.5000 F1200
+G1 X173.000 E0.5000 F1200
+G1 X174.000 E0.5000 F1200
+G1 E-15.0000 F3000
+G1 E-24.5000 F4800
+G1 E-7.0000 F2400
+G1 E-3.5000 F1440
+M104 S240
+G1 X170.000 Y10.000 F2400
+G1 X180.000 E20.0000 F1000
+G1 X170.000 E-20.0000 F1100
+G1 X180.000 E20.0000 F1050
+G1 X170.000 E-20.0000 F1150
+G1 X180.000 E20.0000 F1100
+G1 X170.000 E-20.0000 F1200
+G1 X180.000 E20.0000 F1150
+G1 X170.000 E-20.0000 F1250
+G1 E-42.0000 F2000
+G4 S0
+T1
+G4 S0
+; CP TOOLCHANGE LOAD
+G1 X170.000 E5.0000 F3000
+G1 X171.000 E5.0000 F3000
+G1 X172.000 E5.0000 F3000
+G1 X173.000 E5.0000 F3000
+G1 X174.000 E5.0000 F3000
+G1 X175.000 E5.0000 F3000
+G1 X176.000 E5.0000 F3000
+G1 X177.000 E5.0000 F3000
+M900 K30 ; Filament gcode
+; SKINNYDIP CONFIGURATION START
+; material_type PLA
+; material_name Spool 1
+; insertion_speed 2000
+; extraction_speed 4000
+; insertion_pause 0
+; insertion_distance 31
+; removal_pause 0
+; toolchange_temp 200
+; beep_on_dip off
+; beep_on_temp off
+; SKINNYDIP CONFIGURATION END
+; CP TOOLCHANGE WIPE
+G1 X170.000 Y10.000 E0.5000 F2000
+G1 X171.000 Y10.000 E0.5000 F2000
+G1 X172.000 Y10.000 E0.5000 F2000
+G1 X173.000 Y10.000 E0.5000 F2000
+G1 X174.000 Y10.000 E0.5000 F2000
+G1 X175.000 Y10.000 E0.5000 F2000
+; CP TOOLCHANGE END
+;------------------
+M220 R
+G1 X148.525 Y111.026 E0.01189
+G1 X84.401 Y114.313 E0.83630
+G1 X88.854 Y121.149 E0.20733
+G1 X93.393 Y113.584 E0.09588
+G1 X122.182 Y96.316 E0.74592
+G1 X65.886 Y149.311 E0.03727
+G1 X96.535 Y115.586 E0.61546
+G1 X97.436 Y143.747 E0.16435
+G1 X52.140 Y129.936 E0.72911
+G1 X124.950 Y63.925 E0.98668
+G1 X137.391 Y52.799 E0.22065
+G1 X126.368 Y82.599 E0.54891
+;------------------
+; CP TOOLCHANGE START
+; toolchange #2
+; material : PLA -> PLA
+;------------------
+M220 B
+M220 S100
+; CP TOOLCHANGE UNLOAD
+G1 X170.000 E0.5000 F1200
+G1 X171.000 E0.5000 F1200
+G1 X172.000 E0.5000 F1200
+G1 X173.000 E0.5000 F1200
+G1 X174.000 E0.5000 F1200
+G1 E-15.0000 F3000
+G1 E-24.5000 F4800
+G1 E-7.0000 F2400
+G1 E-3.5000 F1440
+M104 S215
+G1 X170.000 Y10.500 F2400
+G1 X180.000 E20.0000 F1000
+G1 X170.000 E-20.0000 F1100
+G1 X180.000 E20.0000 F1050
+G1 X170.000 E-20.0000 F1150
+G1 X180.000 E20.0000 F1100
+G1 X170.000 E-20.0000 F1200
+G1 X180.000 E20.0000 F1150
+G1 X170.000 E-20.0000 F1250
+G1 E-42.0000 F2000
+G4 S0
+T0
+G4 S0
+; CP TOOLCHANGE LOAD
+G1 X170.000 E5.0000 F3000
+G1 X171.000 E5.0000 F3000
+G1 X172.000 E5.0000 F3000
+G1 X173.000 E5.0000 F3000
+G1 X174.000 E5.0000 F3000
+G1 X175.000 E5.0000 F3000
+G1 X176.000 E5.0000 F3000
+G1 X177.000 E5.0000 F3000
+M900 K30 ; Filament gcode
+; SKINNYDIP CONFIGURATION START
+; material_type PLA
+; material_name Spool 0
+; insertion_speed 2000
+; extraction_speed 4000
+; insertion_pause 100
+; insertion_distance 30
+; removal_pause 0
+; toolchange_temp 200
+; beep_on_dip off
+; beep_on_temp off
+; SKINNYDIP CONFIGURATION END
+; CP TOOLCHANGE WIPE
+G1 X170.000 Y10.500 E0.5000 F2000
+G1 X171.000 Y10.500 E0.5000 F2000
+G1 X172.000 Y10.500 E0.5000 F2000
+G1 X173.000 Y10.500 E0.5000 F2000
+G1 X174.000 Y10.500 E0.5000 F2000
+G1 X175.000 Y10.500 E0.5000 F2000
+; CP TOOLCHANGE END
+;------------------
+M220 R
+G1 X95.816 Y108.335 E0.90525
+G1 X141.772 Y100.165 E0.53651
+G1 X51.870 Y94.012 E0.19128
+M73 P3 R59
+G1 X129.917 Y67.235 E0.47876
+G1 X105.648 Y82.598 E0.52317
+G1 X128.427 Y60.611 E0.56469
+G1 X77.692 Y127.226 E0.51264
+G1 X125.999 Y141.249 E0.44882
+G1 X100.555 Y101.216 E0.69580
+G1 X103.329 Y97.804 E0.94209
+G1 X137.654 Y144.218 E0.26700
+G1 X144.327 Y134.000 E0.14576
+;------------------
+; CP TOOLCHANGE START
+; toolchange #3
+; material : PLA -> PLA
+;------------------
+M220 B
+M220 S100
+; CP TOOLCHANGE UNLOAD
+G1 X170.000 E0.5000 F1200
+G1 X171.000 E0.5000 F1200
+G1 X172.000 E0.5000 F1200
+G1 X173.000 E0.5000 F1200
+G1 X174.000 E0.5000 F1200
+G1 E-15.0000 F3000
+G1 E-24.5000 F4800
+G1 E-7.0000 F2400
+G1 E-3.5000 F1440
+M104 S240
+G1 X170.000 Y11.000 F2400
+G1 X180.000 E20.0000 F1000
+G1 X170.000 E-20.0000 F1100
+G1 X180.000 E20.0000 F1050
+G1 X170.000 E-20.0000 F1150
+G1 X180.000 E20.0000 F1100
+G1 X170.000 E-20.0000 F1200
+G1 X180.000 E20.0000 F1150
+G1 X170.000 E-20.0000 F1250
+G1 E-42.0000 F2000
+G4 S0
+T1
+G4 S0
+; CP TOOLCHANGE LOAD
+G1 X170.000 E5.0000 F3000
+G1 X171.000 E5.0000 F3000
+G1 X172.000 E5.0000 F3000
+G1 X173.000 E5.0000 F3000
+G1 X174.000 E5.0000 F3000
+G1 X175.000 E5.0000 F3000
+G1 X176.000 E5.0000 F3000
+G1 X177.000 E5.0000 F3000
+M900 K30 ; Filament gcode
+; SKINNYDIP CONFIGURATION START
+; material_type PLA
+; material_name Spool 1
+; insertion_speed 2000
+; extraction_speed 4000
+; insertion_pause 0
+; insertion_distance 31
+; removal_pause 0
+; toolchange_temp 200
+; beep_on_dip off
+; beep_on_temp off
+; SKINNYDIP CONFIGURATION END
+; CP TOOLCHANGE WIPE
+G1 X170.000 Y11.000 E0.5000 F2000
+G1 X171.000 Y11.000 E0.5000 F2000
+G1 X172.000 Y11.000 E0.5000 F2000
+G1 X173.000 Y11.000 E0.5000 F2000
+G1 X174.000 Y11.000 E0.5000 F2000
+G1 X175.000 Y11.000 E0.5000 F2000
+; CP TOOLCHANGE END
+;------------------
+M220 R
+G1 X92.834 Y71.269 E0.30975
+G1 X127.693 Y143.950 E0.64702
+G1 X75.311 Y63.725 E0.47306
+G1 X59.413 Y138.493 E0.17117
+G1 X72.371 Y120.632 E0.99413
+G1 X92.128 Y85.661 E0.10127
+G1 X83.798 Y95.867 E0.70612
+G1 X101.743 Y79.545 E0.96117
+G1 X141.855 Y72.855 E0.87763
+G1 X77.192 Y140.590 E0.18974
+G1 X131.978 Y134.959 E0.67921
+G1 X90.595 Y103.660 E0.51963
+;------------------
+; CP TOOLCHANGE START
+; toolchange #4
+; material : PLA -> PLA
+;------------------
+M220 B
+M220 S100
+M73 P4 R50
+; CP TOOLCHANGE UNLOAD
+G1 X170.000 E0.5000 F1200
+G1 X171.000 E0.5000 F1200
+G1 X172.000 E0.5000 F1200
+G1 X173.000 E0.5000 F1200
+G1 X174.000 E0.5000 F1200
+G1 E-15.0000 F3000
+G1 E-24.5000 F4800
+M73 P4 R40
+G1 E-7.0000 F2400
+G1 E-3.5000 F1440
+M104 S215
+G1 X170.000 Y11.500 F2400
+G1 X180.000 E20.0000 F1000
+G1 X170.000 E-20.0000 F1100
+G1 X180.000 E20.0000 F1050
+G1 X170.000 E-20.0000 F1150
+G1 X180.000 E20.0000 F1100
+G1 X170.000 E-20.0000 F1200
+G1 X180.000 E20.0000 F1150
+G1 X170.000 E-20.0000 F1250
+G1 E-42.0000 F2000
+G4 S0
+T2
+G4 S0
+; CP TOOLCHANGE LOAD
+G1 X170.000 E5.0000 F3000
+G1 X171.000 E5.0000 F3000
+G1 X172.000 E5.0000 F3000
+G1 X173.000 E5.0000 F3000
+G1 X174.000 E5.0000 F3000
+G1 X175.000 E5.0000 F3000
+G1 X176.000 E5.0000 F3000
+G1 X177.000 E5.0000 F3000
+M900 K30 ; Filament gcode
+; SKINNYDIP CONFIGURATION START
+; material_type PLA
+; material_name Spool 2
+; insertion_speed 2000
+; extraction_speed 4000
+; insertion_pause 100
+; insertion_distance auto
+; removal_pause 0
+; toolchange_temp 200
+; beep_on_dip off
+; beep_on_temp off
+; SKINNYDIP CONFIGURATION END
+; CP TOOLCHANGE WIPE
+G1 X170.000 Y11.500 E0.5000 F2000
+G1 X171.000 Y11.500 E0.5000 F2000
+G1 X172.000 Y11.500 E0.5000 F2000
+G1 X173.000 Y11.500 E0.5000 F2000
+G1 X174.000 Y11.500 E0.5000 F2000
+G1 X175.000 Y11.500 E0.5000 F2000
+; CP TOOLCHANGE END
+;------------------
+M220 R
+;------------------
+; CP TOOLCHANGE START
+; toolchange #5
+M220 B
+M220 S100
+; CP TOOLCHANGE UNLOAD
+G1 E-15.0000 F3000
+G1 E-24.5000 F4800
+G1 E-7.0000 F2400
+G1 E-3.5000 F1440
+G1 X170.000 Y12.000 F2400
+G1 E-42.0000 F2000
+G1 X160.000 F3000
+G4 S0
+M220 R
+G1 Z10
+M84
+M73 P100 R0
+M73 Q100 S0
+; filament used [mm] = 123.4
+
+; bed_temperature = 60,60,60,60,60
+; cooling_tube_length = 20
+; cooling_tube_retraction = 40
+; extra_loading_move = -2
+; first_layer_temperature = 215,240,215
+; parking_pos_retraction = 92
+; temperature = 215,240,215
+; wipe_tower = 1
@@ -0,0 +1,111 @@
+import io
+import random
+import re
+import struct
+import zlib
+
+import pytest
+
+import skinnydip
+from conftest import read_data
+
+
+def normalized(gcode):
+    """
+    :return: gcode with the time and file name of the header blanked out
+    """
+    gcode = re.sub(br"(?m)^; Postprocessing completed on.*$", b"; Postprocessing completed on", bytes(gcode))
+    return re.sub(br"(?m)^;\s+File Processed:.*$", b"; File Processed:", gcode)
+
+
+def bgcode_block(block_type, compression, params, data):
+    stored = skinnydip.compress_block(data, compression)
+    header = struct.pack("<HHI", block_type, compression, len(data))
+    if compression != skinnydip.BGCODE_NO_COMPRESSION:
+        header += struct.pack("<I", len(stored))
+    block = header + params + stored
+    return block + struct.pack("<I", zlib.crc32(block) & 0xFFFFFFFF)
+
+
+def make_bgcode(gcode, compression, encoding):
+    """
+    Converts plain gcode to binary gcode the way the slicer writes it: the "; key = value"
+    settings at its end go to the slicer metadata block, the rest to gcode blocks.
+    :return: bytes of the binary gcode file
+    """
+    lines = gcode.split(b"\n")
+    cut = len(lines)
+    while cut > 0 and (lines[cut - 1].startswith(b"; ") and b" = " in lines[cut - 1] or not lines[cut - 1]):
+        cut -= 1
+    settings = b"".join([line[2:].replace(b" = ", b"=", 1) + b"\n" for line in lines[cut:] if line])
+    gcode = b"\n".join(lines[:cut]) + b"\n"
+    no_params = struct.pack("<H", 0)
+    blocks = [skinnydip.BGCODE_MAGIC + struct.pack("<IH", 1, skinnydip.BGCODE_CHECKSUM_CRC32),
+              bgcode_block(skinnydip.BGCODE_FILE_METADATA, skinnydip.BGCODE_DEFLATE, no_params,
+                           b"Producer=PrusaSlicer 2.6.0\n"),
+              bgcode_block(skinnydip.BGCODE_PRINTER_METADATA, skinnydip.BGCODE_NO_COMPRESSION, no_params,
+                           b"printer_model=MK3SMMU2S\n"),
+              bgcode_block(skinnydip.BGCODE_THUMBNAIL, skinnydip.BGCODE_NO_COMPRESSION,
+                           struct.pack("<HHH", 0, 16, 16), b"\x89PNG thumbnail"),
+              bgcode_block(skinnydip.BGCODE_PRINT_METADATA, skinnydip.BGCODE_NO_COMPRESSION, no_params,
+                           b"estimated printing time (normal mode)=1h\n"),
+              bgcode_block(skinnydip.BGCODE_SLICER_METADATA, skinnydip.BGCODE_DEFLATE, no_params, settings)]
+    payload = skinnydip.meatpack_encode(gcode) if encoding else gcode
+    blocks.append(bgcode_block(skinnydip.BGCODE_GCODE, compression, struct.pack("<H", encoding), payload))
+    return b"".join(blocks)
+
+
+def random_gcode(seed, lines=300):
+    rand = random.Random(seed)
+    words = [b"G1", b"X10.5", b"Y-3", b"E0.02", b"F2400", b"M104", b"S215", b"T1", b";", b"wipe", b"\t", b"{}"]
+    gcode = b"\n".join([b" ".join(rand.sample(words, rand.randint(0, 5))) for n in range(lines)])
+    return gcode + b"\n" * rand.randint(0, 1)
+
+
+@pytest.mark.parametrize("compression", sorted(skinnydip.BGCODE_HEATSHRINK))
+def test_heatshrink_round_trip(compression):
+    window_bits, lookahead_bits = skinnydip.BGCODE_HEATSHRINK[compression]
+    rand = random.Random(compression)
+    for data in [b"", b"G", b"G1 X1\n" * 2000, read_data("sample.gcode"),
+                 bytes(bytearray([rand.randrange(256) for n in range(5000)]))]:
+        packed = skinnydip.heatshrink_encode(data, window_bits, lookahead_bits)
+        assert skinnydip.heatshrink_decode(packed, window_bits, lookahead_bits) == data
+
+
+def test_meatpack_round_trip():
+    for data in [b"", b"G", b"G1\n", b"\n\n", read_data("sample.gcode")] + [random_gcode(seed) for seed in range(20)]:
+        assert skinnydip.meatpack_decode(skinnydip.meatpack_encode(data)) == data
+
+
+def test_meatpack_no_spaces_keeps_comments():
+    no_spaces = b"G1X10.5E-2;wipe,X1,E2\nG1Y2F2400 ;moveY\n;G1 X1 in a comment\nM104S215\nG1Z0.2\n"
+    spaced = b"G1 X10.5 E-2;wipe,X1,E2\nG1 Y2 F2400 ;moveY\n;G1 X1 in a comment\nM104S215\nG1 Z0.2\n"
+    enable_no_spaces = bytes(bytearray([skinnydip.MEATPACK_SIGNAL, skinnydip.MEATPACK_SIGNAL,
+                                        skinnydip.MEATPACK_ENABLE_NO_SPACES]))
+    assert skinnydip.meatpack_decode(enable_no_spaces + no_spaces) == spaced
+
+
+def test_space_gcode_lines_stops_at_comment():
+    assert skinnydip.space_gcode_lines(b"G1X10E-2;wipe,X1,E2\nM104S200\n;G1X1\n") == \
+        b"G1 X10 E-2;wipe,X1,E2\nM104S200\n;G1X1\n"
+
+
+@pytest.mark.parametrize("compression,encoding", [(0, 0), (1, 0), (2, 2), (3, 2), (3, 1)])
+def test_bgcode_end_to_end(compression, encoding):
+    gcode = read_data("sample.gcode")
+    plain = bytearray()
+    plain_result = skinnydip.process(gcode, plain)
+
+    original = make_bgcode(gcode, compression, encoding)
+    processed = bytearray()
+    result = skinnydip.process(original, processed)
+    assert (result.dips_inserted, result.temp_drops_inserted) == \
+        (plain_result.dips_inserted, plain_result.temp_drops_inserted)
+    assert result.dips_inserted > 0
+    decoded = b"".join(skinnydip.BinaryGcodeReader(io.BytesIO(bytes(processed))))
+    # the plain output still has the slicer's settings at its end
+    assert normalized(decoded) == normalized(plain)[:len(normalized(decoded))]
+
+    unprocessed = bytearray()
+    skinnydip.process(bytes(processed), unprocessed, unprocess=True)
+    assert bytes(unprocessed) == original
@@ -0,0 +1,82 @@
+import random
+import re
+from bisect import bisect_right
+
+import skinnydip
+
+# lines that come close to each part of INSERTIONS_REGEX without matching it
+NEAR_LINES = [b"G1 E-5\n", b"M73 P1\n", b"M104 S200\n", b"G1 X1\n", b"G1 \n", b"G1\n", b"G1E\n", b"G1 E\n",
+              b"G4 S0\n", b"T1\n", b"X\n", b"G1 EEE\n", b"xG1 E-3\n", b"G1 E-2 G1 E-4\n", b"T12\n"]
+
+
+def unload_sequence(rand):
+    """
+    :return: list of lines holding unloads in the shape INSERTIONS_REGEX looks for, with
+             the parts of each drawn at random, some too long or missing
+    """
+    lines = []
+    for unload in range(rand.randrange(1, 5)):
+        lines += [rand.choice(NEAR_LINES) for n in range(rand.randrange(0, 4))]
+        lines.append(rand.choice([b"G1 E-15\n", b"xG1 E-1\n"]))
+        lines += [rand.choice([b"G1 E-5\n", b"M73 P1\n"]) for n in range(rand.randrange(0, 9))]
+        if rand.random() < 0.5:
+            lines.append(b"M104 S" + str(rand.randrange(300)).encode() + b"\n")
+        lines.append(rand.choice([b"G1 X1\n", b"G1 \n", b"G1 E\n", b"G1 X\n"]))
+        lines += [rand.choice(NEAR_LINES) for n in range(rand.randrange(0, 24))]
+        lines.append(rand.choice([b"G1 X1\n", b"G1\n", b"G1E\n", b"G1 E-42\n", b"G1 EE\n"]))
+        lines += [rand.choice(NEAR_LINES) for n in range(rand.randrange(0, 7))]
+        lines += [b"G4 S0\n", rand.choice([b"T1\n", b"T3\n", b"T12\n"]), b"G4 S0\n"]
+        if rand.random() < 0.3:
+            lines += [b"T2\n", b"G4 S0\n"]
+    return lines
+
+
+def random_sequence(rand):
+    """
+    :return: list of lines drawn from NEAR_LINES, some more often than others
+    """
+    weights = [rand.random() for line in NEAR_LINES]
+    total = sum(weights)
+    lines = []
+    for n in range(rand.randrange(5, 80)):
+        pick = rand.random() * total
+        index = 0
+        while index < len(NEAR_LINES) - 1 and pick >= weights[index]:
+            pick -= weights[index]
+            index += 1
+        lines.append(NEAR_LINES[index])
+    return lines
+
+
+def regex_unloads(text, starts):
+    unloads = []
+    for match in re.finditer(skinnydip.INSERTIONS_REGEX, text):
+        unloads.append((match.start("temp_pause"), match.group("filament_temp"),
+                        match.start("temp_restore"), bisect_right(starts, match.start("dip_pos")) - 1,
+                        bisect_right(starts, match.start("new_tool")) - 1, match.group("new_tool")))
+    return unloads
+
+
+def matched_unloads(text, starts):
+    linecount = len(starts) - 1
+    toolchange_lines = [n for n in range(linecount)
+                        if re.match(skinnydip.TOOLCHANGE_REGEX, text[starts[n]:starts[n + 1]])]
+    unloads, floor = skinnydip.match_unloads(text, starts, linecount, toolchange_lines)
+    return [(unload["temp_pause_pos"], unload["filament_temp"], unload["temp_restore_pos"],
+             unload["dip_line"], unload["new_tool_line"], unload["new_tool"].encode())
+            for unload in unloads]
+
+
+def test_match_unloads_agrees_with_insertions_regex():
+    rand = random.Random(13)
+    matched = 0
+    for sequence in range(40000):
+        lines = unload_sequence(rand) if sequence % 2 else random_sequence(rand)
+        text = b"".join(lines)
+        if rand.random() < 0.2:  # no line ending after the last line
+            text = text[:-1]
+        starts = [0] + [match.end() for match in re.finditer(b"\n", text)]
+        expected = regex_unloads(text, starts)
+        assert matched_unloads(text, starts) == expected, text
+        matched += len(expected)
+    assert matched > 10000